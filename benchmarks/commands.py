@@ -0,0 +1,268 @@
+"""
+Runs the propad commands against moto (a local stand-in for EC2, IAM and
+STS) for fleets of simulated boxes and reports, per command, the wall
+time, the AWS API calls by operation, the state store write transactions
+and the ssh config writes. With a baseline it fails when a command makes
+more API calls than before or got slower by more than the threshold.
+
+    pip install 'moto[ec2,iam,sts]'
+    python benchmarks/commands.py [--fleets 10 100 200] [--verbose]
+    python benchmarks/commands.py --save-baseline   # after an intended change
+
+Without a baseline (commands_baseline.json next to this file, committed)
+the run fails like a regression would. The API calls are exact; the wall
+times of moto differ by a third between runs and even more between
+machines, so save a baseline of your own before comparing those.
+
+The boxes never run anything so the bootstrap check over ssh is answered
+with done right away.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+from collections import Counter
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'commands_baseline.json')
+
+REGION = 'us-east-2'
+CREDENTIALS = {'access_key': 'testing', 'secret_key': 'testing'}
+
+# (label, argv) in the order they run; {fleet} is the fleet size and {ami}
+# the image the boxes start from
+COMMANDS = [
+    ('initiate', ['initiate']),
+    ('create -n fleet', ['create', '-n', '{fleet}']),
+    ('stat --refresh (full sync)', ['stat', '--refresh']),
+    ('stat --refresh (unchanged)', ['stat', '--refresh']),
+    ('stat', ['stat']),
+    ('stat --cached', ['stat', '--cached']),
+    ('create', ['create']),
+    ('stop one', ['stop', 'box1']),
+    ('start one', ['start', 'box1']),
+    ('stop --all', ['stop', '--all']),
+    ('start --all', ['start', '--all']),
+    ('advise --no-pull', ['advise', '--no-pull']),
+    ('types', ['types', '--min-vcpu', '4', '--min-mem', '16']),
+    ('terminate one', ['terminate', 'box1']),
+    ('terminate --all', ['terminate', '--all']),
+    # last, so the commands above only talk to the one region
+    ('region add', ['region', 'add', 'us-west-2', '--ami', '{ami}']),
+    ('region list', ['region', 'list']),
+]
+
+
+class Counters(object):
+    """
+    what a command did besides taking time
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.api_calls = Counter()
+        self.db_writes = 0
+        self.ssh_writes = 0
+
+    def api_call(self, event_name, **kwargs):
+        # before-call.<service>.<Operation>
+        self.api_calls['.'.join(event_name.split('.')[1:])] += 1
+
+
+def instrument(counters):
+    from provisionpad.aws import aws_session
+    from provisionpad.db import database
+    from provisionpad.helpers import texthelpers, bootstrap
+
+    aws_session.register_handler('before-call', counters.api_call)
+
+    transaction = database.transaction
+
+    def counted_transaction(dbpath):
+        counters.db_writes += 1
+        return transaction(dbpath)
+    database.transaction = counted_transaction
+
+    write_if_changed = texthelpers.write_if_changed
+
+    def counted_write(*args, **kwargs):
+        wrote = write_if_changed(*args, **kwargs)
+        counters.ssh_writes += int(wrote)
+        return wrote
+    texthelpers.write_if_changed = counted_write
+
+    bootstrap.bootstrap_state = lambda boxname, instance_id=None: 'done'
+
+
+def mock_aws():
+    try:
+        from moto import mock_aws
+        return mock_aws()
+    except ImportError:
+        # moto < 5
+        from moto import mock_ec2, mock_iam, mock_sts
+        stack = contextlib.ExitStack()
+        for x in (mock_ec2, mock_iam, mock_sts):
+            stack.enter_context(x())
+        return stack
+
+
+def setup_home(home):
+    import boto3
+    env_dir = os.path.join(home, '.provisionpad')
+    os.makedirs(env_dir)
+    client = boto3.client('ec2', region_name=REGION,
+                          aws_access_key_id=CREDENTIALS['access_key'],
+                          aws_secret_access_key=CREDENTIALS['secret_key'])
+    ami = client.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+    env_vars = {'access_key': CREDENTIALS['access_key'],
+                'secret_key': CREDENTIALS['secret_key'],
+                'your_name': 'BENCH', 'aws_region': REGION, 'aws_ami': ami}
+    with open(os.path.join(env_dir, 'input_variable.json'), 'w') as f:
+        json.dump(env_vars, f)
+    return ami
+
+
+def run_fleet(fleet, counters, verbose):
+    from provisionpad.bin.propad import PPAD
+
+    results = {}
+    home = tempfile.mkdtemp(prefix='propad-bench-')
+    old_home = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    try:
+        with mock_aws():
+            ami = setup_home(home)
+            for label, argv in COMMANDS:
+                argv = ['propad'] + [x.format(fleet=fleet, ami=ami) for x in argv]
+                counters.reset()
+                out = sys.stdout if verbose else io.StringIO()
+                start = time.time()
+                try:
+                    with contextlib.redirect_stdout(out):
+                        PPAD(argv)
+                except SystemExit as e:
+                    if e.code:
+                        if not verbose:
+                            sys.stdout.write(out.getvalue())
+                        print ('{0} failed on the fleet of {1}'.format(' '.join(argv), fleet))
+                        raise
+                wall = time.time() - start
+                results[label] = {'wall': wall,
+                                  'api_calls': sum(counters.api_calls.values()),
+                                  'api_by_operation': dict(counters.api_calls),
+                                  'db_writes': counters.db_writes,
+                                  'ssh_writes': counters.ssh_writes}
+    finally:
+        if old_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = old_home
+        shutil.rmtree(home, ignore_errors=True)
+    return results
+
+
+def report(fleet, results):
+    print ('\nfleet of {0} boxes'.format(fleet))
+    print ('{:<28} {:>10} {:>9} {:>9} {:>10}   {}'.format(
+        'command', 'wall ms', 'api', 'db', 'ssh cfg', 'api calls'))
+    for label, _ in COMMANDS:
+        x = results[label]
+        ops = ', '.join('{0} {1}'.format(y, n) for y, n in sorted(x['api_by_operation'].items()))
+        print ('{:<28} {:>10.1f} {:>9} {:>9} {:>10}   {}'.format(
+            label, x['wall'] * 1000, x['api_calls'], x['db_writes'], x['ssh_writes'], ops))
+
+
+def regressions(results, baseline, threshold, min_ms):
+    """
+    commands which got slower than the baseline by more than threshold (and
+    min_ms) or make more API calls
+    """
+    failed = []
+    for fleet, commands in results.items():
+        for label, x in commands.items():
+            base = baseline.get(fleet, {}).get(label)
+            if base is None:
+                continue
+            slower = x['wall'] - base['wall']
+            if slower > base['wall'] * threshold and slower * 1000 > min_ms:
+                failed.append('{0} boxes, {1}: {2:.0f} ms -> {3:.0f} ms'.format(
+                    fleet, label, base['wall'] * 1000, x['wall'] * 1000))
+            if x['api_calls'] > base['api_calls']:
+                failed.append('{0} boxes, {1}: {2} -> {3} API calls'.format(
+                    fleet, label, base['api_calls'], x['api_calls']))
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='propad command benchmarks',
+                                     usage='%(prog)s [OPTIONS]')
+    parser.add_argument('--fleets', type=int, nargs='+', default=[10, 100, 200],
+                        help='fleet sizes to run the commands against (the '
+                        'subnet of propad is a /24, so at most about 250)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='json file with the results to compare against')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.5,
+                        help='allowed slow down as a fraction of the baseline')
+    parser.add_argument('--min-ms', type=float, default=100,
+                        help='slow downs under this many milliseconds are noise')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the commands')
+    args = parser.parse_args()
+
+    try:
+        import moto
+    except ImportError:
+        print ('the benchmarks need moto: pip install "moto[ec2,iam,sts]"')
+        sys.exit(2)
+
+    # no real credentials or config should leak in
+    for x in ('AWS_PROFILE', 'AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+        os.environ.pop(x, None)
+    os.environ['PROPAD_NO_DAEMON'] = '1'
+
+    counters = Counters()
+    instrument(counters)
+    results = {}
+    for fleet in args.fleets:
+        results[str(fleet)] = run_fleet(fleet, counters, args.verbose)
+        report(fleet, results[str(fleet)])
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print ('\nsaved the baseline to {0}'.format(args.baseline))
+        return
+    if not os.path.isfile(args.baseline):
+        print ('\nno baseline to compare against at {0}; run with --save-baseline'.format(
+            args.baseline))
+        sys.exit(1)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failed = regressions(results, baseline, args.threshold, args.min_ms)
+    if failed:
+        print ('\nFAIL:')
+        for x in failed:
+            print ('  ' + x)
+        sys.exit(1)
+    print ('\nno regressions against {0}'.format(args.baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Measures how long propad takes to start for the commands which should not
+pay for boto3 & co (--help and stat --cached) and fails when it goes over
+the budget. The budget is the time on top of a bare python startup.
+
+    python benchmarks/startup.py [--budget 100] [--runs 10]
+"""
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# none of these should be imported before a command actually needs them
+HEAVY_MODULES = ['boto3', 'botocore', 'terminaltables', 'colorclass', 'argcomplete']
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'src')
+
+
+def run_python(code, args=()):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [SRC_DIR, env.get('PYTHONPATH')]))
+    start = time.time()
+    proc = subprocess.Popen([sys.executable, '-c', code] + list(args), env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    return time.time() - start, out.decode('UTF-8')
+
+
+def median_time(code, args, runs):
+    times = sorted(run_python(code, args)[0] for x in range(runs))
+    return times[len(times)//2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='propad startup time budget',
+                                     usage='%(prog)s [OPTIONS]')
+    parser.add_argument('--budget', type=float, default=100,
+                        help='allowed milliseconds on top of a bare python startup')
+    parser.add_argument('--runs', type=int, default=10, help='runs per measurement')
+    args = parser.parse_args()
+
+    _, out = run_python('import sys, provisionpad.bin.propad; '
+                        'print(" ".join(x for x in %r if x in sys.modules))' % HEAVY_MODULES)
+    loaded = out.split()
+
+    base = median_time('pass', [], args.runs)
+    propad = 'import sys; sys.argv[0] = "propad"; from provisionpad.bin.propad import main; main()'
+    help_time = median_time(propad, ['--help'], args.runs)
+
+    failed = False
+    print ('python startup     : {0:8.1f} ms'.format(base * 1000))
+    overhead = (help_time - base) * 1000
+    print ('propad --help      : {0:8.1f} ms (+{1:.1f} ms, budget {2:.0f} ms)'.format(
+        help_time * 1000, overhead, args.budget))
+    if overhead > args.budget:
+        print ('FAIL: propad --help is over the startup budget')
+        failed = True
+    if loaded:
+        print ('FAIL: importing propad pulls in {0}'.format(', '.join(loaded)))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,14 @@ import time
 from collections import defaultdict
 import json
 
-import boto3
 from botocore.exceptions import ClientError
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from provisionpad.aws.aws_waiter import wait_for
+from provisionpad.aws.aws_session import get_client, get_resource
 
+# instances of the warm pool (runs/pool.py) carry this tag until claimed
+POOL_TAG = 'propad-pool'
 
 
 class AWSec2Funcs:
@@ -17,18 +21,15 @@ class AWSec2Funcs:
         self.access_key = access_key
         self.secret_key = secret_key 
 
-        self.ec2 = boto3.resource('ec2', region_name=region,
-                                aws_access_key_id=access_key,
-                                aws_secret_access_key=secret_key)
+        self.ec2 = get_resource('ec2', region, access_key, secret_key)
 
-        self.client = boto3.client('ec2', region_name=region,
-                                    aws_access_key_id=access_key,
-                                    aws_secret_access_key=secret_key)
+        self.client = get_client('ec2', region, access_key, secret_key)
 
        
     def create_vpc(self, thename):
 
-        vpctuple = namedtuple(thename, ['sg_id', 'subnet_id', 'vpc_id'])
+        # thename is a Name tag, not an identifier (region names have hyphens)
+        vpctuple = namedtuple('vpc', ['sg_id', 'subnet_id', 'vpc_id'])
         vpctuple.vpc_id = -1
         vpctuple.sg_id = -1
         vpctuple.subnet_id = -1
@@ -97,44 +98,106 @@ class AWSec2Funcs:
         
         self.client.delete_vpc(VpcId=vpcid)
 
-    def get_instance_info(self,id):
-        instances_info = self.client.describe_instances()['Reservations']
+    def _describe_instances(self, **kwargs):
+        paginator = self.client.get_paginator('describe_instances')
+        for page in paginator.paginate(**kwargs):
+            for x in page['Reservations']:
+                for y in x['Instances']:
+                    yield y
+
+    def _instance_info(self, y):
         rdict = {}
-        for x in instances_info:
-            for y in x['Instances']:
-                if y['InstanceId']== id:
-                    rdict['id'] = id
-                    rdict['launch_time'] = y['LaunchTime']
-                    rdict['type'] = y['InstanceType']
-                    rdict['public_dns'] = y['PublicDnsName'] if 'PublicDnsName' in y else 'NA'
-                    rdict['public_ip'] = y['PublicIpAddress'] if 'PublicIpAddress' in y else 'NA'
-                    rdict['private_dns'] = y['PrivateDnsName']
-                    rdict['private_ip'] = y['PrivateIpAddress']
-                    rdict['az'] = y['Placement']['AvailabilityZone'] # az is not me it is availabilityzone :D
-                    rdict['pdrive'] = y['BlockDeviceMappings'][0]['Ebs']['VolumeId']
-                    break
+        rdict['id'] = y['InstanceId']
+        rdict['launch_time'] = y['LaunchTime']
+        rdict['type'] = y['InstanceType']
+        rdict['public_dns'] = y['PublicDnsName'] if 'PublicDnsName' in y else 'NA'
+        rdict['public_ip'] = y['PublicIpAddress'] if 'PublicIpAddress' in y else 'NA'
+        rdict['private_dns'] = y['PrivateDnsName']
+        rdict['private_ip'] = y['PrivateIpAddress']
+        rdict['az'] = y['Placement']['AvailabilityZone'] # az is not me it is availabilityzone :D
+        rdict['region'] = self.region
+        if any(x['Key'] == POOL_TAG for x in y.get('Tags', [])):
+            rdict['pool'] = True
+        if y.get('HibernationOptions', {}).get('Configured'):
+            rdict['hibernate'] = True
+        # pending instances may not have their root volume mapped yet
+        rdict['pdrive'] = y['BlockDeviceMappings'][0]['Ebs']['VolumeId'] \
+            if y.get('BlockDeviceMappings') else 'NA'
         return rdict
 
+    def get_instance_info(self,id):
+        return self.get_instances_info([id]).get(id, {})
+
+    def get_instances_info(self, ids):
+        """
+        returns a dict of instance id to instance info for all the ids
+        using a single (paginated) describe call
+        """
+        if not ids:
+            return {}
+        try:
+            instances_info = list(self._describe_instances(InstanceIds=list(ids)))
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'InvalidInstanceID.NotFound':
+                raise
+            # one of the ids is gone; fall back to a filter which ignores
+            # the unknown ids instead of failing the whole call
+            filters = [{'Name': 'instance-id', 'Values': list(ids)}]
+            instances_info = list(self._describe_instances(Filters=filters))
+        return {y['InstanceId']: self._instance_info(y) for y in instances_info}
+
+    def owned_instances_info(self, your_name):
+        """
+        returns a dict of instance id to instance info (plus its state)
+        for all the non terminated instances tagged with your_name
+        """
+        # the tag filter is a substring match on the server side, same as
+        # the old python loop; terminated instances are left out altogether
+        filters = [
+            {'Name': 'tag:Name', 'Values': ['*{0}*'.format(your_name)]},
+            {'Name': 'instance-state-name',
+             'Values': ['pending', 'running', 'shutting-down', 'stopping', 'stopped']},
+        ]
+        data = {}
+        for y in self._describe_instances(Filters=filters):
+            data[y['InstanceId']] = self._instance_info(y)
+            data[y['InstanceId']]['state'] = y['State']['Name']
+        return data
+
     def instance_state(self, your_name):
-        instance_info = self.client.describe_instances()['Reservations']
         data = {}
-        for x in instance_info:
-            for y in x['Instances']:
-                if 'Tags' in y:
-                    for tag in y['Tags']:
-                        if tag['Key']=='Name' and your_name in tag['Value']:
-                            ip = y['PublicIpAddress'] if 'PublicIpAddress' in y else 'NA'
-                            data[y['InstanceId']] = [y['State']['Name'], ip]
-                            break
+        for id, info in self.owned_instances_info(your_name).items():
+            data[id] = [info['state'], info['public_ip']]
         return data
 
     def create_ec2_instance(self, params):
-
+        return self.create_ec2_instances(params, [params['name']])[0]
+
+    def create_ec2_instances(self, params, names, callback=None):
+        """
+        launches one instance per name with a single RunInstances call,
+        waits for all of them together and returns their info in the
+        order of names. params['name'] tags the instances until they get
+        their own name
+        """
+        count = len(names)
+        extra = {}
+        if params.get('hibernate'):
+            extra['HibernationOptions'] = {'Configured': True}
+        if params.get('root_volume'):
+            # hibernation needs an encrypted root with room for the memory
+            extra['BlockDeviceMappings'] = [{
+                'DeviceName': params['root_volume']['device'],
+                'Ebs': {'VolumeSize': params['root_volume']['size'],
+                        'VolumeType': 'gp3',
+                        'Encrypted': True,
+                        'DeleteOnTermination': True},
+            }]
         instances = self.ec2.create_instances(
                         ImageId=params['aws_ami'],
                         InstanceType=params['box_type'],
-                        MaxCount=1,
-                        MinCount=1,
+                        MaxCount=count,
+                        MinCount=count,
                         NetworkInterfaces=[{
                             'SubnetId': params['vpc']['subnet_id'],
                             'Groups': [params['vpc']['sg_id'],],
@@ -147,86 +210,308 @@ class AWSec2Funcs:
                                 'Tags': [
                                     {
                                         'Key': 'Name',
-                                        'Value': params['name']
+                                        'Value': names[0] if count == 1 else params['name']
                                     },
-                                ]
+                                ] + params.get('tags', [])
                             },
                         ],
                         IamInstanceProfile={
                             'Name': params['aws_iam_role']
                         },
-                        KeyName=params['ssh_key_name'])
-
-        instances[0].wait_until_running()
-        return self.get_instance_info(instances[0].id)
+                        UserData=params.get('user_data', ''),
+                        KeyName=params['ssh_key_name'],
+                        **extra)
+
+        ids = [x.id for x in instances]
+        self.wait_instances(ids, 'running', callback=callback)
+        if count > 1:
+            def tag(id_name):
+                self.client.create_tags(Resources=[id_name[0]],
+                                        Tags=[{'Key': 'Name', 'Value': id_name[1]}])
+            with ThreadPoolExecutor(max_workers=min(count, 16)) as pool:
+                list(pool.map(tag, zip(ids, names)))
+        infos = self.get_instances_info(ids)
+        return [infos[x] for x in ids]
+
+    def set_name_tag(self, id, name, remove=()):
+        """
+        renames the instance and drops the tags with the keys in remove
+        """
+        self.client.create_tags(Resources=[id], Tags=[{'Key': 'Name', 'Value': name}])
+        if remove:
+            self.client.delete_tags(Resources=[id], Tags=[{'Key': x} for x in remove])
 
     def terminate_ec2_instance(self, id):
-        ids = [id,]
-        instances = self.ec2.instances.filter(InstanceIds=ids).terminate()
-
-    def stop_ec2_instance(self, id):
-        ids = [id,]
-        instances = self.ec2.instances.filter(InstanceIds=ids).stop()
+        self.terminate_ec2_instances([id])
+
+    def terminate_ec2_instances(self, ids):
+        self.client.terminate_instances(InstanceIds=list(ids))
+
+    def stop_ec2_instance(self, id, wait=False):
+        self.stop_ec2_instances([id], wait=wait)
+
+    def stop_ec2_instances(self, ids, wait=False, callback=None, hibernate=False):
+        """
+        stops (or hibernates) all the instances with one call and optionally
+        waits for all of them together
+        """
+        if hibernate:
+            self.client.stop_instances(InstanceIds=list(ids), Hibernate=True)
+        else:
+            self.client.stop_instances(InstanceIds=list(ids))
+        if wait:
+            self.wait_instances(ids, 'stopped', callback=callback)
 
     def start_ec2_instance(self, id):
-        ids = [id,]
-        instances = self.ec2.instances.filter(InstanceIds=ids).start()
-        self.ec2.Instance(id=id).wait_until_running()
-        return self.get_instance_info(id)
+        return self.start_ec2_instances([id])[id]
+
+    def start_ec2_instances(self, ids, callback=None):
+        """
+        starts all the instances with one call, waits for all of them
+        together and returns their (new) info keyed by id
+        """
+        self.client.start_instances(InstanceIds=list(ids))
+        self.wait_instances(ids, 'running', callback=callback)
+        return self.get_instances_info(ids)
+
+    def instances_states(self, ids):
+        # a filter (instead of InstanceIds) does not fail on instances
+        # which are too new to be visible yet
+        filters = [{'Name': 'instance-id', 'Values': list(ids)}]
+        return {y['InstanceId']: y['State']['Name']
+                for y in self._describe_instances(Filters=filters)}
+
+    def volumes_states(self, ids):
+        filters = [{'Name': 'volume-id', 'Values': list(ids)}]
+        paginator = self.client.get_paginator('describe_volumes')
+        data = {}
+        for page in paginator.paginate(Filters=filters):
+            for x in page['Volumes']:
+                data[x['VolumeId']] = x['State']
+        return data
+
+    def wait_instances(self, ids, state, timeout=600, callback=None):
+        """
+        waits for all the instances with a single describe call per round
+        """
+        failed_states = {'running': ('shutting-down', 'terminated'),
+                         'stopped': ('terminated',)}.get(state, ())
+        wait_for(ids, self.instances_states, state, timeout=timeout,
+                 callback=callback, failed_states=failed_states)
+
+    def wait_volumes(self, ids, state, timeout=300, callback=None):
+        wait_for(ids, self.volumes_states, state, timeout=timeout,
+                 callback=callback, failed_states=('error', 'deleting', 'deleted'))
 
     def volume_waiter(self, id, state):
-        tw = 0
-        while True:
-            if tw > 60:
-                print ('it is taking too long to make this volume avaialable; volume waiter')
-                sys.exit()
-            info = self.client.describe_volumes()['Volumes']
-            for x in info:
-                if x['VolumeId'] == id:
-                    if x['State'] == state:
-                        return 
-            time.sleep(5)
-            tw += 5
+        self.wait_volumes([id], state)
 
     def create_volume(self, params):
-        volume = self.ec2.create_volume(
+        """
+        creates an EBS volume and returns its id without waiting for it.
+        params: az, size, vtype, name and optionally iops (gp3, io1, io2),
+        throughput (gp3) and snapshot (the id of the snapshot to make it
+        from)
+        """
+        extra = {}
+        if params.get('snapshot'):
+            extra['SnapshotId'] = params['snapshot']
+        if params.get('iops'):
+            extra['Iops'] = params['iops']
+        if params.get('throughput'):
+            extra['Throughput'] = params['throughput']
+        response = self.client.create_volume(
             AvailabilityZone=params['az'],
-            # Encrypted=True|False,
-            # Iops=123,
-            # KmsKeyId='string',
             Size=params['size'],
-            # SnapshotId='string',
-            VolumeType=params['vtype']   ,#'standard'|'io1'|'gp2'|'sc1'|'st1',
-            TagSpecifications=[
-                {
-                    'ResourceType': 'volume',
-                    'Tags': [
-                        {
-                            'Key': 'Name',
-                            'Value': params['name']
-                        },
-                    ]
-                },
-            ]
-        )
-        self.volume_waiter(volume.id, 'available')
-        response = volume.attach_to_instance(
-            Device='/dev/xvdh',
-            InstanceId=params['instance_id'],
-            # DryRun=True|False
-        )
+            VolumeType=params['vtype'],
+            TagSpecifications=[{'ResourceType': 'volume',
+                                'Tags': [{'Key': 'Name', 'Value': params['name']}]}],
+            **extra)
+        return response['VolumeId']
+
+    def attach_volume(self, volume_id, instance_id, device):
+        self.client.attach_volume(VolumeId=volume_id, InstanceId=instance_id, Device=device)
+
+    def detach_volume(self, volume_id):
+        self.client.detach_volume(VolumeId=volume_id)
+
+    def delete_volume(self, volume_id):
+        self.client.delete_volume(VolumeId=volume_id)
+
+    def volumes_info(self, ids):
+        """
+        returns a dict of volume id to its state, size, type, iops,
+        throughput and the instance it is attached to (or None) for the
+        volumes which still exist, with a single describe call
+        """
+        filters = [{'Name': 'volume-id', 'Values': list(ids)}]
+        paginator = self.client.get_paginator('describe_volumes')
+        data = {}
+        for page in paginator.paginate(Filters=filters):
+            for x in page['Volumes']:
+                attached = x.get('Attachments') or [{}]
+                data[x['VolumeId']] = {'state': x['State'], 'size': x['Size'],
+                                       'type': x['VolumeType'], 'iops': x.get('Iops', 0),
+                                       'throughput': x.get('Throughput', 0),
+                                       'instance_id': attached[0].get('InstanceId')}
+        return data
+
+    def create_snapshot(self, volume_id, name, tags=()):
+        """
+        starts a snapshot of the volume tagged with name and returns its id
+        """
+        response = self.client.create_snapshot(
+            VolumeId=volume_id,
+            Description='propad ' + name,
+            TagSpecifications=[{'ResourceType': 'snapshot',
+                                'Tags': [{'Key': 'Name', 'Value': name}] + list(tags)}])
+        return response['SnapshotId']
+
+    def _snapshots(self, **kwargs):
+        paginator = self.client.get_paginator('describe_snapshots')
+        data = []
+        for page in paginator.paginate(**kwargs):
+            for x in page['Snapshots']:
+                tags = dict((y['Key'], y['Value']) for y in x.get('Tags', []))
+                data.append({'id': x['SnapshotId'], 'name': tags.get('Name', ''),
+                             'size': x['VolumeSize'], 'state': x['State'],
+                             'progress': x.get('Progress', ''), 'time': x['StartTime'],
+                             'tags': tags})
+        return data
+
+    def named_snapshots(self, names, state=None):
+        """
+        the snapshots of this account with a Name tag matching any of the
+        names (which can have * and ?), optionally only the ones in state
+        """
+        filters = [{'Name': 'tag:Name', 'Values': list(names)}]
+        if state:
+            filters.append({'Name': 'status', 'Values': [state]})
+        return self._snapshots(OwnerIds=['self'], Filters=filters)
+
+    def snapshot_info(self, snapshot_id):
+        return self._snapshots(SnapshotIds=[snapshot_id])[0]
+
+    def instance_devices(self, instance_id):
+        """
+        the device names taken on the instance
+        """
+        for y in self._describe_instances(InstanceIds=[instance_id]):
+            return set(x['DeviceName'] for x in y.get('BlockDeviceMappings', []))
+        return set()
 
     def get_volume_info(self, id):
-        volume_info = self.client.describe_volumes()
-        print (volume_info['Volumes'][0]['Attachments'])
-        print (volume_info['Volumes'][1])
-        print (len(volume_info['Volumes']) )
+        paginator = self.client.get_paginator('describe_volumes')
+        for page in paginator.paginate(VolumeIds=[id]):
+            for x in page['Volumes']:
+                if x['VolumeId'] == id:
+                    return x
+        return {}
+
+    def _instance_types(self, **kwargs):
+        paginator = self.client.get_paginator('describe_instance_types')
+        data = {}
+        for page in paginator.paginate(**kwargs):
+            for x in page['InstanceTypes']:
+                ebs = x.get('EbsInfo', {}).get('EbsOptimizedInfo', {})
+                data[x['InstanceType']] = {
+                    'vcpu': x['VCpuInfo']['DefaultVCpus'],
+                    'memory_mib': x['MemoryInfo']['SizeInMiB'],
+                    'network': x.get('NetworkInfo', {}).get('NetworkPerformance', ''),
+                    'ebs_mbps': ebs.get('BaselineBandwidthInMbps', 0),
+                    'arch': ','.join(x.get('ProcessorInfo', {}).get('SupportedArchitectures', [])),
+                    'hibernation': x.get('HibernationSupported', False),
+                    'storage_gib': x.get('InstanceStorageInfo', {}).get('TotalSizeInGB', 0),
+                }
+        return data
+
+    def all_instance_types_info(self):
+        """
+        returns a dict of every instance type of the region to its vcpu,
+        memory_mib, network (performance), ebs_mbps (baseline bandwidth),
+        arch, hibernation (whether it can hibernate) and storage_gib
+        (instance store)
+        """
+        return self._instance_types()
+
+    def subnet_zone(self, subnet_id):
+        subnets = self.client.describe_subnets(SubnetIds=[subnet_id])['Subnets']
+        return subnets[0]['AvailabilityZone']
+
+    def instance_type_zones(self):
+        """
+        returns a dict of instance type to the availability zones offering it
+        """
+        paginator = self.client.get_paginator('describe_instance_type_offerings')
+        data = {}
+        for page in paginator.paginate(LocationType='availability-zone'):
+            for x in page['InstanceTypeOfferings']:
+                data.setdefault(x['InstanceType'], []).append(x['Location'])
+        return data
+
+    def create_image(self, instance_id, name, reboot=True):
+        """
+        starts making an image of the instance and returns its id. Without
+        reboot the file systems are copied as they are while running
+        """
+        tags = [{'Key': 'Name', 'Value': name}]
+        response = self.client.create_image(
+            InstanceId=instance_id,
+            Name=name,
+            Description='baked by propad',
+            NoReboot=not reboot,
+            TagSpecifications=[{'ResourceType': 'image', 'Tags': tags},
+                               {'ResourceType': 'snapshot', 'Tags': tags}])
+        return response['ImageId']
+
+    def images_states(self, ids):
+        filters = [{'Name': 'image-id', 'Values': list(ids)}]
+        images = self.client.describe_images(Filters=filters)['Images']
+        return {x['ImageId']: x['State'] for x in images}
+
+    def wait_images(self, ids, state='available', timeout=3600, callback=None):
+        wait_for(ids, self.images_states, state, timeout=timeout, delay=5, max_delay=30,
+                 callback=callback, failed_states=('failed', 'invalid', 'deregistered', 'error'))
+
+    def delete_image(self, image_id):
+        """
+        deregisters the image and deletes its snapshots
+        """
+        images = self.client.describe_images(ImageIds=[image_id])['Images']
+        self.client.deregister_image(ImageId=image_id)
+        for image in images:
+            for x in image.get('BlockDeviceMappings', []):
+                if 'Ebs' in x and 'SnapshotId' in x['Ebs']:
+                    self.client.delete_snapshot(SnapshotId=x['Ebs']['SnapshotId'])
+
+    def image_root(self, image_id):
+        """
+        (device name, size in GiB) of the root volume of the image
+        """
+        image = self.client.describe_images(ImageIds=[image_id])['Images'][0]
+        for x in image.get('BlockDeviceMappings', []):
+            if x['DeviceName'] == image['RootDeviceName'] and 'Ebs' in x:
+                return image['RootDeviceName'], x['Ebs']['VolumeSize']
+        return image['RootDeviceName'], 8
+
+    def latest_image(self, owner, name_pattern):
+        """
+        id of the newest available image of owner whose name matches the
+        pattern or None
+        """
+        filters = [{'Name': 'name', 'Values': [name_pattern]},
+                   {'Name': 'state', 'Values': ['available']}]
+        images = self.client.describe_images(Owners=[owner], Filters=filters)['Images']
+        if not images:
+            return None
+        return max(images, key=lambda x: x['CreationDate'])['ImageId']
 
     def create_key_pair(self, key_name):
         return self.ec2.create_key_pair(KeyName=key_name).key_material
 
     def check_key_pair(self, key_name):
-        key_pairs = self.client.describe_key_pairs()['KeyPairs']
+        filters = [{'Name': 'key-name', 'Values': [key_name]}]
+        key_pairs = self.client.describe_key_pairs(Filters=filters)['KeyPairs']
         for key in key_pairs:
             if key['KeyName'] == key_name:
                 return True
@@ -1,10 +1,10 @@
 import os
 import sys
-import boto3
 from botocore.exceptions import ClientError
 import json
 import time
 from provisionpad.aws.aws_sts import AWSstsFuncs
+from provisionpad.aws.aws_session import get_client, get_resource
 
 class AWSiamFuncs:
 
@@ -13,13 +13,9 @@ class AWSiamFuncs:
         self.access_key = access_key
         self.secret_key = secret_key 
 
-        self.client = boto3.client('iam', region_name=region,
-                                    aws_access_key_id=access_key,
-                                    aws_secret_access_key=secret_key )
+        self.client = get_client('iam', region, access_key, secret_key)
 
-        self.iam = boto3.resource('iam', region_name=region,
-                                    aws_access_key_id=access_key,
-                                    aws_secret_access_key=secret_key )
+        self.iam = get_resource('iam', region, access_key, secret_key)
 
         self.sts = AWSstsFuncs(region, access_key, secret_key)
 
@@ -92,6 +88,16 @@ class AWSiamFuncs:
             return False
         return True
 
+    def put_role_policy(self, role_name, policy_name, policy_doc):
+        """
+        adds (or replaces) an inline policy of the role
+        """
+        self.client.put_role_policy(
+            RoleName=role_name,
+            PolicyName=policy_name,
+            PolicyDocument=json.dumps(policy_doc),
+        )
+
     def create_instance_profile(self, name):
         instance_profile = self.iam.create_instance_profile(
             InstanceProfileName=name,
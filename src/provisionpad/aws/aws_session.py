@@ -0,0 +1,80 @@
+import threading
+import boto3
+from botocore.config import Config
+
+# One boto3 session per region and credentials and one client per service
+# on top of it for the whole process. Building them reloads the botocore
+# models and the credential chain and opens new connections, so AWSec2Funcs
+# & co share them instead of making their own.
+
+MAX_POOL_CONNECTIONS = 32
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_resources = {}
+# botocore event handlers every session (and client) gets, see register_handler
+_handlers = []
+
+
+def client_config():
+    return Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                  retries={'max_attempts': 8, 'mode': 'standard'})
+
+
+def get_session(region, access_key, secret_key):
+    key = (region, access_key, secret_key)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = boto3.session.Session(region_name=region,
+                                                   aws_access_key_id=access_key,
+                                                   aws_secret_access_key=secret_key)
+            for event, handler in _handlers:
+                _register(_sessions[key].events, event, handler)
+        return _sessions[key]
+
+
+def register_handler(event, handler):
+    """
+    registers a botocore event handler (e.g. before-call to count the API
+    calls) on the shared sessions and clients, the current ones and the
+    ones made later
+    """
+    with _lock:
+        _handlers.append((event, handler))
+        emitters = [x.events for x in _sessions.values()] + \
+                   [x.meta.events for x in _clients.values()] + \
+                   [x.meta.client.meta.events for x in _resources.values()]
+    for emitter in emitters:
+        _register(emitter, event, handler)
+
+
+def _register(emitter, event, handler):
+    # clients may share the emitter of their session; the unique id keeps
+    # the handler from running twice
+    emitter.register(event, handler, unique_id='propad-{0}-{1}'.format(event, id(handler)))
+
+
+def get_resource(service, region, access_key, secret_key):
+    session = get_session(region, access_key, secret_key)
+    key = (service, region, access_key, secret_key)
+    with _lock:
+        if key not in _resources:
+            _resources[key] = session.resource(service, config=client_config())
+        return _resources[key]
+
+
+def get_client(service, region, access_key, secret_key):
+    """
+    the client of the cached resource when the service has one so both
+    share the same connection pool
+    """
+    session = get_session(region, access_key, secret_key)
+    if service in session.get_available_resources():
+        return get_resource(service, region, access_key, secret_key).meta.client
+    key = (service, region, access_key, secret_key)
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session.client(service, config=client_config())
+        return _clients[key]
+
@@ -0,0 +1,94 @@
+import time
+import random
+from provisionpad.helpers.trace import span
+
+
+class WaiterError(Exception):
+    pass
+
+
+class WaiterTimeout(WaiterError):
+
+    def __init__(self, ids, target):
+        self.ids = sorted(ids)
+        self.target = target
+        super(WaiterTimeout, self).__init__(
+            'timed out waiting for {0} to become {1}'.format(', '.join(self.ids), target))
+
+
+class WaiterFailure(WaiterError):
+
+    def __init__(self, states, target):
+        self.states = states
+        self.target = target
+        super(WaiterFailure, self).__init__(
+            'gave up waiting for {0} to become {1}: {2}'.format(
+                ', '.join(sorted(states)), target,
+                ', '.join('{0} is {1}'.format(x, y) for x, y in sorted(states.items()))))
+
+
+def backoff_delays(delay=1, max_delay=15):
+    """
+    exponential backoff with (equal) jitter: 1, 2, 4, ... capped at max_delay
+    and each picked at random from the upper half of the interval
+    """
+    attempt = 0
+    while True:
+        cap = min(max_delay, delay * 2 ** attempt)
+        yield cap / 2.0 + random.uniform(0, cap / 2.0)
+        attempt += 1
+
+
+def wait_for(ids, fetch_states, target, timeout=600, delay=1, max_delay=15,
+             callback=None, failed_states=()):
+    """
+    waits until all the resources in ids reach the target state
+
+    fetch_states(ids) should return {id: state} for as many of the ids as it
+    can with a single API call; missing ids are considered not ready yet.
+    timeout is either a number of seconds for every id or a dict of id to
+    seconds. callback(id, state) is called as soon as each id gets there.
+    Raises WaiterFailure if an id ends up in one of the failed_states and
+    WaiterTimeout, after the others are done, for the ids that ran out of time
+    """
+    with span('wait for ' + target, count=len(ids)):
+        _wait_for(ids, fetch_states, target, timeout, delay, max_delay,
+                  callback, failed_states)
+
+
+def _wait_for(ids, fetch_states, target, timeout, delay, max_delay,
+              callback, failed_states):
+    start = time.time()
+    if isinstance(timeout, dict):
+        deadlines = dict((x, start + timeout[x]) for x in ids)
+    else:
+        deadlines = dict((x, start + timeout) for x in ids)
+    pending = set(ids)
+    timed_out = set()
+    delays = backoff_delays(delay, max_delay)
+
+    while pending:
+        states = fetch_states(sorted(pending))
+        failed = dict((x, states[x]) for x in pending
+                      if states.get(x) in failed_states)
+        if failed:
+            raise WaiterFailure(failed, target)
+        for x in sorted(pending):
+            if states.get(x) == target:
+                pending.discard(x)
+                if callback is not None:
+                    callback(x, target)
+        now = time.time()
+        for x in sorted(pending):
+            if deadlines[x] <= now:
+                pending.discard(x)
+                timed_out.add(x)
+        if not pending:
+            break
+        # no point sleeping past the first deadline
+        nap = min(next(delays), max(0, min(deadlines[x] for x in pending) - now))
+        with span('backoff sleep'):
+            time.sleep(nap)
+
+    if timed_out:
+        raise WaiterTimeout(timed_out, target)
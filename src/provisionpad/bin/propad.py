@@ -1,26 +1,40 @@
+# PYTHON_ARGCOMPLETE_OK
 import sys
 import os
 import argparse
-import argcomplete
 import json
 import textwrap
 from provisionpad.db.database import load_database
-from provisionpad.runs.create_instance import create_instance
-from provisionpad.runs.terminate_instance import terminate_instance
-from provisionpad.runs.stop_instance import stop_instance
-from provisionpad.runs.start_instance import start_instance
-from provisionpad.runs.create_vpc import create_vpc
-from provisionpad.runs.initiate import initiate
-from provisionpad.runs.status import show_status
+from provisionpad.helpers import trace
 
-shut_down_time = 10
+# The runs (and with them boto3, terminaltables, ...) are imported inside
+# the commands that need them so --help, tab completion and
+# stat --cached start fast. benchmarks/startup.py keeps an eye on it.
+
+# minutes a box has to be idle before it stops itself
+shut_down_time = 20
 
 from argparse import RawTextHelpFormatter
 
+def get_env_vars():
+    home = os.path.expanduser("~")
+    env_dir = os.path.join(home, '.provisionpad') 
+    env_var_path = os.path.join(env_dir, 'env_variable.json')
+    with open(env_var_path, 'r') as f:
+        env_vars = json.load(f)
+        if env_vars['env_path'] != env_var_path:
+            print ('something wrong')
+            raise ('The environment variable seems to be a wrong one')
+    env_vars = {str(key):str(val) for key, val in env_vars.items()}
+    return env_vars
+
+
 class PPAD(object):
 
-    def __init__(self):
+    def __init__(self, argv=None):
+        self.argv, profile = trace.profile_option(sys.argv if argv is None else argv)
         parser = argparse.ArgumentParser(
+            prog=os.path.basename(self.argv[0]),
             description='A very simple command line tool to control'
                         'your remote cloud based workstation',
             usage='''%(prog)s <command> [<args>]
@@ -32,28 +46,41 @@ The following commands are available:
     stop       :   Stop the running instance
     start      :   Start an stopped instance
     stat       :   Get the information on the current workspace
+    advise     :   Suggest instance types from how busy the boxes have been
+    region     :   Add another AWS region or list the ones in use
+    types      :   Find instance types by size
+    bake       :   Make an image of a box to create ready boxes from
+    pool       :   Keep stopped boxes ready so create only has to start one
+    volume     :   Create, attach, detach and list EBS data volumes
+    daemon     :   Start/stop a background agent which keeps propad warm
+
+Add --profile (or --profile=trace.json for a Chrome trace) to any command
+to see where its time goes.
 ''')
-        parser.add_argument('command', help='Choose one of (initiate, create, terminate, stop, start, stat) to run')
-        args = parser.parse_args(sys.argv[1:2])
+        parser.add_argument('command', help='Choose one of (initiate, create, terminate, stop, start, stat, advise, region, types, bake, pool, volume, daemon) to run')
+        if '_ARGCOMPLETE' in os.environ:
+            import argcomplete
+            argcomplete.autocomplete(parser)
+        args = parser.parse_args(self.argv[1:2])
         if not hasattr(self, args.command):
             print ('Unrecognized command')
             parser.print_help()
             exit(1)
-        getattr(self, args.command)()
+        if profile is None:
+            getattr(self, args.command)()
+            return
+        trace.start(profile)
+        try:
+            with trace.span('propad ' + args.command):
+                getattr(self, args.command)()
+        finally:
+            trace.finish()
 
     def get_env_vars(self):
-        home = os.path.expanduser("~")
-        env_dir = os.path.join(home, '.provisionpad') 
-        env_var_path = os.path.join(env_dir, 'env_variable.json')
-        with open(env_var_path, 'r') as f:
-            env_vars = json.load(f)
-            if env_vars['env_path'] != env_var_path:
-                print ('something wrong')
-                raise ('The environment variable seems to be a wrong one')
-        env_vars = {str(key):str(val) for key, val in env_vars.items()}
-        return env_vars
+        return get_env_vars()
 
     def initiate(self):
+        from provisionpad.runs.initiate import initiate
         initiate()
 
     def create(self):
@@ -67,6 +94,8 @@ The following commands are available:
 
 If no name is provided an automatic name starting with box will be used.
 Please note you can not use names starting with box.
+With --count N, N boxes are created together; a given name gets the
+numbers 1..N appended to it.
 If no instance type is provided the default t2.micro will be sued for aws
 as the instance type qualifies for the free tier            
             
@@ -74,11 +103,48 @@ as the instance type qualifies for the free tier
 
         parser.add_argument('name', nargs='?', help='Enter the name you want to use')
         parser.add_argument('type', nargs='?', help='''Enter the type of computing instance
-                                                    If you are using AWS see the following link for further info:
+                                                    propad types --min-vcpu 4 --min-mem 16 lists the ones
+                                                    which fit; for the prices see
                                                     https://aws.amazon.com/ec2/pricing/on-demand/
                                                     ''')
 
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('-n', '--count', type=int, default=1,
+                            help='Number of boxes to create with the same type')
+        parser.add_argument('--region',
+                            help='AWS region to create the boxes in (see propad region); '
+                                 'the one picked at initiate by default')
+        parser.add_argument('--image',
+                            help='Start from an image made with propad bake; '
+                                 'the boxes are ready right after they boot')
+        parser.add_argument('--hibernate', action='store_true',
+                            help='Stopping the boxes (propad stop or the idle shutdown) '
+                                 'hibernates them; start resumes them with their memory')
+        parser.add_argument('--scratch-caches', action='store_true',
+                            help='Point tmp and the pip and dataset caches at /scratch, '
+                                 'the instance store of types like c5d or i3 '
+                                 '(empty again after every stop)')
+        idle = parser.add_argument_group('idle shutdown policy',
+                                         'The box stops itself once all of these stay under '
+                                         'their limit for the whole idle window')
+        idle.add_argument('--idle-minutes', type=float, default=shut_down_time,
+                          help='Length of the idle window (default %(default)s)')
+        idle.add_argument('--idle-cpu', type=float,
+                          help='Lowest cpu idle fraction of an idle box (default 0.97)')
+        idle.add_argument('--idle-disk-kbps', type=float,
+                          help='Highest disk throughput of an idle box (default 1000)')
+        idle.add_argument('--idle-net-kbps', type=float,
+                          help='Highest network throughput of an idle box (default 100)')
+        idle.add_argument('--idle-load', type=float,
+                          help='Highest load average per cpu of an idle box (default 0.5)')
+        idle.add_argument('--idle-ssh-sessions', type=int,
+                          help='Most ssh sessions an idle box can have (ignored by default)')
+        idle.add_argument('--sample-seconds', type=float,
+                          help='Seconds between two samples (default 15)')
+
+        args = parser.parse_args(self.argv[2:])
+
+        if args.count < 1:
+            parser.error('count should be at least 1')
 
         if not args.name:
             boxname = ''
@@ -90,7 +156,33 @@ as the instance type qualifies for the free tier
         else:
             boxtype = args.type
 
-        create_instance(boxname, boxtype, shut_down_time, env_vars, DB)
+        idle_policy = {'window': args.idle_minutes * 60}
+        for key, val in [('cpu_idle', args.idle_cpu),
+                         ('disk_bps', args.idle_disk_kbps and args.idle_disk_kbps * 1000),
+                         ('net_bps', args.idle_net_kbps and args.idle_net_kbps * 1000),
+                         ('load', args.idle_load),
+                         ('ssh_sessions', args.idle_ssh_sessions),
+                         ('sample_interval', args.sample_seconds)]:
+            if val is not None:
+                idle_policy[key] = val
+
+        from provisionpad.runs.create_instance import create_instance
+        create_instance(boxname, boxtype, idle_policy, env_vars, DB, args.count,
+                        region=args.region, image=args.image, hibernate=args.hibernate,
+                        scratch_caches=args.scratch_caches)
+
+    def select_boxes(self, args, boxnames):
+        if not args.names and not args.all:
+            raise NameError('You need to enter the name of the box')
+        from provisionpad.helpers.namehelpers import match_box_names
+        matched, unmatched = match_box_names(args.names, boxnames, args.all)
+        if unmatched:
+            print ('the box is not available check again: {0}'.format(' '.join(unmatched)))
+            sys.exit(1)
+        if not matched:
+            print ('there is no box to work on')
+            sys.exit()
+        return matched
 
     def terminate(self):
 
@@ -98,22 +190,27 @@ as the instance type qualifies for the free tier
         DB = load_database(env_vars['db_path'])
 
         parser = argparse.ArgumentParser(
-            description='Create a new computing instance',
-            usage='''propad terminate thename
+            description='Terminate computing instances',
+            usage='''propad terminate thename [thename ...] [--all]
 
 for example:
     propad terminate box2 
     the command above will terminate the box2 and the associated root volume           
+    propad terminate 'box*'
+    the command above will terminate all the running boxes named box...
             
 ''')
 
-        parser.add_argument('name', nargs='?', help='Enter the name of the box you want to terminate')
+        parser.add_argument('names', nargs='*', help='Enter the names (or glob patterns) of the boxes you want to terminate')
+        parser.add_argument('--all', action='store_true', help='Terminate all the running boxes')
 
-        args = parser.parse_args(sys.argv[2:])
-        boxname = args.name
-        if not boxname:
-            raise NameError('You need to enter the name of the box')
-        terminate_instance(boxname, env_vars, DB)
+        args = parser.parse_args(self.argv[2:])
+        # patterns only pick running boxes but a stopped box asked for by
+        # its name still gets the proper error
+        boxnames = list(DB['running_instances']) + \
+            [x for x in args.names if x in DB['stopped_instances']]
+        from provisionpad.runs.terminate_instance import terminate_instances
+        terminate_instances(self.select_boxes(args, boxnames), env_vars, DB)
     
     def stop(self):
 
@@ -121,24 +218,24 @@ for example:
         DB = load_database(env_vars['db_path'])
 
         parser = argparse.ArgumentParser(
-            description='Create a new computing instance',
-            usage='''propad stop thename
+            description='Stop running computing instances',
+            usage='''propad stop thename [thename ...] [--all]
 
 for example:
-    propad top box2 
+    propad stop box2 
     the command above will stop the box2 and the associated root volume           
+    propad stop --all
+    the command above will stop all the running boxes
             
 ''')
 
-        parser.add_argument('name', nargs='?', help='Enter the name of the box you want to terminate')
-
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('names', nargs='*', help='Enter the names (or glob patterns) of the boxes you want to stop')
+        parser.add_argument('--all', action='store_true', help='Stop all the running boxes')
 
-        boxname = args.name
-        if not boxname:
-            raise NameError('You need to enter the name of the box')
+        args = parser.parse_args(self.argv[2:])
 
-        stop_instance(boxname, env_vars, DB)
+        from provisionpad.runs.stop_instance import stop_instances
+        stop_instances(self.select_boxes(args, DB['running_instances']), env_vars, DB)
     
     def start(self):
 
@@ -146,24 +243,24 @@ for example:
         DB = load_database(env_vars['db_path'])
 
         parser = argparse.ArgumentParser(
-            description='Create a new computing instance',
-            usage='''propad stop thename
+            description='Start stopped computing instances',
+            usage='''propad start thename [thename ...] [--all]
 
 for example:
     propad start box2 
     the command above will restart the stopped box2            
+    propad start 'gpu*'
+    the command above will restart all the stopped boxes named gpu...
             
 ''')
 
-        parser.add_argument('name', nargs='?', help='Enter the name of the box you want to terminate')
-
-        args = parser.parse_args(sys.argv[2:])
+        parser.add_argument('names', nargs='*', help='Enter the names (or glob patterns) of the boxes you want to start')
+        parser.add_argument('--all', action='store_true', help='Start all the stopped boxes')
 
-        boxname = args.name
-        if not boxname:
-            raise NameError('You need to enter the name of the box')
+        args = parser.parse_args(self.argv[2:])
 
-        start_instance(boxname, env_vars, DB)
+        from provisionpad.runs.start_instance import start_instances
+        start_instances(self.select_boxes(args, DB['stopped_instances']), env_vars, DB)
 
 
     def stat(self):
@@ -171,13 +268,326 @@ for example:
         Prints out the stat of the running and stopped instances
         '''
 
+        parser = argparse.ArgumentParser(
+            description='Get the information on the current workspace',
+            usage='''propad stat [--cached | --refresh]
+
+--cached shows the state propad already knows about without asking AWS
+--refresh asks AWS even if the state was synced in the last few seconds
+''')
+        parser.add_argument('--cached', action='store_true',
+                            help='Only use the local state; no AWS calls')
+        parser.add_argument('--refresh', action='store_true',
+                            help='Always sync the state with AWS')
+        args = parser.parse_args(self.argv[2:])
+
         env_vars = self.get_env_vars()
         DB = load_database(env_vars['db_path'])
-        show_status(env_vars, DB)
+        from provisionpad.runs.status import show_status
+        show_status(env_vars, DB, cached=args.cached, refresh=args.refresh)
+
+    def advise(self):
+        '''
+        Right sizing advice from the utilization history of the boxes
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Suggest instance types from how busy the boxes have been',
+            usage='''propad advise [thename ...] [--days N] [--no-pull]
+
+Every box keeps a history of its cpu and memory use. advise copies the new
+part of it into the local state and suggests the smallest type of the same
+family which would have kept the box under 70% cpu and 80% memory most
+(95%) of the time. With no names all the boxes are looked at.
+''')
+        parser.add_argument('names', nargs='*', help='Enter the names (or glob patterns) of the boxes')
+        parser.add_argument('--days', type=float, default=14,
+                            help='Days of history to look at (default %(default)s)')
+        parser.add_argument('--no-pull', action='store_true',
+                            help='Only use the history already stored locally')
+        args = parser.parse_args(self.argv[2:])
+
+        env_vars = self.get_env_vars()
+        DB = load_database(env_vars['db_path'])
+        boxnames = list(DB['running_instances']) + list(DB['stopped_instances'])
+        args.all = not args.names
+        from provisionpad.runs.advise import advise
+        advise(self.select_boxes(args, boxnames), env_vars, DB,
+               days=args.days, pull=not args.no_pull)
 
         
-def main():
-   PPAD() 
+    def region(self):
+        '''
+        Sets propad up in more AWS regions
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Add another AWS region or list the ones in use',
+            usage='''propad region add theregion [--ami AMI]
+       propad region list
+
+add creates the VPC and key pair propad needs in the region; after that
+create --region theregion starts boxes there and stat, stop, start and
+terminate work on the boxes of all the regions at once.
+''')
+        parser.add_argument('action', choices=['add', 'list'])
+        parser.add_argument('name', nargs='?', help='Enter the AWS region (us-west-2, ...)')
+        parser.add_argument('--ami', help='Image the boxes start from (Ubuntu 18.04 by default)')
+        args = parser.parse_args(self.argv[2:])
+
+        env_vars = self.get_env_vars()
+        DB = load_database(env_vars['db_path'])
+        from provisionpad.runs.regions import add_region, list_regions
+        if args.action == 'add':
+            if not args.name:
+                parser.error('enter the region to add')
+            add_region(args.name, env_vars, DB, ami=args.ami)
+        else:
+            list_regions(env_vars, DB)
+
+    def types(self):
+        '''
+        Queries the cached instance type catalog
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Find instance types by size',
+            usage='''propad types [pattern] [--min-vcpu N] [--min-mem GiB] [--arch ARCH]
+
+for example:
+    propad types --min-vcpu 16 --min-mem 64
+    propad types 'c5*' --arch x86_64
+
+The catalog of each region is cached in the state store for a week so
+this does not call AWS; --refresh fetches it again.
+''')
+        parser.add_argument('pattern', nargs='?', default='*',
+                            help='Glob pattern on the type name (m5.*, c6g*, ...)')
+        parser.add_argument('--min-vcpu', type=int, default=0, help='Least number of vCPUs')
+        parser.add_argument('--min-mem', type=float, default=0, help='Least memory in GiB')
+        parser.add_argument('--arch', help='Architecture (x86_64, arm64)')
+        parser.add_argument('--region', help='AWS region; the one picked at initiate by default')
+        parser.add_argument('--refresh', action='store_true', help='Fetch the catalog from AWS again')
+        args = parser.parse_args(self.argv[2:])
+
+        env_vars = self.get_env_vars()
+        from provisionpad.runs.types import show_types
+        show_types(env_vars, args.region or env_vars['aws_region'], args.pattern,
+                   args.min_vcpu, args.min_mem, args.arch, args.refresh)
+
+    def bake(self):
+        '''
+        Makes images of configured boxes
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Make an image of a box to create ready boxes from',
+            usage='''propad bake thename [--name imagename] [--no-reboot] [--wait]
+       propad bake --list
+       propad bake --delete imagename
+
+for example:
+    propad bake box2 --name cuda
+    propad create gpu p3.2xlarge --image cuda
+
+The image is made in the background (it takes a few minutes); --list
+shows when it is available. By default AWS reboots the box to take a
+consistent copy of its disks; --no-reboot copies them while it runs.
+''')
+        parser.add_argument('boxname', nargs='?', help='Enter the name of the box')
+        parser.add_argument('--name', help='Name of the image (the box name and the time by default)')
+        parser.add_argument('--no-reboot', action='store_true', help='Do not reboot the box')
+        parser.add_argument('--wait', action='store_true', help='Wait for the image here')
+        parser.add_argument('--list', action='store_true', help='List the baked images')
+        parser.add_argument('--delete', metavar='IMAGENAME', help='Delete a baked image')
+        args = parser.parse_args(self.argv[2:])
+
+        env_vars = self.get_env_vars()
+        DB = load_database(env_vars['db_path'])
+        from provisionpad.runs import bake
+        if args.list:
+            bake.list_images(env_vars, DB)
+        elif args.delete:
+            bake.delete_image(args.delete, env_vars, DB)
+        elif args.boxname:
+            bake.bake(args.boxname, env_vars, DB, imagename=args.name,
+                      reboot=not args.no_reboot, wait=args.wait)
+        else:
+            parser.error('enter the name of the box to bake')
+
+    def pool(self):
+        '''
+        Controls the warm pool of set up, stopped boxes
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Keep stopped boxes ready so create only has to start one',
+            usage='''propad pool set thetype N [--region theregion]
+       propad pool list
+       propad pool fill
 
+for example:
+    propad pool set c5.xlarge 2
+    propad create mybox c5.xlarge
+    the second command starts one of the two stopped c5.xlarge boxes which
+    are already set up and the pool gets a new one in the background
 
+set N to 0 to empty the pool of a type. The pool boxes cost only their
+disks while stopped.
+''')
+        parser.add_argument('action', choices=['set', 'list', 'fill'])
+        parser.add_argument('type', nargs='?', help='Enter the instance type')
+        parser.add_argument('size', nargs='?', type=int, help='Number of boxes to keep ready')
+        parser.add_argument('--region', help='AWS region; the one picked at initiate by default')
+        args = parser.parse_args(self.argv[2:])
 
+        env_vars = self.get_env_vars()
+        DB = load_database(env_vars['db_path'])
+        from provisionpad.runs import pool
+        if args.action == 'set':
+            if not args.type or args.size is None or args.size < 0:
+                parser.error('enter the instance type and the size of its pool')
+            region = args.region or env_vars['aws_region']
+            from provisionpad.helpers.typehelpers import check_instance_type
+            check_instance_type(env_vars, DB, region, args.type)
+            pool.set_pool_size(args.type, args.size, region, env_vars, DB)
+        elif args.action == 'list':
+            pool.list_pool(env_vars, DB)
+        else:
+            pool.fill_pool(env_vars)
+
+    def volume(self):
+        '''
+        Creates, attaches, detaches, lists and deletes EBS data volumes
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Create, attach, detach and list EBS data volumes',
+            usage='''propad volume create thename [--box thebox] [--size GiB] [--count N]
+                            [--type gp3|io2|...] [--iops N] [--throughput MiB/s]
+                            [--mount /path] [--snapshot thesnapshot [--prewarm]]
+       propad volume attach thename thebox [--mount /path]
+       propad volume detach thename [thename ...]
+       propad volume delete thename [thename ...]
+       propad volume list
+       propad volume snapshot thename thesnapshot
+       propad volume snapshots [pattern]
+       propad volume prewarm thename [--no-follow]
+
+for example:
+    propad volume create scratch --box mybox --size 500 --count 4 --throughput 500 --mount /data
+    the command above creates four 500 GiB gp3 volumes together, attaches them
+    to mybox and stripes them (RAID0) into one file system mounted at /data,
+    good for about 2000 MB/s if mybox itself can move that much
+
+The volumes of a group are attached and detached together and the file
+system goes back to its mount point on the next attach. --mount makes a file
+system on volumes propad has not made one on yet; anything on them is lost.
+
+    propad volume snapshot scratch refdata
+    propad volume create ref --box otherbox --snapshot refdata --prewarm
+    propad volume prewarm ref
+    the first command snapshots the volumes of scratch as refdata, the second
+    makes new volumes with the same data from it on otherbox, mounted where
+    scratch was, and starts reading all their blocks in the background so the
+    first reads are not slow; the third shows how far that got.
+--snapshot also takes the Name tag or the id of any snapshot of the account.
+''')
+        parser.add_argument('action', choices=['create', 'attach', 'detach', 'delete', 'list',
+                                               'snapshot', 'snapshots', 'prewarm'])
+        parser.add_argument('names', nargs='*',
+                            help='Enter the name of the volume(s) and for attach the box')
+        parser.add_argument('--box', help='Box to attach the new volumes to')
+        parser.add_argument('--zone', help='Availability zone of new volumes without a box')
+        parser.add_argument('--region', help='AWS region of new volumes without a box')
+        parser.add_argument('--size', type=int,
+                            help='GiB per volume (default 100, or the size of the snapshot)')
+        parser.add_argument('-n', '--count', type=int, default=1,
+                            help='Number of volumes to stripe together (default %(default)s)')
+        parser.add_argument('--type', default='gp3', choices=['gp3', 'gp2', 'io1', 'io2', 'st1', 'sc1'],
+                            help='EBS volume type (default %(default)s)')
+        parser.add_argument('--iops', type=int, help='Provisioned IOPS per volume (gp3, io1, io2)')
+        parser.add_argument('--throughput', type=int, help='MiB/s per volume (gp3, 125 to 1000)')
+        parser.add_argument('--mount', help='Where to mount the file system on the box')
+        parser.add_argument('--snapshot', help='Make the volumes from this snapshot (Name tag or id)')
+        parser.add_argument('--prewarm', action='store_true',
+                            help='Read all the blocks of volumes made from a snapshot once, '
+                                 'in the background on the box')
+        parser.add_argument('--no-follow', action='store_true',
+                            help='Start pre-warming without waiting for it')
+        args = parser.parse_args(self.argv[2:])
+
+        env_vars = self.get_env_vars()
+        DB = load_database(env_vars['db_path'])
+        from provisionpad.runs import volume
+        if args.action == 'create':
+            if len(args.names) != 1:
+                parser.error('enter the name of the new volume')
+            if args.count < 1:
+                parser.error('count should be at least 1')
+            if (args.mount or args.prewarm) and not args.box:
+                parser.error('--mount and --prewarm need --box')
+            if args.prewarm and not args.snapshot:
+                parser.error('only volumes made from a snapshot need --prewarm')
+            volume.create_volumes(args.names[0], args.size, args.type, args.iops, args.throughput,
+                                  args.count, args.box, args.zone, args.region, args.mount,
+                                  env_vars, DB, snapshot=args.snapshot, prewarm=args.prewarm)
+        elif args.action == 'attach':
+            if len(args.names) < 2:
+                parser.error('enter the name of the volume and of the box')
+            volume.attach_volumes(args.names[:-1], args.names[-1], args.mount, env_vars, DB)
+        elif args.action == 'detach':
+            if not args.names:
+                parser.error('enter the name of the volume')
+            volume.detach_volumes(args.names, env_vars, DB)
+        elif args.action == 'delete':
+            if not args.names:
+                parser.error('enter the name of the volume')
+            volume.delete_volumes(args.names, env_vars, DB)
+        elif args.action == 'snapshot':
+            if len(args.names) != 2:
+                parser.error('enter the name of the volume and of the snapshot')
+            volume.snapshot_volumes(args.names[0], args.names[1], env_vars, DB)
+        elif args.action == 'snapshots':
+            volume.list_snapshots(args.names[0] if args.names else '*', env_vars, DB)
+        elif args.action == 'prewarm':
+            if not args.names:
+                parser.error('enter the name of the volume')
+            volume.prewarm_volumes(args.names, not args.no_follow, env_vars, DB)
+        else:
+            volume.list_volumes(env_vars, DB)
+
+    def daemon(self):
+        '''
+        Controls the background agent the other commands are forwarded to
+        '''
+
+        parser = argparse.ArgumentParser(
+            description='Control the propad daemon',
+            usage='''propad daemon start|stop|status [--refresh seconds]
+
+The daemon keeps the AWS connections and the state warm. While it runs
+create, terminate, stop, start, stat and advise are handed over to it; set
+PROPAD_NO_DAEMON=1 to run a command in process anyway.
+''')
+        parser.add_argument('action', choices=['start', 'stop', 'status'])
+        parser.add_argument('--refresh', type=float, default=20,
+                            help='Seconds between two syncs of the state with AWS')
+        args = parser.parse_args(self.argv[2:])
+
+        from provisionpad.runs import daemon
+        if args.action == 'start':
+            self.get_env_vars()
+            daemon.start_daemon(args.refresh)
+        elif args.action == 'stop':
+            daemon.stop_daemon()
+        else:
+            daemon.daemon_status()
+
+        
+def main():
+    from provisionpad.runs.daemon import forward
+    code = forward(sys.argv)
+    if code is not None:
+        sys.exit(code)
+    PPAD() 
@@ -1,22 +1,516 @@
 import os
 import sys
+import json
+import time
 import pickle
+import sqlite3
+import datetime
 from collections import deque
+from copy import deepcopy
+from contextlib import contextmanager
+from provisionpad.helpers.trace import span
 
-def initiate_db(dbpath):
-    print('initiating the database')
-    database = {'created_instances': 0}
-    database['available_names'] = deque()
-    database['running_instances'] = {}
-    database['stopped_instances'] = {}
-    pickle.dump( database, open( dbpath, 'wb' ), protocol=2 )
+# The state lives in a sqlite database (WAL mode) so that several propad
+# commands can run at the same time. Commands still see the state as the
+# good old dict:
+#   {'created_instances': int, 'available_names': deque,
+#    'running_instances': {name: info}, 'stopped_instances': {name: info},
+#    'pool_instances': {name: info},
+#    vpc_name: {'vpc_id', 'sg_id', 'subnet_id'},
+#    'sync': {'time', 'etag'}, 'regions': {region: {...}},
+#    'images': {name: {...}}}
+# and save_database only writes the rows that changed since the dict was
+# loaded, inside a single transaction.
+# The utilization history the boxes report (see propad advise) is append
+# only and the instance type catalog is a cache of AWS; both are too big
+# for the dict and have their own functions at the bottom.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value       TEXT
+);
+CREATE TABLE IF NOT EXISTS instances (
+    name        TEXT PRIMARY KEY,
+    instance_id TEXT NOT NULL UNIQUE,
+    state       TEXT NOT NULL,
+    info        TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS instances_state ON instances (state);
+CREATE TABLE IF NOT EXISTS vpcs (
+    name        TEXT PRIMARY KEY,
+    vpc_id      TEXT,
+    sg_id       TEXT,
+    subnet_id   TEXT
+);
+CREATE TABLE IF NOT EXISTS available_names (
+    name        TEXT PRIMARY KEY,
+    position    INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS utilization (
+    instance_id TEXT NOT NULL,
+    time        REAL NOT NULL,
+    type        TEXT NOT NULL,
+    cpu         REAL,
+    cpu_max     REAL,
+    mem         REAL,
+    mem_max     REAL,
+    disk_bps    REAL,
+    net_bps     REAL,
+    PRIMARY KEY (instance_id, time)
+);
+CREATE TABLE IF NOT EXISTS instance_types (
+    region      TEXT NOT NULL,
+    type        TEXT NOT NULL,
+    vcpu        INTEGER NOT NULL,
+    memory_mib  INTEGER NOT NULL,
+    network     TEXT,
+    ebs_mbps    INTEGER,
+    arch        TEXT,
+    zones       TEXT,
+    hibernation INTEGER,
+    storage_gib INTEGER,
+    updated     REAL NOT NULL,
+    PRIMARY KEY (region, type)
+);
+CREATE INDEX IF NOT EXISTS instance_types_size ON instance_types (region, vcpu, memory_mib);
+'''
+
+SCHEMA_VERSION = '1'
+
+# small bits of state kept as json in the meta table, with their defaults
+META_KEYS = {
+    'sync': {'time': 0, 'etag': ''},
+    # the regions added on top of the home one, see helpers/regionhelpers.py
+    'regions': {},
+    # images baked from boxes, see runs/bake.py
+    'images': {},
+    # size of the warm pool per 'region/type', see runs/pool.py
+    'pool': {},
+    # EBS volumes made with propad volume, see runs/volume.py
+    'volumes': {},
+    # availability zone of the subnets propad launches into (they never move)
+    'subnet_zones': {},
+}
+
+# dict key -> value of the state column in the instances table
+INSTANCE_SECTIONS = {
+    'running_instances': 'running',
+    'stopped_instances': 'stopped',
+    # the warm pool, see runs/pool.py; named pool-<instance id>
+    'pool_instances': 'pool',
+}
+
+
+class Database(dict):
+    """
+    dict view of the state store which remembers what was loaded so that
+    only the changes are written back
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Database, self).__init__(*args, **kwargs)
+        self.snapshot = None
+
+
+def store_path(dbpath):
+    """
+    older environments point to the pickle (database.p); the sqlite
+    store sits next to it
+    """
+    root, ext = os.path.splitext(dbpath)
+    if ext == '.p':
+        return root + '.sqlite'
+    return dbpath
+
+
+def _json_default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    raise TypeError('can not store {0} in the database'.format(type(obj)))
+
+
+def _encode(info):
+    return json.dumps(info, sort_keys=True, default=_json_default)
+
+
+def _connect(dbpath):
+    path = store_path(dbpath)
+    is_new = not os.path.isfile(path)
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if is_new:
+        print('initiating the database')
+    conn.executescript(SCHEMA)
+    _migrate_instance_types(conn)
+    version = conn.execute(
+        "SELECT value FROM meta WHERE key='schema_version'").fetchone()
+    if version is None:
+        with _begin(conn):
+            # another process may have been faster
+            version = conn.execute(
+                "SELECT value FROM meta WHERE key='schema_version'").fetchone()
+            if version is None:
+                _migrate_pickle(conn, dbpath)
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)",
+                             (SCHEMA_VERSION,))
+    return conn
+
+
+def _migrate_instance_types(conn):
+    # the catalog is only a cache of AWS; one cached before it had all the
+    # columns is dropped and fetched again
+    columns = set(x[1] for x in conn.execute('PRAGMA table_info(instance_types)'))
+    if not set(TYPE_FIELDS) <= columns:
+        conn.execute('DROP TABLE IF EXISTS instance_types')
+        conn.executescript(SCHEMA)
+
+
+@contextmanager
+def _begin(conn):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield conn
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+@contextmanager
+def transaction(dbpath):
+    """
+    a write transaction on the store; it holds the write lock so
+    concurrent propad commands wait for each other
+    """
+    conn = _connect(dbpath)
+    try:
+        with _begin(conn):
+            yield conn
+    finally:
+        conn.close()
+
+
+def _rows(database):
+    rows = {'instances': {}, 'vpcs': {}, 'names': []}
+    for key, state in INSTANCE_SECTIONS.items():
+        for name, info in database.get(key, {}).items():
+            rows['instances'][name] = (info['id'], state, _encode(info))
+    for key, val in database.items():
+        if isinstance(val, dict) and 'vpc_id' in val:
+            rows['vpcs'][key] = (val['vpc_id'], val['sg_id'], val['subnet_id'])
+    rows['names'] = list(database.get('available_names', []))
+    rows['created_instances'] = database.get('created_instances', 0)
+    rows['meta'] = dict((key, _encode(database.get(key, default)))
+                        for key, default in META_KEYS.items())
+    return rows
+
+
+def _empty_rows():
+    return {'instances': {}, 'vpcs': {}, 'names': [], 'created_instances': 0,
+            'meta': {}}
+
+
+def _write_rows(conn, new, old):
+    for name in set(old['instances']) - set(new['instances']):
+        conn.execute('DELETE FROM instances WHERE name=?', (name,))
+    for name, row in new['instances'].items():
+        if old['instances'].get(name) != row:
+            conn.execute('INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)',
+                         (name,) + row)
+    for name in set(old['vpcs']) - set(new['vpcs']):
+        conn.execute('DELETE FROM vpcs WHERE name=?', (name,))
+    for name, row in new['vpcs'].items():
+        if old['vpcs'].get(name) != row:
+            conn.execute('INSERT OR REPLACE INTO vpcs VALUES (?, ?, ?, ?)',
+                         (name,) + row)
+    for name in set(old['names']) - set(new['names']):
+        conn.execute('DELETE FROM available_names WHERE name=?', (name,))
+    for name in new['names']:
+        if name not in old['names']:
+            conn.execute('''INSERT OR IGNORE INTO available_names
+                            SELECT ?, COALESCE(MAX(position), 0) + 1
+                            FROM available_names''', (name,))
+    for key, value in new['meta'].items():
+        if old['meta'].get(key) != value:
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+    if new['created_instances'] != old['created_instances']:
+        # never go backwards if another command has created boxes meanwhile
+        conn.execute('''INSERT OR REPLACE INTO meta
+                        SELECT 'created_instances',
+                               MAX(?, COALESCE((SELECT CAST(value AS INTEGER) FROM meta
+                                                WHERE key='created_instances'), 0))''',
+                     (new['created_instances'],))
+
+
+def _migrate_pickle(conn, dbpath):
+    picklepath = os.path.splitext(store_path(dbpath))[0] + '.p'
+    if not os.path.isfile(picklepath):
+        return
+    print ('migrating {0} into the new database'.format(picklepath))
+    with open(picklepath, 'rb') as f:
+        database = pickle.load(f)
+    _write_rows(conn, _rows(database), _empty_rows())
+    os.rename(picklepath, picklepath + '.migrated')
+
+
+def _read(conn):
+    database = Database()
+    row = conn.execute(
+        "SELECT value FROM meta WHERE key='created_instances'").fetchone()
+    database['created_instances'] = int(row[0]) if row else 0
+    database['available_names'] = deque(
+        x[0] for x in conn.execute('SELECT name FROM available_names ORDER BY position'))
+    for key in INSTANCE_SECTIONS:
+        database[key] = {}
+    sections = dict((y, x) for x, y in INSTANCE_SECTIONS.items())
+    for name, state, info in conn.execute('SELECT name, state, info FROM instances'):
+        database[sections[state]][name] = json.loads(info)
+    for key, default in META_KEYS.items():
+        row = conn.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+        database[key] = json.loads(row[0]) if row else deepcopy(default)
+    for name, vpc_id, sg_id, subnet_id in conn.execute('SELECT * FROM vpcs'):
+        database[name] = {'vpc_id': vpc_id, 'sg_id': sg_id, 'subnet_id': subnet_id}
+    database.snapshot = _rows(database)
     return database
 
+
+def initiate_db(dbpath):
+    return load_database(dbpath)
+
+
 def load_database(dbpath):
-    if os.path.isfile(dbpath):
-        return pickle.load(open(dbpath, 'rb'))
-    else: # used for initializing the database
-        return initiate_db(dbpath)
+    with span('load state'):
+        return _load_database(dbpath)
+
+
+def _load_database(dbpath):
+    conn = _connect(dbpath)
+    try:
+        # a read transaction gives a consistent view of all the tables
+        conn.execute('BEGIN')
+        database = _read(conn)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+    return database
+
 
 def save_database(database, dbpath):
-    pickle.dump( database, open( dbpath, 'wb' ), protocol=2 )
+    """
+    writes the changes made to database since it was loaded (or last
+    saved) in a single transaction. Does nothing when nothing changed
+    """
+    old = getattr(database, 'snapshot', None)
+    new = _rows(database)
+    if old == new:
+        return
+    with span('save state'), transaction(dbpath) as conn:
+        if old is None:
+            # a plain dict; replace whatever is stored
+            old = _read(conn).snapshot
+        _write_rows(conn, new, old)
+    if isinstance(database, Database):
+        database.snapshot = new
+
+
+def claim_pool_instance(database, dbpath, boxname, match):
+    """
+    atomically takes the first pool instance whose info match(info) likes
+    out of the pool and files it as the stopped box boxname. Returns its
+    info or None when there is none
+    """
+    with transaction(dbpath) as conn:
+        rows = conn.execute("SELECT name, info FROM instances WHERE state='pool' ORDER BY name").fetchall()
+        for poolname, info in rows:
+            info = json.loads(info)
+            if match(info):
+                break
+        else:
+            return None
+        info.pop('pool_state', None)
+        conn.execute("UPDATE instances SET name=?, state='stopped', info=? WHERE name=?",
+                     (boxname, _encode(info), poolname))
+
+    # keep the in memory copy, and what it thinks is stored, in line
+    database['pool_instances'].pop(poolname, None)
+    database['stopped_instances'][boxname] = info
+    snapshot = getattr(database, 'snapshot', None)
+    if snapshot is not None:
+        snapshot['instances'].pop(poolname, None)
+        snapshot['instances'][boxname] = (info['id'], 'stopped', _encode(info))
+    return info
+
+
+def remove_pool_instances(database, dbpath, names):
+    """
+    atomically takes the pool instances names out of the pool; the ones a
+    create claimed in the meantime are left alone. Returns the infos of
+    the ones removed
+    """
+    if not names:
+        return []
+    marks = ', '.join('?' * len(names))
+    with transaction(dbpath) as conn:
+        rows = conn.execute("SELECT name, info FROM instances WHERE state='pool' "
+                            "AND name IN ({0})".format(marks), list(names)).fetchall()
+        conn.execute("DELETE FROM instances WHERE state='pool' AND name IN ({0})".format(marks),
+                     list(names))
+
+    # none of them is in the pool any more, removed or claimed
+    snapshot = getattr(database, 'snapshot', None)
+    for poolname in names:
+        database['pool_instances'].pop(poolname, None)
+        if snapshot is not None:
+            snapshot['instances'].pop(poolname, None)
+    return [json.loads(info) for poolname, info in rows]
+
+
+def reserve_box_name(database, dbpath):
+    """
+    atomically takes a name from the pool of available names or makes a new
+    one, so two commands running at the same time never get the same name
+    """
+    boxi = None
+    with transaction(dbpath) as conn:
+        row = conn.execute(
+            'SELECT name FROM available_names ORDER BY position LIMIT 1').fetchone()
+        if row is not None:
+            boxn = row[0]
+            if conn.execute('SELECT 1 FROM instances WHERE name=?', (boxn,)).fetchone():
+                raise Exception('Was not able to find a proper name. Please report the bug')
+            conn.execute('DELETE FROM available_names WHERE name=?', (boxn,))
+        else:
+            row = conn.execute(
+                "SELECT value FROM meta WHERE key='created_instances'").fetchone()
+            boxi = (int(row[0]) if row else 0) + 1
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('created_instances', ?)",
+                         (str(boxi),))
+            boxn = 'box{0}'.format(boxi)
+
+    # keep the in memory copy, and what it thinks is stored, in line
+    snapshot = getattr(database, 'snapshot', None)
+    if boxn in database['available_names']:
+        database['available_names'].remove(boxn)
+    if snapshot is not None and boxn in snapshot['names']:
+        snapshot['names'].remove(boxn)
+    if boxi is not None:
+        database['created_instances'] = boxi
+        if snapshot is not None:
+            snapshot['created_instances'] = boxi
+    return boxn
+
+
+UTILIZATION_FIELDS = ('time', 'cpu', 'cpu_max', 'mem', 'mem_max', 'disk_bps', 'net_bps')
+
+
+def save_utilization(dbpath, instance_id, boxtype, records):
+    """
+    records are tuples in the order of UTILIZATION_FIELDS
+    """
+    if not records:
+        return
+    with transaction(dbpath) as conn:
+        conn.executemany('INSERT OR REPLACE INTO utilization VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(instance_id, x[0], boxtype) + tuple(x[1:]) for x in records])
+
+
+def last_utilization_time(dbpath, instance_id):
+    conn = _connect(dbpath)
+    try:
+        row = conn.execute('SELECT MAX(time) FROM utilization WHERE instance_id=?',
+                           (instance_id,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] or 0
+
+
+def load_utilization(dbpath, instance_id, boxtype, since=0):
+    """
+    the history of the instance while it had the type boxtype, oldest first
+    """
+    conn = _connect(dbpath)
+    try:
+        rows = conn.execute('SELECT {0} FROM utilization '
+                            'WHERE instance_id=? AND type=? AND time>? '
+                            'ORDER BY time'.format(', '.join(UTILIZATION_FIELDS)),
+                            (instance_id, boxtype, since)).fetchall()
+    finally:
+        conn.close()
+    return [dict(zip(UTILIZATION_FIELDS, x)) for x in rows]
+
+
+def forget_utilization(dbpath, instance_ids):
+    """
+    drops the history of the instances which are gone
+    """
+    with transaction(dbpath) as conn:
+        conn.executemany('DELETE FROM utilization WHERE instance_id=?',
+                         [(x,) for x in instance_ids])
+
+
+TYPE_FIELDS = ('type', 'vcpu', 'memory_mib', 'network', 'ebs_mbps', 'arch', 'zones',
+               'hibernation', 'storage_gib')
+
+
+def save_instance_types(dbpath, region, types, zones):
+    """
+    replaces the cached catalog of the region; types as returned by
+    AWSec2Funcs.all_instance_types_info and zones by instance_type_zones
+    """
+    now = time.time()
+    with transaction(dbpath) as conn:
+        conn.execute('DELETE FROM instance_types WHERE region=?', (region,))
+        conn.executemany(
+            'INSERT INTO instance_types (region, {0}, updated) VALUES (?, {1}, ?)'.format(
+                ', '.join(TYPE_FIELDS), ', '.join('?' * len(TYPE_FIELDS))),
+            [(region, name, x['vcpu'], x['memory_mib'], x['network'], x['ebs_mbps'],
+              x['arch'], ','.join(sorted(zones.get(name, []))), int(x['hibernation']),
+              x['storage_gib'], now)
+             for name, x in types.items()])
+
+
+def instance_types_updated(dbpath, region):
+    """
+    when the catalog of the region was cached; 0 if it never was
+    """
+    conn = _connect(dbpath)
+    try:
+        row = conn.execute('SELECT MIN(updated) FROM instance_types WHERE region=?',
+                           (region,)).fetchone()
+    finally:
+        conn.close()
+    return row[0] or 0
+
+
+def load_instance_types(dbpath, region, min_vcpu=0, min_memory_mib=0, arch=None, pattern='*',
+                        name=None):
+    """
+    the cached types of the region with at least min_vcpu and
+    min_memory_mib, smallest first. pattern is a glob on the type name,
+    name the exact type
+    """
+    query = ('SELECT {0} FROM instance_types '
+             'WHERE region=? AND vcpu>=? AND memory_mib>=? AND type GLOB ?'.format(
+                 ', '.join(TYPE_FIELDS)))
+    params = [region, min_vcpu, min_memory_mib, pattern]
+    if name is not None:
+        query += ' AND type=?'
+        params.append(name)
+    if arch:
+        query += " AND (',' || arch || ',') LIKE ?"
+        params.append('%,{0},%'.format(arch))
+    query += ' ORDER BY vcpu, memory_mib, type'
+    conn = _connect(dbpath)
+    try:
+        rows = conn.execute(query, params).fetchall()
+    finally:
+        conn.close()
+    types = []
+    for row in rows:
+        x = dict(zip(TYPE_FIELDS, row))
+        x['zones'] = x['zones'].split(',') if x['zones'] else []
+        x['hibernation'] = bool(x['hibernation'])
+        types.append(x)
+    return types
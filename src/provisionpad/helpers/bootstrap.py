@@ -0,0 +1,235 @@
+import os
+import sys
+import gzip
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from provisionpad.aws.aws_waiter import wait_for
+
+# The box sets itself up on the first boot through cloud-init (EC2 user
+# data): it installs psutil, drops the idle clock script, its policy and
+# its cron entry and finally writes done (or failed) and the instance id
+# into the status file which propad polls over ssh. Boxes made from a baked
+# image (propad bake) already have all of that and only get their policy;
+# the instance id tells their status apart from the one baked in.
+# Hibernating boxes also get boto3 so the agent can hibernate them.
+# The script is gzipped (cloud-init unpacks it): with the agent inlined it
+# comes close to the 16 KB EC2 takes as user data.
+#
+# Both also drop a cloud-init per-boot script which stripes the instance
+# store NVMe devices (c5d, m5d, i3 ...) if there are several and mounts
+# them at /scratch. The instance store is empty after every stop, so it
+# runs again on every boot; on types without one it does nothing. A resume
+# from hibernation is not a boot, so those types can not hibernate (see
+# helpers/hibernatehelpers.py).
+
+REMOTE_USER = 'ubuntu'
+REMOTE_DIR = '/home/{0}/.provisionpad'.format(REMOTE_USER)
+STATUS_FILE = REMOTE_DIR + '/bootstrap.status'
+# bytes of user data EC2 takes (before the base64 encoding)
+USER_DATA_LIMIT = 16384
+SCRATCH_DIR = '/scratch'
+SCRATCH_SCRIPT = '/var/lib/cloud/scripts/per-boot/propad-scratch.sh'
+
+USER_DATA_HEADER = '''#!/bin/bash
+# written by propad; runs once on the first boot
+PPAD_USER={user}
+PPAD_DIR={remote_dir}
+PPAD_STATUS={status_file}
+PPAD_ID=$(cat /var/lib/cloud/data/instance-id 2>/dev/null || cloud-init query instance_id 2>/dev/null || true)
+set -e
+trap 'echo "failed $PPAD_ID" > $PPAD_STATUS; chown $PPAD_USER: $PPAD_STATUS' ERR
+'''
+
+USER_DATA = USER_DATA_HEADER + '''
+mkdir -p $PPAD_DIR/data
+cat > $PPAD_DIR/tclock.py <<'PROPAD_EOF'
+{tclock}
+PROPAD_EOF
+cat > $PPAD_DIR/policy.json <<'PROPAD_EOF'
+{policy}
+PROPAD_EOF
+
+PY=$(command -v python3 || command -v python)
+$PY -c 'import psutil' 2>/dev/null || $PY -m pip install psutil || \\
+    (apt-get update && apt-get install -y python3-psutil)
+{install}
+{scratch}
+echo "* * * * * $PY $PPAD_DIR/tclock.py" > $PPAD_DIR/cron
+crontab -u $PPAD_USER $PPAD_DIR/cron
+chown -R $PPAD_USER: $PPAD_DIR
+echo "done $PPAD_ID" > $PPAD_STATUS
+'''
+
+BAKED_USER_DATA = USER_DATA_HEADER + '''
+cat > $PPAD_DIR/policy.json <<'PROPAD_EOF'
+{policy}
+PROPAD_EOF
+{install}
+{scratch}
+# the samples and the history of the box the image was baked from
+rm -f $PPAD_DIR/data/*.ring
+chown -R $PPAD_USER: $PPAD_DIR
+echo "done $PPAD_ID" > $PPAD_STATUS
+'''
+
+SCRATCH_BOOT = '''#!/bin/bash
+# written by propad; runs on every boot
+SCRATCH={scratch_dir}
+CACHES={caches}
+PROFILE=/etc/profile.d/propad-scratch.sh
+DEVICES=$(lsblk -d -n -p -o NAME,MODEL | awk '/Instance Storage/ {{print $1}}')
+if [ -z "$DEVICES" ]; then rm -f $PROFILE; exit 0; fi
+set -e
+if ! mountpoint -q $SCRATCH; then
+    set -- $DEVICES
+    TARGET=$1
+    if [ $# -gt 1 ]; then
+        command -v mdadm >/dev/null || (apt-get update && apt-get install -y mdadm)
+        held=$(ls /sys/block/$(basename $1)/holders 2>/dev/null | head -1)
+        if [ -n "$held" ]; then
+            TARGET=/dev/$held
+        else
+            TARGET=/dev/md/propad-scratch
+            mdadm --assemble $TARGET "$@" 2>/dev/null || \\
+                mdadm --create $TARGET --run --level=0 --chunk=256 --raid-devices=$# "$@"
+        fi
+    fi
+    # a reboot keeps the file system, a stop does not
+    blkid $TARGET >/dev/null || mkfs.ext4 -q -F -m 0 -E nodiscard $TARGET
+    mkdir -p $SCRATCH
+    mount -o noatime $TARGET $SCRATCH
+    chown {user}: $SCRATCH
+fi
+if [ $CACHES = 1 ]; then
+    mkdir -p $SCRATCH/tmp $SCRATCH/cache
+    chmod 1777 $SCRATCH/tmp
+    chown {user}: $SCRATCH/cache
+    cat > $PROFILE <<EOF
+export TMPDIR=$SCRATCH/tmp
+export XDG_CACHE_HOME=$SCRATCH/cache
+export PIP_CACHE_DIR=$SCRATCH/cache/pip
+export HF_HOME=$SCRATCH/cache/huggingface
+EOF
+else
+    rm -f $PROFILE
+fi
+'''
+
+SCRATCH_SETUP = '''mkdir -p $(dirname {script})
+cat > {script} <<'PROPAD_EOF'
+{body}
+PROPAD_EOF
+chmod +x {script}
+{script} || echo "could not set up {scratch_dir}" >&2
+'''
+
+HIBERNATE_INSTALL = '''PY=$(command -v python3 || command -v python)
+$PY -c 'import boto3' 2>/dev/null || $PY -m pip install boto3 || \\
+    (apt-get update && apt-get install -y python3-boto3)
+'''
+
+
+def agent_script():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(dir_path, '..', 'runs', 'scripts', 'tclock.py')) as f:
+        return f.read().strip()
+
+
+def scratch_setup(caches=False):
+    body = SCRATCH_BOOT.format(scratch_dir=SCRATCH_DIR, caches=int(caches),
+                               user=REMOTE_USER).strip()
+    return SCRATCH_SETUP.format(script=SCRATCH_SCRIPT, body=body, scratch_dir=SCRATCH_DIR)
+
+
+def build_user_data(policy, baked=False, scratch_caches=False):
+    """
+    the gzipped user data. policy overrides the defaults of the idle agent
+    (see DEFAULT_POLICY in scripts/tclock.py). baked is for images made
+    with propad bake. scratch_caches points tmp and the caches at the
+    instance store
+    """
+    install = HIBERNATE_INSTALL if policy.get('hibernate') else ''
+    scratch = scratch_setup(scratch_caches)
+    policy = json.dumps(policy, indent=4, sort_keys=True)
+    if baked:
+        script = BAKED_USER_DATA.format(user=REMOTE_USER, remote_dir=REMOTE_DIR,
+                                        status_file=STATUS_FILE, policy=policy,
+                                        install=install, scratch=scratch)
+    else:
+        script = USER_DATA.format(user=REMOTE_USER, remote_dir=REMOTE_DIR,
+                                  status_file=STATUS_FILE, tclock=agent_script(),
+                                  policy=policy, install=install, scratch=scratch)
+    user_data = gzip.compress(script.encode('UTF-8'))
+    if len(user_data) > USER_DATA_LIMIT:
+        raise Exception('the bootstrap script is {0} bytes gzipped, more than the {1} EC2 '
+                        'takes as user data'.format(len(user_data), USER_DATA_LIMIT))
+    return user_data
+
+
+def ssh_command(target):
+    """
+    target is a host of the ssh config (the box name) or a list of ssh
+    arguments for the boxes which are not in there (the warm pool)
+    """
+    if not isinstance(target, list):
+        target = [target]
+    return ['ssh', '-o', 'BatchMode=yes', '-o', 'ConnectTimeout=5'] + target
+
+
+def direct_ssh_target(info, key_pair_path):
+    return ['-i', key_pair_path, '-o', 'StrictHostKeyChecking=no',
+            '{0}@{1}'.format(REMOTE_USER, info['public_ip'])]
+
+
+def bootstrap_state(boxname, instance_id=None):
+    """
+    done, failed or pending (which includes sshd not being up yet). With
+    an instance_id a status written on another instance is still pending.
+    boxname is anything ssh_command takes
+    """
+    cmd = ssh_command(boxname) + ['cat', STATUS_FILE]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    status = out.decode('UTF-8').split()
+    if proc.returncode != 0 or not status or status[0] not in ('done', 'failed'):
+        return 'pending'
+    if instance_id is not None and status[1:] != [instance_id]:
+        return 'pending'
+    return status[0]
+
+
+def wait_for_bootstrap(boxnames, timeout=900, callback=None, instance_ids=None,
+                       targets=None):
+    """
+    waits for all the boxes; each round probes the boxes in parallel.
+    instance_ids maps the box names to their instance ids and targets to
+    how to reach them (see ssh_command) if not by their name
+    """
+    instance_ids = instance_ids or {}
+    targets = targets or {}
+
+    def probe(name):
+        return bootstrap_state(targets.get(name, name), instance_ids.get(name))
+
+    def states(names):
+        with ThreadPoolExecutor(max_workers=min(len(names), 32)) as pool:
+            return dict(zip(names, pool.map(probe, names)))
+    wait_for(boxnames, states, 'done', timeout=timeout, delay=2,
+             callback=callback, failed_states=('failed',))
+
+
+def push_policy(boxname, policy, timeout=180):
+    """
+    replaces the idle policy of a box which is already set up; retries
+    until sshd is up
+    """
+    text = json.dumps(policy, indent=4, sort_keys=True)
+
+    def push(names):
+        cmd = ssh_command(names[0]) + ['cat > {0}/policy.json'.format(REMOTE_DIR)]
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        proc.communicate(text.encode('UTF-8'))
+        return {names[0]: 'done' if proc.returncode == 0 else 'pending'}
+    wait_for([boxname], push, 'done', timeout=timeout, delay=2)
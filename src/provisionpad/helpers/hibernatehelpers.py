@@ -0,0 +1,68 @@
+import sys
+from provisionpad.aws.aws_iam import AWSiamFuncs
+
+# propad create --hibernate launches boxes which keep their memory over a
+# stop: EC2 writes the RAM to the root volume and reads it back on start.
+# That needs hibernation configured at launch and an encrypted root volume
+# big enough for the image plus all of the memory. The idle agent on such
+# a box hibernates it (StopInstances Hibernate=True with the instance role)
+# instead of powering it off, so the role gets a policy which lets a box
+# stop itself, added the first time a hibernating box is created.
+#
+# Types with instance store are refused: the store is wiped by the
+# hibernation but a resume is not a boot, so the resumed kernel would
+# still have /scratch (see helpers/bootstrap.py) mounted on blank devices.
+
+# the most memory EC2 hibernates (Linux)
+MAX_MEMORY_MIB = 150 * 1024
+HIBERNATE_POLICY_NAME = 'propad-hibernate'
+HIBERNATE_POLICY = {
+    'Version': '2012-10-17',
+    'Statement': [{'Effect': 'Allow',
+                   'Action': 'ec2:StopInstances',
+                   'Resource': 'arn:aws:ec2:*:*:instance/*',
+                   # only the box making the call
+                   'Condition': {'ArnEquals': {'aws:ARN': '${ec2:SourceInstanceARN}'}}}],
+}
+
+
+def root_volume_size(image_gib, memory_mib):
+    """
+    GiB of a root volume with room for the image and the memory (plus one
+    GiB of slack for the swap header and the like)
+    """
+    return image_gib + -(-memory_mib // 1024) + 1
+
+
+def check_hibernation(boxtype, type_info):
+    """
+    exits if boxtype can not hibernate, has too much memory to or has
+    instance store
+    """
+    if not type_info['hibernation']:
+        print ('{0} does not support hibernation'.format(boxtype))
+        sys.exit(1)
+    if type_info['storage_gib']:
+        print ('{0} has instance store which a hibernation wipes; pick a type '
+               'without one (c5 instead of c5d)'.format(boxtype))
+        sys.exit(1)
+    if type_info['memory_mib'] > MAX_MEMORY_MIB:
+        print ('{0} has more memory than EC2 can hibernate ({1} GiB)'.format(
+            boxtype, MAX_MEMORY_MIB // 1024))
+        sys.exit(1)
+
+
+def hibernate_params(awsf, ami, type_info):
+    """
+    the launch params of hibernating boxes
+    """
+    device, image_gib = awsf.image_root(ami)
+    return {'hibernate': True,
+            'root_volume': {'device': device,
+                            'size': root_volume_size(image_gib, type_info['memory_mib'])}}
+
+
+def allow_self_hibernate(env_vars):
+    awsiamf = AWSiamFuncs(env_vars['aws_region'], env_vars['access_key'],
+                          env_vars['secret_key'])
+    awsiamf.put_role_policy(env_vars['role_name'], HIBERNATE_POLICY_NAME, HIBERNATE_POLICY)
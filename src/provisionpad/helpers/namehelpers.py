@@ -1,6 +1,7 @@
 import os
 import sys
-from provisionpad.db.database import save_database
+import fnmatch
+from provisionpad.db.database import reserve_box_name
 
 
 def vpc_name():
@@ -9,18 +10,26 @@ def vpc_name():
 
 def get_box_name(DB, dbpath):
     """
-    gets redis variables names and returns the best name for the
+    reserves a name in the state store and returns the best name for the
     newly created instance
     """
-    if len(DB['available_names']) > 0:
-        dname = DB['available_names'].popleft()
-        if dname in DB['running_instances'] or\
-                dname in DB['stopped_instances'] :
-            raise Exception('Was not able to find a proper name. Please report the bug')
-        boxn = dname
-    else:
-        boxi = DB['created_instances'] + 1
-        boxn = 'box{0}'.format(boxi)
-        DB['created_instances'] += 1
-        save_database(DB, dbpath)
-    return boxn
\ No newline at end of file
+    return reserve_box_name(DB, dbpath)
+
+
+def match_box_names(patterns, boxnames, select_all=False):
+    """
+    returns the box names matching any of the names or glob patterns
+    (box*, gpu-?) and the patterns that did not match anything
+    """
+    if select_all:
+        return sorted(boxnames), []
+    matched = []
+    unmatched = []
+    for pattern in patterns:
+        found = fnmatch.filter(sorted(boxnames), pattern)
+        if not found:
+            unmatched.append(pattern)
+        for x in found:
+            if x not in matched:
+                matched.append(x)
+    return matched, unmatched
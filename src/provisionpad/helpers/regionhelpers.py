@@ -0,0 +1,66 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# propad works in the region picked at initiate (the home region) and in
+# the ones added later with propad region add. Those live in the state
+# store under 'regions' as {region: {'vpc_name', 'key_pair_name',
+# 'key_pair_path', 'aws_ami'}}; every instance info carries its region
+# (the older ones without it are in the home region).
+#
+# Whatever needs a region gets region_env(env_vars, DB, region): the env
+# vars with these four (and aws_region) swapped for the region's own, so
+# the rest of the code does not need to know about regions at all.
+
+REGION_KEYS = ('vpc_name', 'key_pair_name', 'key_pair_path', 'aws_ami')
+
+
+def home_region(env_vars):
+    return env_vars['aws_region']
+
+
+def all_regions(env_vars, DB):
+    """
+    the home region first, then the added ones
+    """
+    home = home_region(env_vars)
+    return [home] + sorted(x for x in DB.get('regions', {}) if x != home)
+
+
+def region_env(env_vars, DB, region):
+    if region == home_region(env_vars):
+        return env_vars
+    if region not in DB.get('regions', {}):
+        print ('propad is not set up in {0}; run propad region add {0}'.format(region))
+        sys.exit(1)
+    region_vars = dict(env_vars)
+    region_vars.update(DB['regions'][region])
+    region_vars['aws_region'] = region
+    return region_vars
+
+
+def instance_region(info, env_vars):
+    return info.get('region', home_region(env_vars))
+
+
+def group_by_region(boxnames, section, env_vars, DB):
+    """
+    {region: [boxname, ...]} for the boxes in DB[section]
+    """
+    groups = {}
+    for boxname in boxnames:
+        region = instance_region(DB[section][boxname], env_vars)
+        groups.setdefault(region, []).append(boxname)
+    return groups
+
+
+def for_each_region(regions, func):
+    """
+    calls func(region) for all the regions at the same time and returns
+    {region: result}; a single region runs in this thread
+    """
+    regions = list(regions)
+    if len(regions) == 1:
+        return {regions[0]: func(regions[0])}
+    with ThreadPoolExecutor(max_workers=len(regions)) as pool:
+        return dict(zip(regions, pool.map(func, regions)))
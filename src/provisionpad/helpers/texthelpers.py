@@ -1,6 +1,17 @@
 import re
 import os
 import sys
+import tempfile
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import region_env, instance_region
+
+SSH_HOST_TEMPLATE = '''Host {0}
+    HostName {1}
+    User ubuntu
+    IdentityFile {2}
+    ForwardAgent yes
+    StrictHostKeyChecking no
+'''
 
 def create_dir_for_file(filepath):
     thedir = os.path.dirname(os.path.realpath(filepath))
@@ -8,51 +19,73 @@ def create_dir_for_file(filepath):
         os.makedirs(thedir)
         print('dir did not exist created one')
 
-def write_into_text(marker, text, filetowrite):
+def write_if_changed(text, filetowrite, mode=None):
+    """
+    atomically replaces filetowrite with text (temp file + rename) unless
+    it already has exactly that content. Returns True if it wrote the file
+    """
     create_dir_for_file(filetowrite)
-    pattern = '### PROVISIONPAD {0}\n.*?\n### PROVISIONPAD'.format(marker)
-    if not os.path.isfile(filetowrite):
-        with open(filetowrite, 'w+') as f:
-            f.write(
-            '### PROVISIONPAD {0}\n{1}\n### PROVISIONPAD\n'.format(
-                marker, text.strip())
-            )
-    else:
+    if os.path.isfile(filetowrite):
         with open(filetowrite, 'r') as f:
-            textfile = f.read()
-        with open(filetowrite, 'a+') as f:
-            f.write(
-            '\n### PROVISIONPAD {0}\n{1}\n### PROVISIONPAD\n'.format(
-                marker, text.strip())
-            )            
+            if f.read() == text:
+                return False
+    thedir = os.path.dirname(os.path.realpath(filetowrite))
+    fd, tmp_path = tempfile.mkstemp(dir=thedir, prefix='.propad')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        if mode is not None:
+            os.chmod(tmp_path, mode)
+        elif os.path.isfile(filetowrite):
+            os.chmod(tmp_path, os.stat(filetowrite).st_mode & 0o777)
+        os.replace(tmp_path, filetowrite)
+    except:
+        os.remove(tmp_path)
+        raise
+    return True
 
-def delete_text_from_file(marker, filetodelete):
-    create_dir_for_file(filetodelete)
-    pattern = '### PROVISIONPAD {0}\n.*?\n### PROVISIONPAD'.format(marker)
-    if not os.path.isfile(filetodelete):
-        print ('the file does not exists. Will ignore it for now') 
-    else:
-        with open(filetodelete, 'r') as f:
-            textfile = f.read()
-            modified_text = re.sub(pattern, '', textfile, flags=re.DOTALL)
-        with open(filetodelete, 'w') as f:
-            f.write(modified_text)
+def ssh_config_path(env_vars):
+    return os.path.join(env_vars['env_dir'], 'ssh_config')
 
-def clean_propad_from_file(filetodelete):
-    create_dir_for_file(filetodelete)
-    pattern = '### PROVISIONPAD.*?\n### PROVISIONPAD'
-    if not os.path.isfile(filetodelete):
-        pass
-    else:
-        with open(filetodelete, 'r') as f:
+def include_ssh_config(include_path, ssh_config):
+    """
+    makes sure the user's ssh config pulls in the propad owned file. The
+    Include has to come before any Host entry so it goes to the top. Blocks
+    written by the older propad versions are removed at the same time
+    """
+    include_path = os.path.realpath(include_path)
+    if ' ' in include_path:
+        include_path = '"{0}"'.format(include_path)
+    include_line = 'Include {0}'.format(include_path)
+    textfile = ''
+    if os.path.isfile(ssh_config):
+        with open(ssh_config, 'r') as f:
             textfile = f.read()
-            modified_text = re.sub(pattern, '', textfile, flags=re.DOTALL)
-            texttowrite = ''
-            for line in modified_text.split('\n'):
-                if line != '':
-                    texttowrite += line+'\n'
+    lines = textfile.split('\n')
+    if include_line in lines and '### PROVISIONPAD' not in textfile:
+        return False
+    pattern = '### PROVISIONPAD.*?\n### PROVISIONPAD\n?'
+    textfile = re.sub(pattern, '', textfile, flags=re.DOTALL)
+    lines = [x for x in textfile.split('\n') if x != include_line]
+    texttowrite = include_line + '\n' + '\n'.join(lines).lstrip('\n')
+    return write_if_changed(texttowrite, ssh_config)
 
-        with open(filetodelete, 'w') as f:
-            f.write(texttowrite)
-                 
+def render_ssh_config(DB, env_vars):
+    """
+    writes the Host entries of all the running boxes to the propad owned
+    ssh config in a single pass. The file is only touched when something
+    changed
+    """
+    with span('ssh config'):
+        return _render_ssh_config(DB, env_vars)
 
+def _render_ssh_config(DB, env_vars):
+    blocks = ['# Generated by propad; changes will be overwritten\n']
+    for ins in sorted(DB['running_instances']):
+        info = DB['running_instances'][ins]
+        # every region has its own key pair
+        key_pair_path = region_env(env_vars, DB, instance_region(info, env_vars))['key_pair_path']
+        blocks.append(SSH_HOST_TEMPLATE.format(ins, info['public_ip'], key_pair_path))
+    include_ssh_config(ssh_config_path(env_vars),
+                       os.path.join(env_vars['HOME'], '.ssh/config'))
+    return write_if_changed('\n'.join(blocks), ssh_config_path(env_vars), mode=0o600)
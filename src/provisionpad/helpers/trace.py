@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import json
+import threading
+import subprocess
+from contextlib import contextmanager
+
+# propad --profile[=FILE] <command> (or PROPAD_TRACE=1|FILE) records where a
+# command spends its time: spans around the steps of the runs, every AWS
+# API call (through botocore event hooks on the shared sessions) and every
+# subprocess (ssh). Without a file a breakdown table goes to stderr; with
+# one a Chrome trace (chrome://tracing, ui.perfetto.dev) is written to it.
+# When tracing is off span() costs next to nothing.
+
+_tracer = None
+_hooks_registered = False
+
+
+class Tracer(object):
+
+    def __init__(self, output=''):
+        self.output = output
+        self.start = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, name, cat, start, end, args=None):
+        event = {'name': name, 'cat': cat, 'start': start, 'end': end,
+                 'tid': threading.current_thread().ident, 'args': args or {}}
+        with self.lock:
+            self.events.append(event)
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        return {'traceEvents': [
+            {'name': x['name'], 'cat': x['cat'], 'ph': 'X', 'pid': pid, 'tid': x['tid'],
+             'ts': (x['start'] - self.start) * 1e6, 'dur': (x['end'] - x['start']) * 1e6,
+             'args': x['args']} for x in self.events]}
+
+    def table(self):
+        totals = {}
+        for x in self.events:
+            key = (x['cat'], x['name'])
+            calls, total, most = totals.get(key, (0, 0, 0))
+            dur = x['end'] - x['start']
+            totals[key] = (calls + 1, total + dur, max(most, dur))
+        lines = ['{:<8} {:<40} {:>6} {:>10} {:>10} {:>10}'.format(
+            'kind', 'span', 'calls', 'total ms', 'mean ms', 'max ms')]
+        for (cat, name), (calls, total, most) in sorted(
+                totals.items(), key=lambda x: (x[0][0], -x[1][1])):
+            lines.append('{:<8} {:<40} {:>6} {:>10.1f} {:>10.1f} {:>10.1f}'.format(
+                cat, name[:40], calls, total * 1000, total * 1000 / calls, most * 1000))
+        api_calls = len([x for x in self.events if x['cat'] == 'aws'])
+        lines.append('{0} AWS API calls; {1:.1f} ms wall time'.format(
+            api_calls, (time.time() - self.start) * 1000))
+        return '\n'.join(lines)
+
+
+def profile_option(argv):
+    """
+    takes --profile[=FILE] out of argv. Returns the argv left and where the
+    trace goes: None (no tracing), '' (a table on stderr) or a json file
+    """
+    output = os.environ.get('PROPAD_TRACE') or None
+    if output in ('1', 'table'):
+        output = ''
+    rest = []
+    for x in argv:
+        if x == '--profile':
+            output = output or ''
+        elif x.startswith('--profile='):
+            output = x.split('=', 1)[1]
+        else:
+            rest.append(x)
+    return rest, output
+
+
+def enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, cat='propad', **args):
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        tracer.add(name, cat, start, time.time(), args)
+
+
+def _before_call(context=None, **kwargs):
+    if _tracer is not None and context is not None:
+        context['propad_trace_start'] = time.time()
+
+
+def _after_call(model=None, context=None, **kwargs):
+    tracer = _tracer
+    if tracer is None or context is None or 'propad_trace_start' not in context:
+        return
+    start = context.pop('propad_trace_start')
+    args = {}
+    if 'exception' in kwargs:
+        args['error'] = str(kwargs['exception'])
+    tracer.add('{0}.{1}'.format(model.service_model.service_name, model.name),
+               'aws', start, time.time(), args)
+
+
+class TracedPopen(subprocess.Popen):
+
+    def __init__(self, args, *more, **kwargs):
+        self._trace_start = time.time()
+        self._trace_args = args
+        super(TracedPopen, self).__init__(args, *more, **kwargs)
+
+    def wait(self, *args, **kwargs):
+        code = super(TracedPopen, self).wait(*args, **kwargs)
+        tracer = _tracer
+        if tracer is not None and self._trace_start is not None:
+            cmd = self._trace_args
+            if isinstance(cmd, str):
+                cmd = cmd.split()
+            tracer.add(os.path.basename(cmd[0]), 'process', self._trace_start,
+                       time.time(), {'cmd': ' '.join(cmd), 'exit': code})
+            self._trace_start = None
+        return code
+
+
+_popen = subprocess.Popen
+
+
+def start(output=''):
+    global _tracer, _hooks_registered
+    _tracer = Tracer(output)
+    if not _hooks_registered:
+        from provisionpad.aws.aws_session import register_handler
+        register_handler('before-call', _before_call)
+        register_handler('after-call', _after_call)
+        register_handler('after-call-error', _after_call)
+        _hooks_registered = True
+    subprocess.Popen = TracedPopen
+
+
+def finish():
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    subprocess.Popen = _popen
+    if tracer is None:
+        return
+    if tracer.output:
+        with open(tracer.output, 'w') as f:
+            json.dump(tracer.chrome_trace(), f)
+        sys.stderr.write('trace written to {0}\n'.format(tracer.output))
+    else:
+        sys.stderr.write(tracer.table() + '\n')
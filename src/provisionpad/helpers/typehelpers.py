@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import difflib
+from concurrent.futures import ThreadPoolExecutor
+from provisionpad.aws.aws_ec2 import AWSec2Funcs
+from provisionpad.db.database import save_database, save_instance_types, \
+    instance_types_updated, load_instance_types
+from provisionpad.helpers.regionhelpers import region_env
+from provisionpad.helpers.trace import span
+
+# A copy of describe_instance_types and the type offerings of each region
+# is kept in the state store (instance_types table) so that checking a type
+# or looking for one does not need AWS. It is fetched the first time a
+# region is needed and again once it is older than CATALOG_TTL.
+
+CATALOG_TTL = 7 * 24 * 3600
+
+# Gbit/s of the network performance classes which are not given as a
+# number (the older types); the rest read like 'Up to 10 Gigabit'
+NETWORK_CLASSES = {'Very Low': 0.05, 'Low': 0.1, 'Low to Moderate': 0.3,
+                   'Moderate': 0.5, 'High': 1.0}
+
+
+def cache_instance_types(env_vars, region, refresh=False):
+    """
+    makes sure the catalog of the region is in the state store
+    """
+    dbpath = env_vars['db_path']
+    if not refresh and time.time() - instance_types_updated(dbpath, region) < CATALOG_TTL:
+        return
+    print ('caching the instance types of {0}'.format(region))
+    awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+    with span('cache instance types'), ThreadPoolExecutor(max_workers=2) as pool:
+        types = pool.submit(awsf.all_instance_types_info)
+        zones = pool.submit(awsf.instance_type_zones)
+        save_instance_types(dbpath, region, types.result(), zones.result())
+
+
+def network_bps(performance):
+    """
+    bytes per second of a network performance class of the catalog (the
+    burst of the 'Up to' ones); 0 if it can not be told
+    """
+    if performance in NETWORK_CLASSES:
+        return NETWORK_CLASSES[performance] * 1e9 / 8
+    words = performance.split()
+    if 'Gigabit' not in words:
+        return 0
+    try:
+        gbit = float(words[words.index('Gigabit') - 1])
+        if words[0].endswith('x'):
+            # e.g. 8x 100 Gigabit
+            gbit *= int(words[0][:-1])
+    except ValueError:
+        return 0
+    return gbit * 1e9 / 8
+
+
+def find_instance_types(env_vars, region, **kwargs):
+    """
+    load_instance_types on the (cached) catalog of the region
+    """
+    cache_instance_types(env_vars, region)
+    return load_instance_types(env_vars['db_path'], region, **kwargs)
+
+
+def subnet_zone(env_vars, DB, region):
+    """
+    the availability zone propad launches into in the region; looked up once
+    """
+    subnet_id = DB[region_env(env_vars, DB, region)['vpc_name']]['subnet_id']
+    if subnet_id not in DB['subnet_zones']:
+        awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+        DB['subnet_zones'][subnet_id] = awsf.subnet_zone(subnet_id)
+        save_database(DB, env_vars['db_path'])
+    return DB['subnet_zones'][subnet_id]
+
+
+def check_instance_type(env_vars, DB, region, boxtype):
+    """
+    exits with a hint when boxtype can not be launched in the subnet propad
+    uses in the region
+    """
+    found = find_instance_types(env_vars, region, name=boxtype)
+    if not found:
+        names = [x['type'] for x in load_instance_types(env_vars['db_path'], region)]
+        close = difflib.get_close_matches(boxtype, names, n=3)
+        print ('{0} is not an instance type in {1}'.format(boxtype, region))
+        if close:
+            print ('did you mean: {0}'.format(', '.join(close)))
+        print ('propad types lists the ones available')
+        sys.exit(1)
+    zone = subnet_zone(env_vars, DB, region)
+    if zone not in found[0]['zones']:
+        print ('{0} is not offered in {1}, the availability zone of the propad subnet'.format(
+            boxtype, zone))
+        if found[0]['zones']:
+            print ('it is in: {0}'.format(', '.join(found[0]['zones'])))
+        sys.exit(1)
+    return found[0]
@@ -1,26 +1,92 @@
 import os
 import sys
+import time
+import json
+import hashlib
 from provisionpad.db.database import load_database, save_database
 from provisionpad.aws.aws_ec2 import AWSec2Funcs
-from provisionpad.helpers.texthelpers import delete_text_from_file, write_into_text
-from provisionpad.helpers.texthelpers import clean_propad_from_file
+from provisionpad.helpers.texthelpers import render_ssh_config
 from copy import deepcopy
 from provisionpad.helpers.namehelpers import get_box_name
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import all_regions, for_each_region
 
 # 0 : pending # 16 : running # 32 : shutting-down
 # 48 : terminated  # 64 : stopping # 80 : stopped
 
-def update_status(env_vars, DB):
+DEFAULT_SYNC_TTL = 30
+
+def sync_ttl(env_vars):
+    """
+    seconds a sync with AWS is trusted for; PROPAD_SYNC_TTL or sync_ttl in
+    the env variables overrides the default
+    """
+    ttl = os.environ.get('PROPAD_SYNC_TTL', env_vars.get('sync_ttl', DEFAULT_SYNC_TTL))
+    return float(ttl)
+
+def fingerprint(aws_inst_info):
+    """
+    etag like hash of what AWS says about our instances
+    """
+    thestate = sorted((x, y[0], y[1]) for x, y in aws_inst_info.items())
+    return hashlib.sha1(json.dumps(thestate).encode('UTF-8')).hexdigest()
+
+def mark_synced(DB, etag=''):
+    """
+    propad changed the state itself so the DB is as good as freshly synced.
+    Without an etag the next sync past the ttl reconciles in full
+    """
+    DB['sync'] = {'time': time.time(), 'etag': etag}
+
+def update_status(env_vars, DB, force=False):
+
+    if not force and time.time() - DB['sync']['time'] < sync_ttl(env_vars):
+        return
 
-    region = env_vars['aws_region']
-    home_folder = env_vars['HOME']
     access_key = env_vars['access_key']
     secret_key = env_vars['secret_key']
-    awsec2f = AWSec2Funcs(region, access_key, secret_key)
-    aws_inst_info = awsec2f.instance_state(env_vars['your_name'])
-    aws_inst_info_d = deepcopy(aws_inst_info)
 
-    clean_propad_from_file(os.path.join(home_folder,'.ssh/config'))
+    def describe(region):
+        awsec2f = AWSec2Funcs(region, access_key, secret_key)
+        return awsec2f.owned_instances_info(env_vars['your_name'])
+
+    # one describe call per region, all the regions at the same time, gives
+    # both the states and the full info we need for the instances that are
+    # not tracked yet
+    with span('describe instances'):
+        aws_full_info = {}
+        for info in for_each_region(all_regions(env_vars, DB), describe).values():
+            aws_full_info.update(info)
+
+    # the warm pool (runs/pool.py) is not ours to adopt or wait for; its
+    # instances are left alone unless a box was claimed from it already
+    boxes_ids = set(x['id'] for key in ('running_instances', 'stopped_instances')
+                    for x in DB[key].values())
+    pool_ids = set(x['id'] for x in DB['pool_instances'].values())
+    for ins_id, ins_info in list(aws_full_info.items()):
+        if ins_id not in boxes_ids and (ins_id in pool_ids or ins_info.get('pool')):
+            del aws_full_info[ins_id]
+            pool_ids.discard(ins_id)
+    for name, info in list(DB['pool_instances'].items()):
+        if info['id'] in pool_ids:
+            # gone from AWS
+            del DB['pool_instances'][name]
+
+    aws_inst_info = {}
+    for ins_id, ins_info in aws_full_info.items():
+        aws_inst_info[ins_id] = [ins_info.pop('state'), ins_info['public_ip']]
+
+    etag = fingerprint(aws_inst_info)
+    if etag == DB['sync']['etag']:
+        # nothing changed on AWS since the last full reconciliation; the
+        # ssh config is rendered all the same in case it was lost or edited
+        # (an unchanged one is not written)
+        mark_synced(DB, etag)
+        save_database(DB, env_vars['db_path'])
+        render_ssh_config(DB, env_vars)
+        return
+
+    aws_inst_info_d = deepcopy(aws_inst_info)
 
     for ins in aws_inst_info:
         if aws_inst_info[ins][0] == 'terminated':
@@ -33,8 +99,7 @@ def update_status(env_vars, DB):
 
     aws_inst_info = aws_inst_info_d
 
-    DBD = deepcopy(DB)
-    for ins, ins_info in DBD['running_instances'].items():
+    for ins, ins_info in list(DB['running_instances'].items()):
         if ins_info['id'] not in aws_inst_info:
             print ('seems like the instance you have created ')
             print ('has been removed from the aws manually most likely')
@@ -42,30 +107,16 @@ def update_status(env_vars, DB):
             del(DB['running_instances'][ins])
             if ins[0:3] == 'box':
                 DB['available_names'].append(ins)
-            save_database(DB, env_vars['db_path'])
-            delete_text_from_file(ins, os.path.join(home_folder,'.ssh/config'))
         elif ins_info['id'] in aws_inst_info and aws_inst_info[ins_info['id']][0]=='stopped':
             print ('seems like the instance has been stopped')
             print ('removing it from the running instances')
             DB['stopped_instances'][ins] = DB['running_instances'][ins]
             del(DB['running_instances'][ins])
-            save_database(DB, env_vars['db_path'])
-            delete_text_from_file(ins, os.path.join(home_folder,'.ssh/config'))
         else:
-            write_into_text(ins,
-'''
-Host {0}
-    HostName {1}
-    User ubuntu
-    IdentityFile {2}
-    ForwardAgent yes
-    StrictHostKeyChecking no
-'''.format(ins, DB['running_instances'][ins]['public_ip'], env_vars['key_pair_path']),
-os.path.join(home_folder,'.ssh/config'))
+            DB['running_instances'][ins].update(aws_full_info[ins_info['id']])
             print ('{0} is fine as expected'.format(ins))
 
-    DBD = deepcopy(DB)
-    for ins, ins_info in DBD['stopped_instances'].items():
+    for ins, ins_info in list(DB['stopped_instances'].items()):
         if ins_info['id'] not in aws_inst_info:
             print ('seems like the instance you have created ')
             print ('has been removed from the aws manually most likely')
@@ -73,25 +124,12 @@ os.path.join(home_folder,'.ssh/config'))
             del(DB['stopped_instances'][ins])
             if ins[0:3] == 'box':
                 DB['available_names'].append(ins)
-            save_database(DB, env_vars['db_path'])
-            delete_text_from_file(ins, os.path.join(home_folder,'.ssh/config'))
         elif ins_info['id'] in aws_inst_info and aws_inst_info[ins_info['id']][0]=='running':
             print ('seems like the instance has started manually')
             print ('moving from stopped to running')
             DB['running_instances'][ins] = DB['stopped_instances'][ins]
-            DB['running_instances'][ins]['public_ip'] = aws_inst_info[ins_info['id']][1]
+            DB['running_instances'][ins].update(aws_full_info[ins_info['id']])
             del(DB['stopped_instances'][ins])
-            save_database(DB, env_vars['db_path'])
-            write_into_text(ins,
-'''
-Host {0}
-    HostName {1}
-    User ubuntu
-    IdentityFile {2}
-    ForwardAgent yes
-    StrictHostKeyChecking no
-'''.format(ins, DB['running_instances'][ins]['public_ip'], env_vars['key_pair_path']),
-os.path.join(home_folder,'.ssh/config'))
         else:
             print ('{0} is fine as expected'.format(ins))
 
@@ -103,25 +141,15 @@ os.path.join(home_folder,'.ssh/config'))
 
     to_create = set(aws_inst_info) - ids_db
     for x in to_create:
-        ins = get_box_name(DB, env_vars['db_path'])
         thekeyname = 'stopped_instances'
         if aws_inst_info[x][0] == 'running':
             thekeyname = 'running_instances'
         boxname = get_box_name(DB, env_vars['db_path'])
-        DB[thekeyname][boxname] = awsec2f.get_instance_info(x)
-        write_into_text(ins,
-'''
-Host {0}
-    HostName {1}
-    User ubuntu
-    IdentityFile {2}
-    ForwardAgent yes
-    StrictHostKeyChecking no
-'''.format(ins, DB[thekeyname][boxname]['public_ip'], env_vars['key_pair_path']),
-os.path.join(home_folder,'.ssh/config'))
+        DB[thekeyname][boxname] = aws_full_info[x]
 
     if len(ids_db - set(aws_inst_info))>0:
         raise Exception('this should not happen in status')
 
-
-    save_database(DB, env_vars['db_path'])
\ No newline at end of file
+    mark_synced(DB, etag)
+    save_database(DB, env_vars['db_path'])
+    render_ssh_config(DB, env_vars)
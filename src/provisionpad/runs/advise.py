@@ -0,0 +1,147 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from provisionpad.db.database import save_utilization, last_utilization_time, \
+    load_utilization
+from provisionpad.helpers.bootstrap import REMOTE_DIR, ssh_command
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import instance_region
+from provisionpad.helpers.typehelpers import find_instance_types, network_bps
+
+# The idle agent on every box keeps a 5 minute summary of its cpu, memory,
+# disk and network use for about a month (see scripts/tclock.py). advise
+# pulls what is new of it into the state store, so the history outlives
+# the box's own ring, and compares the busy end of it (95th percentile)
+# with what the instance type offers.
+
+# a right sized box runs at most this busy at its 95th percentile
+TARGET_CPU = 0.7
+TARGET_MEM = 0.8
+# of the EBS baseline bandwidth and the network class
+TARGET_IO = 0.7
+PERCENTILE = 0.95
+# hours of history needed before advising anything
+MIN_HOURS = 24
+
+
+def pull_history(boxname, since):
+    """
+    the history records of the box after since or None if the box can not
+    be reached (or runs an agent without a history)
+    """
+    script = '{0}/tclock.py --history {1}'.format(REMOTE_DIR, since)
+    cmd = ssh_command(boxname) + ['python3 {0} 2>/dev/null || python {0}'.format(script)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    try:
+        return json.loads(out.decode('UTF-8'))
+    except ValueError:
+        return None
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def recommend(usage, current, sizes):
+    """
+    the smallest size of the family which keeps the 95th percentile use
+    under the targets; the largest one if none does. Sizes whose EBS
+    bandwidth or network class is not known are not held to them
+    """
+    need_vcpu = usage['cpu'] * current['vcpu'] / TARGET_CPU
+    need_mem = usage['mem'] * current['memory_mib'] / TARGET_MEM
+    need_disk = usage['disk'] / TARGET_IO
+    need_net = usage['net'] / TARGET_IO
+    ordered = sorted(sizes.items(), key=lambda x: (x[1]['vcpu'], x[1]['memory_mib']))
+    for boxtype, info in ordered:
+        if info['vcpu'] < need_vcpu or info['memory_mib'] < need_mem:
+            continue
+        # ebs_mbps is in Mbit/s
+        if info['ebs_mbps'] and info['ebs_mbps'] * 1e6 / 8 < need_disk:
+            continue
+        net = network_bps(info['network'])
+        if net and net < need_net:
+            continue
+        return boxtype
+    return ordered[-1][0]
+
+
+def sync_history(boxnames, env_vars, DB):
+    """
+    pulls the new history of the running boxes in parallel; returns the
+    names of the boxes which could not be reached
+    """
+    dbpath = env_vars['db_path']
+
+    def pull(boxname):
+        info = DB['running_instances'][boxname]
+        records = pull_history(boxname, last_utilization_time(dbpath, info['id']))
+        if records is not None:
+            save_utilization(dbpath, info['id'], info['type'], records)
+        return records is not None
+
+    running = [x for x in boxnames if x in DB['running_instances']]
+    if not running:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(running), 16)) as pool:
+        pulled = list(pool.map(pull, running))
+    return [x for x, ok in zip(running, pulled) if not ok]
+
+
+def advise(boxnames, env_vars, DB, days=14, pull=True):
+
+    boxes = {}
+    for key in ('running_instances', 'stopped_instances'):
+        for boxname in boxnames:
+            if boxname in DB[key]:
+                boxes[boxname] = DB[key][boxname]
+
+    if pull:
+        with span('pull history'):
+            not_reached = sync_history(boxnames, env_vars, DB)
+        for boxname in not_reached:
+            print ('could not get the history of {0}; using what is stored'.format(boxname))
+
+    # the sizes come from the cached catalog; what is on offer differs a
+    # bit from region to region
+    sizes = {}
+    for info in boxes.values():
+        key = (instance_region(info, env_vars), info['type'].split('.')[0])
+        if key not in sizes:
+            types = find_instance_types(env_vars, key[0], pattern=key[1] + '.*')
+            sizes[key] = dict((x['type'], x) for x in types if 'metal' not in x['type'])
+
+    since = time.time() - days * 24 * 3600
+    print ("{:<20} {:<14} {:>7} {:>8} {:>8} {:>9} {:>9}   {:<20}".format(
+        'Name', 'Type', 'Hours', 'CPU p95', 'Mem p95', 'Disk p95', 'Net p95', 'Advice'))
+    for boxname in sorted(boxes):
+        info = boxes[boxname]
+        history = load_utilization(env_vars['db_path'], info['id'], info['type'], since)
+        hours = len(history) * 5 / 60.0
+        if hours < MIN_HOURS:
+            print ("{:<20} {:<14} {:>7.1f} {:>8} {:>8} {:>9} {:>9}   {:<20}".format(
+                boxname, info['type'], hours, '-', '-', '-', '-', 'not enough history yet'))
+            continue
+        usage = {'cpu': percentile([x['cpu'] for x in history], PERCENTILE),
+                 'mem': percentile([x['mem_max'] for x in history], PERCENTILE),
+                 'disk': percentile([x['disk_bps'] for x in history], PERCENTILE),
+                 'net': percentile([x['net_bps'] for x in history], PERCENTILE)}
+        family = sizes[(instance_region(info, env_vars), info['type'].split('.')[0])]
+        if info['type'] not in family:
+            advice = 'unknown type'
+        else:
+            better = recommend(usage, family[info['type']], family)
+            if better == info['type']:
+                advice = 'keep'
+            else:
+                advice = 'change to {0}'.format(better)
+        print ("{:<20} {:<14} {:>7.1f} {:>7.0f}% {:>7.0f}% {:>5.0f}MB/s {:>5.0f}MB/s   {:<20}".format(
+            boxname, info['type'], hours, usage['cpu'] * 100, usage['mem'] * 100,
+            usage['disk'] / 1e6, usage['net'] / 1e6, advice))
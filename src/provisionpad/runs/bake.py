@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import subprocess
+from provisionpad.aws.aws_ec2 import AWSec2Funcs
+from provisionpad.aws.aws_waiter import WaiterError
+from provisionpad.db.database import load_database, save_database
+from provisionpad.helpers.regionhelpers import instance_region
+from provisionpad.helpers.trace import span
+
+# propad bake <box> makes an image (AMI) of a box with everything set up on
+# it. Making one takes minutes, so bake only starts it and leaves the
+# waiting to a background process (python -m provisionpad.runs.bake NAME)
+# which marks the image available (or failed) in the state store:
+#   DB['images'][name] = {'image_id', 'region', 'source', 'type',
+#                         'created', 'state'}
+# propad create --image name then starts boxes from it which only need
+# their idle policy on the first boot.
+
+
+def bake_log_path(env_vars):
+    return os.path.join(env_vars['env_dir'], 'bake.log')
+
+
+def bake(boxname, env_vars, DB, imagename=None, reboot=True, wait=False):
+
+    for key in ('running_instances', 'stopped_instances'):
+        if boxname in DB[key]:
+            info = DB[key][boxname]
+            break
+    else:
+        print ('the box {0} is not available check again:'.format(boxname))
+        sys.exit(1)
+
+    if not imagename:
+        imagename = '{0}-{1}'.format(boxname, time.strftime('%Y%m%d-%H%M%S'))
+    if imagename in DB['images']:
+        print ('there is already an image named {0}'.format(imagename))
+        sys.exit(1)
+
+    region = instance_region(info, env_vars)
+    awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+    with span('create image'):
+        image_id = awsf.create_image(
+            info['id'], 'propad-{0}-{1}'.format(env_vars['your_name'], imagename), reboot=reboot)
+    DB['images'][imagename] = {'image_id': image_id, 'region': region,
+                               'source': boxname, 'type': info['type'],
+                               'created': time.time(), 'state': 'pending'}
+    save_database(DB, env_vars['db_path'])
+    print ('baking {0} from {1} as {2}'.format(imagename, boxname, image_id))
+
+    if wait:
+        wait_image(imagename, env_vars)
+        return
+    with open(bake_log_path(env_vars), 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'provisionpad.runs.bake', imagename],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True, close_fds=True)
+    print ('it is ready in a few minutes; propad bake --list shows when')
+
+
+def wait_image(imagename, env_vars):
+    """
+    waits for the image and records how it ended up
+    """
+    DB = load_database(env_vars['db_path'])
+    image = DB['images'][imagename]
+    awsf = AWSec2Funcs(image['region'], env_vars['access_key'], env_vars['secret_key'])
+    try:
+        with span('wait for image'):
+            awsf.wait_images([image['image_id']])
+        state = 'available'
+    except WaiterError as e:
+        print (e)
+        state = 'failed'
+    # the state may have changed while we were waiting
+    DB = load_database(env_vars['db_path'])
+    if imagename in DB['images']:
+        DB['images'][imagename]['state'] = state
+        save_database(DB, env_vars['db_path'])
+    print ('image {0} is {1}'.format(imagename, state))
+    return state
+
+
+def image_for_create(imagename, region, env_vars, DB):
+    """
+    the image id to create boxes in region from; waits if it is still
+    being baked
+    """
+    if imagename not in DB['images']:
+        print ('there is no image named {0}; see propad bake --list'.format(imagename))
+        sys.exit(1)
+    image = DB['images'][imagename]
+    if image['region'] != region:
+        print ('the image {0} is in {1}'.format(imagename, image['region']))
+        sys.exit(1)
+    if image['state'] == 'failed':
+        print ('baking the image {0} failed'.format(imagename))
+        sys.exit(1)
+    if image['state'] != 'available':
+        print ('waiting for the image {0} to be ready'.format(imagename))
+        if wait_image(imagename, env_vars) != 'available':
+            sys.exit(1)
+    return image['image_id']
+
+
+def list_images(env_vars, DB):
+    print ("{:<28} {:<22} {:<12} {:<14} {:<14} {:<10}".format(
+        'Image', 'Id', 'Region', 'From', 'Type', 'State'))
+    for name in sorted(DB['images']):
+        x = DB['images'][name]
+        print ("{:<28} {:<22} {:<12} {:<14} {:<14} {:<10}".format(
+            name, x['image_id'], x['region'], x['source'], x['type'], x['state']))
+
+
+def delete_image(imagename, env_vars, DB):
+    if imagename not in DB['images']:
+        print ('there is no image named {0}'.format(imagename))
+        sys.exit(1)
+    image = DB['images'][imagename]
+    awsf = AWSec2Funcs(image['region'], env_vars['access_key'], env_vars['secret_key'])
+    awsf.delete_image(image['image_id'])
+    del DB['images'][imagename]
+    save_database(DB, env_vars['db_path'])
+    print ('image {0} deleted'.format(imagename))
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from provisionpad.bin.propad import get_env_vars
+    parser = argparse.ArgumentParser(description='waits for a baked image',
+                                     usage='%(prog)s NAME')
+    parser.add_argument("imagename", help="Name of the image in the state store")
+    args = parser.parse_args()
+    wait_image(args.imagename, get_env_vars())
@@ -1,118 +1,99 @@
 import os
 import sys
-import time
-import subprocess
 from provisionpad.aws.aws_ec2 import AWSec2Funcs
 from provisionpad.db.database import load_database, save_database
 from provisionpad.helpers.namehelpers import vpc_name
-from provisionpad.helpers.texthelpers import write_into_text
+from provisionpad.helpers.texthelpers import render_ssh_config
 from provisionpad.helpers.namehelpers import get_box_name
-from provisionpad.helpers.update_status import update_status
+from provisionpad.helpers.update_status import update_status, mark_synced
+from provisionpad.helpers.bootstrap import build_user_data, wait_for_bootstrap
 from provisionpad.runs.status import show_status
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import region_env, home_region
+from provisionpad.helpers.typehelpers import check_instance_type
+from provisionpad.helpers.hibernatehelpers import check_hibernation, hibernate_params, \
+    allow_self_hibernate
 
 
-def run_command(cmd_list):
-    try:
-        proc = subprocess.call(cmd_list,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return proc.returncode
-    except:
-        proc = subprocess.call(cmd_list,
-                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        return proc
+def create_instance(boxname, boxtype, idle_policy, env_vars, DB, count=1, region=None,
+                    image=None, hibernate=False, scratch_caches=False):
 
-def create_instance(boxname, boxtype, shut_down_time, env_vars, DB):
+    if image and not region and image in DB['images']:
+        region = DB['images'][image]['region']
+    region = region or home_region(env_vars)
+    region_vars = region_env(env_vars, DB, region)
+    # a typo fails here, from the cached catalog, not after RunInstances
+    type_info = check_instance_type(env_vars, DB, region, boxtype)
+    if hibernate:
+        check_hibernation(boxtype, type_info)
 
-    update_status(env_vars,DB)
+    with span('sync state'):
+        update_status(env_vars,DB)
 
-    region = env_vars['aws_region']
-    home_folder = env_vars['HOME']
     access_key = env_vars['access_key']
     secret_key = env_vars['secret_key']
     awsf = AWSec2Funcs(region, access_key, secret_key)
 
-    my_ssh_key_path = env_vars['key_pair_path']
-    ssh_key_name = env_vars['key_pair_name']
+    ssh_key_name = region_vars['key_pair_name']
 
     if not boxname:
-        boxname = get_box_name(DB, env_vars['db_path'])
+        with span('reserve names', count=count):
+            boxnames = [get_box_name(DB, env_vars['db_path']) for x in range(count)]
     else:
-        if boxname[:3] == 'box' or \
-                boxname in DB['running_instances'] or \
-                boxname in DB['stopped_instances']:
-            print ("enter a better name. either exists or starts with box")
-            sys.exit()
+        if count == 1:
+            boxnames = [boxname]
+        else:
+            boxnames = ['{0}{1}'.format(boxname, x+1) for x in range(count)]
+        for boxname in boxnames:
+            if boxname[:3] == 'box' or \
+                    boxname in DB['running_instances'] or \
+                    boxname in DB['stopped_instances']:
+                print ("enter a better name. either exists or starts with box")
+                sys.exit()
+
+    if count == 1 and not image and not hibernate and not scratch_caches:
+        from provisionpad.runs.pool import claim_from_pool
+        if claim_from_pool(boxnames[0], boxtype, region, idle_policy, env_vars, DB):
+            show_status(env_vars, DB)
+            return
 
     params = {}
     params['ssh_key_name'] = ssh_key_name
-    params['aws_ami'] = env_vars['aws_ami']
+    if image:
+        from provisionpad.runs.bake import image_for_create
+        params['aws_ami'] = image_for_create(image, region, env_vars, DB)
+    else:
+        params['aws_ami'] = region_vars['aws_ami']
     params['aws_iam_role'] = env_vars['role_name']
-    params['vpc'] = DB[env_vars['vpc_name'] ]
+    params['vpc'] = DB[region_vars['vpc_name'] ]
     params['box_type'] = boxtype
-    params['name'] = env_vars['your_name']+boxname
+    params['name'] = env_vars['your_name']
+    if hibernate:
+        with span('hibernation'):
+            params.update(hibernate_params(awsf, params['aws_ami'], type_info))
+            allow_self_hibernate(env_vars)
+        idle_policy = dict(idle_policy, hibernate=True, region=region)
+    with span('build user data'):
+        params['user_data'] = build_user_data(idle_policy, baked=bool(image),
+                                              scratch_caches=scratch_caches)
 
 
     print ('Waiting for confirmation from AWS')
 
-    DB['running_instances'][boxname] = awsf.create_ec2_instance(params)
-    write_into_text(boxname,
-'''
-Host {0}
-    HostName {1}
-    User ubuntu
-    IdentityFile {2}
-    ForwardAgent yes
-    StrictHostKeyChecking no
-'''.format(boxname, DB['running_instances'][boxname]['public_ip'], my_ssh_key_path),
-os.path.join(home_folder,'.ssh/config'))
+    with span('launch instances', count=count, type=boxtype):
+        infos = awsf.create_ec2_instances(params, [env_vars['your_name']+x for x in boxnames])
+    for boxname, info in zip(boxnames, infos):
+        DB['running_instances'][boxname] = info
+    render_ssh_config(DB, env_vars)
+    mark_synced(DB)
     save_database(DB, env_vars['db_path'])
 
-    tmp_dir = os.path.join(env_vars['env_dir'], 'tmp')
-    tmp_tclock = os.path.join(tmp_dir,'tclock.py')
-    tmp_cron = os.path.join(tmp_dir,'cron')
-
-    if not os.path.isdir(tmp_dir):
-        os.mkdir(tmp_dir)
-
-
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    tmp_tclock = os.path.join(dir_path,'scripts', 'tclock.py')
-
-
-
-    with open(tmp_cron, 'wb') as f:
-        towrite = '*/{0} * * * * python /home/ubuntu/.provisionpad/tclock.py\n'.format(shut_down_time)
-        f.write(towrite.encode('UTF-8'))
+    def created(boxname, state):
+        print ('ec2 instance {} created successfully'.format(boxname))
 
     print ('Setting up EC2 instance')
-    time.sleep(30)
-
-
+    with span('bootstrap'):
+        wait_for_bootstrap(boxnames, callback=created,
+                           instance_ids=dict((x, y['id']) for x, y in zip(boxnames, infos)))
 
-
-    out = run_command(['ssh', boxname, 'pip', 'install', 'psutil'])
-    if out != 0:
-        raise Exception('Failed to install psutil on server')
-    out = run_command(['ssh', boxname, 'mkdir', '-p', '.provisionpad/data'])
-    if out != 0:
-        raise Exception('Failed to create .provisionpad/data')
-    out = run_command(['ssh', boxname, 'touch', '.provisionpad/data/total_idle.out'])
-    if out != 0:
-        raise Exception('Failed to create .provisionpad/data/total_idle.out')
-    out = run_command(['scp', tmp_cron,
-                       '{0}:~/.provisionpad/'.format(boxname)])
-    if out != 0:
-        raise Exception('Failed to copy the crontab file')
-    out = run_command(['scp', tmp_tclock,
-                       '{0}:~/.provisionpad/'.format(boxname)])
-    if out != 0:
-        raise Exception('Failed to copy the tmp_tclock')
-    out = run_command(['ssh', boxname, 'crontab',
-                               '/home/ubuntu/.provisionpad/cron'])
-    if out != 0:
-        raise Exception('schedule a cron job')
-    os.remove(tmp_cron)
-
-    print ('ec2 instance {} created successfully'.format(boxname))
     show_status(env_vars, DB)
-
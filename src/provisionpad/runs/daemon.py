@@ -0,0 +1,326 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import threading
+import traceback
+import subprocess
+from contextlib import contextmanager
+
+# propad daemon keeps a warm python process around (boto3 imported, clients
+# and their connections in the aws_session cache, the state synced every
+# few seconds) and runs the commands the propad CLI forwards to it over a
+# unix socket. Every request is one json line {"argv": [...], "env": {...}};
+# the answer is a stream of json lines {"out": text} ending with
+# {"exit": code}, or {"busy": true} alone.
+#
+# The commands run one at a time, each with the PROPAD_* environment of
+# the client it came from: they share the boto3 clients, the stdout of the
+# process and os.environ. A command which finds the daemon busy with
+# another one for longer than BUSY_WAIT gets busy back and runs in its
+# own process instead.
+
+# commands which make sense to run in the daemon; initiate asks questions
+FORWARDED = ('create', 'terminate', 'stop', 'start', 'stat', 'advise')
+# the environment variables of the client a command runs with
+ENV_PREFIX = 'PROPAD_'
+
+DEFAULT_REFRESH = 20
+BUSY_WAIT = 5
+
+# held by the command being run and by the refresh
+command_lock = threading.Lock()
+
+
+def env_dir():
+    return os.path.join(os.path.expanduser("~"), '.provisionpad')
+
+
+def socket_path():
+    return os.path.join(env_dir(), 'propad.sock')
+
+
+def pid_path():
+    return os.path.join(env_dir(), 'propad.pid')
+
+
+def log_path():
+    return os.path.join(env_dir(), 'daemon.log')
+
+
+def _connect(timeout=None):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path())
+    except:
+        sock.close()
+        raise
+    return sock
+
+
+def client_env():
+    return dict((x, y) for x, y in os.environ.items() if x.startswith(ENV_PREFIX))
+
+
+def forward(argv):
+    """
+    runs the command in the daemon if one is up and returns its exit code;
+    None means there is no daemon (or it is busy) and the command should
+    run in process
+    """
+    if os.environ.get('PROPAD_NO_DAEMON') or len(argv) < 2 or argv[1] not in FORWARDED:
+        return None
+    # the trace has to be taken in this process
+    if os.environ.get('PROPAD_TRACE') or any(x.startswith('--profile') for x in argv):
+        return None
+    if not os.path.exists(socket_path()):
+        return None
+    try:
+        sock = _connect(timeout=1)
+    except (socket.error, OSError):
+        return None
+    sock.settimeout(None)
+    with sock:
+        sock.sendall((json.dumps({'argv': argv, 'env': client_env()}) + '\n').encode('UTF-8'))
+        for line in sock.makefile('r'):
+            msg = json.loads(line)
+            if msg.get('busy'):
+                return None
+            if 'out' in msg:
+                sys.stdout.write(msg['out'])
+                sys.stdout.flush()
+            elif 'exit' in msg:
+                return msg['exit']
+    print ('lost the connection to propad daemon')
+    return 1
+
+
+class ThreadOutput(object):
+    """
+    stands in for sys.stdout/sys.stderr and sends whatever a thread prints
+    to that thread's client, everything else to the real stream
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        target = getattr(self.local, 'target', None)
+        if target is None:
+            return self.stream.write(text)
+        target(text)
+
+    def flush(self):
+        if getattr(self.local, 'target', None) is None:
+            self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+@contextmanager
+def environment(env):
+    """
+    os.environ with the PROPAD_* variables of env instead of the daemon's
+    """
+    saved = client_env()
+    for x in saved:
+        del os.environ[x]
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        for x in client_env():
+            del os.environ[x]
+        os.environ.update(saved)
+
+
+def run_command(argv, env, write):
+    """
+    runs the command with command_lock held
+    """
+    from provisionpad.bin.propad import PPAD
+    sys.stdout.local.target = write
+    sys.stderr.local.target = write
+    code = 0
+    try:
+        with environment(env):
+            PPAD(argv)
+    except SystemExit as e:
+        if e.code is None:
+            code = 0
+        elif isinstance(e.code, int):
+            code = e.code
+        else:
+            write('{0}\n'.format(e.code))
+            code = 1
+    except Exception:
+        write(traceback.format_exc())
+        code = 1
+    finally:
+        sys.stdout.local.target = None
+        sys.stderr.local.target = None
+    return code
+
+
+def handle(conn):
+    with conn:
+        lines = conn.makefile('r')
+        request = json.loads(lines.readline())
+
+        def write(text):
+            conn.sendall((json.dumps({'out': text}) + '\n').encode('UTF-8'))
+
+        if request.get('ping'):
+            conn.sendall((json.dumps({'exit': 0, 'pid': os.getpid()}) + '\n').encode('UTF-8'))
+            return
+        if not command_lock.acquire(timeout=BUSY_WAIT):
+            conn.sendall((json.dumps({'busy': True}) + '\n').encode('UTF-8'))
+            return
+        try:
+            env = dict((x, y) for x, y in request.get('env', {}).items()
+                       if x.startswith(ENV_PREFIX))
+            code = run_command(request['argv'], env, write)
+        finally:
+            command_lock.release()
+        conn.sendall((json.dumps({'exit': code}) + '\n').encode('UTF-8'))
+
+
+def refresh_loop(refresh):
+    """
+    keeps the state (and the connections) warm so stat can answer from
+    the state store within the sync ttl
+    """
+    from provisionpad.db.database import load_database
+    from provisionpad.helpers.update_status import update_status
+    from provisionpad.bin.propad import get_env_vars
+    while True:
+        # a command syncs anyway; no need to refresh while one runs
+        if command_lock.acquire(blocking=False):
+            try:
+                sys.stdout.local.target = lambda x: None
+                env_vars = get_env_vars()
+                DB = load_database(env_vars['db_path'])
+                update_status(env_vars, DB, force=True)
+            except SystemExit:
+                # some instance is in transition; try again next round
+                pass
+            except Exception:
+                sys.stderr.stream.write(traceback.format_exc())
+            finally:
+                sys.stdout.local.target = None
+                command_lock.release()
+        time.sleep(refresh)
+
+
+def serve(refresh=DEFAULT_REFRESH):
+    # import the heavy bits once, up front
+    import provisionpad.runs.create_instance
+    import provisionpad.runs.terminate_instance
+    import provisionpad.runs.stop_instance
+    import provisionpad.runs.start_instance
+
+    sys.stdout = ThreadOutput(sys.stdout)
+    sys.stderr = ThreadOutput(sys.stderr)
+
+    path = socket_path()
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen(16)
+    with open(pid_path(), 'w') as f:
+        f.write(str(os.getpid()))
+
+    def shutdown(signum, frame):
+        for x in (path, pid_path()):
+            if os.path.exists(x):
+                os.remove(x)
+        os._exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    refresher = threading.Thread(target=refresh_loop, args=(refresh,))
+    refresher.daemon = True
+    refresher.start()
+
+    print ('propad daemon listening on {0}'.format(path))
+    sys.stdout.flush()
+    while True:
+        conn, _ = server.accept()
+        worker = threading.Thread(target=handle, args=(conn,))
+        worker.daemon = True
+        worker.start()
+
+
+def daemon_pid():
+    """
+    pid of the running daemon or None
+    """
+    if not os.path.exists(socket_path()):
+        return None
+    try:
+        sock = _connect(timeout=1)
+    except (socket.error, OSError):
+        return None
+    with sock:
+        sock.sendall((json.dumps({'ping': True}) + '\n').encode('UTF-8'))
+        return json.loads(sock.makefile('r').readline()).get('pid')
+
+
+def start_daemon(refresh=DEFAULT_REFRESH):
+    pid = daemon_pid()
+    if pid:
+        print ('propad daemon is already running (pid {0})'.format(pid))
+        return
+    with open(log_path(), 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'provisionpad.runs.daemon',
+                          '--refresh', str(refresh)],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True, close_fds=True)
+    for x in range(100):
+        pid = daemon_pid()
+        if pid:
+            print ('propad daemon started (pid {0})'.format(pid))
+            return
+        time.sleep(0.1)
+    raise Exception('propad daemon did not come up; see {0}'.format(log_path()))
+
+
+def stop_daemon():
+    pid = daemon_pid()
+    if not pid:
+        print ('propad daemon is not running')
+        return
+    os.kill(pid, signal.SIGTERM)
+    print ('propad daemon stopped')
+
+
+def daemon_status():
+    pid = daemon_pid()
+    if pid:
+        print ('propad daemon is running (pid {0})'.format(pid))
+    else:
+        print ('propad daemon is not running')
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description='propad daemon',
+                                     usage='%(prog)s [OPTIONS]')
+    parser.add_argument("--refresh", dest="refresh", type=float, default=DEFAULT_REFRESH,
+                        help="Seconds between two syncs of the state with AWS")
+    args = parser.parse_args()
+    serve(args.refresh)
@@ -10,6 +10,7 @@ from provisionpad.aws.aws_iam import AWSiamFuncs
 from provisionpad.aws.aws_sts import AWSstsFuncs
 from provisionpad.db.database import load_database, save_database
 from provisionpad.runs.create_vpc import create_vpc
+from provisionpad.helpers.trace import span
 
 def initiate():
 
@@ -17,7 +18,7 @@ def initiate():
     env_dir = os.path.join(home, '.provisionpad')
     if not os.path.isdir(env_dir):
         os.mkdir(env_dir)
-    dbpath = os.path.join(env_dir, 'database.p')
+    dbpath = os.path.join(env_dir, 'database.sqlite')
     DB = load_database(dbpath)
 
     home = os.path.expanduser("~")
@@ -94,18 +95,30 @@ def initiate():
 
     env_vars['HOME'] = home
 
-    create_vpc(env_vars, DB)
+    with span('vpc'):
+        create_vpc(env_vars, DB)
 
     awsec2f = AWSec2Funcs(env_vars['aws_region'], env_vars['access_key'], env_vars['secret_key'])
     awsstsf = AWSstsFuncs(env_vars['aws_region'], env_vars['access_key'], env_vars['secret_key'])
     awsiamf = AWSiamFuncs(env_vars['aws_region'], env_vars['access_key'], env_vars['secret_key'])
 
+    with span('key pair'):
+        setup_key_pair(env_vars, awsec2f)
+
+    with span('iam role'):
+        setup_role(env_vars, awsstsf, awsiamf)
+
+    with open(env_var_path, 'w') as f:
+        json.dump(env_vars, f, indent=4)
+
+
+def setup_key_pair(env_vars, awsec2f):
     if not os.path.isfile(env_vars['key_pair_path']):
         if not awsec2f.check_key_pair(env_vars['key_pair_name']):
             try:
                 print ('creating key pair')
                 with open(env_vars['key_pair_path'], 'w') as f:
-                    key_pair = str(awsec2f.create_key_pair(key_pair_name))
+                    key_pair = str(awsec2f.create_key_pair(env_vars['key_pair_name']))
                     print (key_pair)
                     f.write(key_pair)
                 os.chmod(env_vars['key_pair_path'], 0o600)
@@ -117,6 +130,8 @@ def initiate():
     else:
         print ('the key pair exists')
 
+
+def setup_role(env_vars, awsstsf, awsiamf):
     account_id = awsstsf.get_account_id()
     policy_attach = []
     for policy in env_vars['policy']:
@@ -146,9 +161,5 @@ def initiate():
         raise Exception(' was not able to find the role')
 
 
-    with open(env_var_path, 'w') as f:
-        json.dump(env_vars, f, indent=4)
-
-
 
 
@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import fcntl
+import subprocess
+from provisionpad.aws.aws_ec2 import AWSec2Funcs, POOL_TAG
+from provisionpad.aws.aws_waiter import WaiterFailure, WaiterTimeout
+from provisionpad.db.database import load_database, save_database, claim_pool_instance, \
+    remove_pool_instances
+from provisionpad.helpers.bootstrap import build_user_data, wait_for_bootstrap, \
+    direct_ssh_target, push_policy
+from provisionpad.helpers.regionhelpers import region_env
+from provisionpad.helpers.trace import span
+
+# The warm pool keeps already set up (bootstrapped) instances stopped, per
+# region and instance type, so create only has to start one:
+#   DB['pool'] = {'region/type': size}
+#   DB['pool_instances'] = {'pool-<instance id>': info + pool_state}
+# pool_state is filling while the instance boots and sets itself up and
+# ready once it is stopped again. The instances are tagged propad-pool so
+# update_status leaves them alone. A claimed instance is renamed, loses
+# the tag and becomes an ordinary box; the pool is then refilled in the
+# background (python -m provisionpad.runs.pool).
+
+# what pool boxes are set up with; the default idle policy of create
+POOL_POLICY = {'window': 1200}
+# seconds a fill waits for the new instances to set themselves up
+BOOTSTRAP_TIMEOUT = 900
+
+
+def pool_key(region, boxtype):
+    return '{0}/{1}'.format(region, boxtype)
+
+
+def pool_log_path(env_vars):
+    return os.path.join(env_vars['env_dir'], 'pool.log')
+
+
+def claim_from_pool(boxname, boxtype, region, idle_policy, env_vars, DB):
+    """
+    turns a ready pool instance into the box boxname and starts it; False
+    if the pool has none of the type
+    """
+    if not DB['pool'].get(pool_key(region, boxtype)):
+        return False
+
+    def ready(info):
+        return info.get('pool_state') == 'ready' and info['type'] == boxtype and \
+            info['region'] == region
+    with span('claim from pool'):
+        info = claim_pool_instance(DB, env_vars['db_path'], boxname, ready)
+    if info is None:
+        print ('the warm pool of {0} is empty; creating a new box'.format(boxtype))
+        refill_in_background(env_vars)
+        return False
+
+    print ('Starting a box from the warm pool')
+    awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+    awsf.set_name_tag(info['id'], env_vars['your_name'] + boxname, remove=[POOL_TAG])
+    DB['stopped_instances'][boxname].pop('pool', None)
+    from provisionpad.runs.start_instance import start_instances
+    start_instances([boxname], env_vars, DB)
+    if idle_policy != POOL_POLICY:
+        with span('push policy'):
+            push_policy(boxname, idle_policy)
+    refill_in_background(env_vars)
+    return True
+
+
+def refill_in_background(env_vars):
+    with open(pool_log_path(env_vars), 'a') as log:
+        subprocess.Popen([sys.executable, '-m', 'provisionpad.runs.pool'],
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True, close_fds=True)
+
+
+def fill_pool(env_vars):
+    """
+    launches or terminates pool instances until every region/type has as
+    many as asked for; only one fill runs at a time
+    """
+    lock = open(os.path.join(env_vars['env_dir'], 'pool.lock'), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        print ('the pool is being filled already')
+        return
+    DB = load_database(env_vars['db_path'])
+    # with the lock held anything still filling was left by a fill that died
+    for name, info in list(DB['pool_instances'].items()):
+        if info.get('pool_state') != 'ready':
+            shrink(info['region'], [name], env_vars, DB)
+    for key, size in sorted(DB['pool'].items()):
+        region, boxtype = key.split('/', 1)
+        names = sorted(x for x, y in DB['pool_instances'].items()
+                       if y['region'] == region and y['type'] == boxtype)
+        if len(names) < size:
+            launch(region, boxtype, size - len(names), env_vars, DB)
+        elif len(names) > size:
+            shrink(region, names[:len(names) - size], env_vars, DB)
+    # types dropped from the pool altogether
+    for name, info in list(DB['pool_instances'].items()):
+        if pool_key(info['region'], info['type']) not in DB['pool']:
+            shrink(info['region'], [name], env_vars, DB)
+
+
+def launch(region, boxtype, count, env_vars, DB):
+    region_vars = region_env(env_vars, DB, region)
+    awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+    params = {}
+    params['ssh_key_name'] = region_vars['key_pair_name']
+    params['aws_ami'] = region_vars['aws_ami']
+    params['aws_iam_role'] = env_vars['role_name']
+    params['vpc'] = DB[region_vars['vpc_name']]
+    params['box_type'] = boxtype
+    params['name'] = env_vars['your_name'] + 'pool'
+    params['tags'] = [{'Key': POOL_TAG, 'Value': boxtype}]
+    params['user_data'] = build_user_data(POOL_POLICY)
+
+    print ('adding {0} {1} to the warm pool in {2}'.format(count, boxtype, region))
+    infos = awsf.create_ec2_instances(params, [params['name']] * count)
+    names = {}
+    for info in infos:
+        info['pool_state'] = 'filling'
+        names['pool-' + info['id']] = info
+        DB['pool_instances']['pool-' + info['id']] = info
+    save_database(DB, env_vars['db_path'])
+
+    instance_ids = dict((x, y['id']) for x, y in names.items())
+    targets = dict((x, direct_ssh_target(y, region_vars['key_pair_path']))
+                   for x, y in names.items())
+    pending = sorted(names)
+    failed = []
+    # one deadline for all of them, however often a failure restarts the wait
+    deadline = time.time() + BOOTSTRAP_TIMEOUT
+    while pending:
+        try:
+            wait_for_bootstrap(pending, timeout=max(0, deadline - time.time()),
+                               instance_ids=instance_ids, targets=targets)
+            break
+        except WaiterFailure as e:
+            # keep waiting for the others
+            print (e)
+            failed.extend(e.states)
+            pending = [x for x in pending if x not in e.states]
+        except WaiterTimeout as e:
+            print (e)
+            failed.extend(e.ids)
+            break
+    if failed:
+        shrink(region, failed, env_vars, DB)
+    ready = [x for x in names if x not in failed]
+    if not ready:
+        return
+    awsf.stop_ec2_instances([names[x]['id'] for x in ready], wait=True)
+    for x in ready:
+        DB['pool_instances'][x]['pool_state'] = 'ready'
+    save_database(DB, env_vars['db_path'])
+    print ('{0} {1} ready in the warm pool'.format(len(ready), boxtype))
+
+
+def shrink(region, names, env_vars, DB):
+    # a create may claim some of them at any time, so only what is still in
+    # the pool when they are taken out is terminated
+    removed = remove_pool_instances(DB, env_vars['db_path'], names)
+    if not removed:
+        return
+    awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+    awsf.terminate_ec2_instances([x['id'] for x in removed])
+
+
+def set_pool_size(boxtype, size, region, env_vars, DB):
+    region_env(env_vars, DB, region)
+    key = pool_key(region, boxtype)
+    if size:
+        DB['pool'][key] = size
+    else:
+        DB['pool'].pop(key, None)
+    save_database(DB, env_vars['db_path'])
+    refill_in_background(env_vars)
+    print ('the warm pool of {0} in {1} is being resized to {2}'.format(boxtype, region, size))
+
+
+def list_pool(env_vars, DB):
+    print ("{:<16} {:<16} {:>6} {:>6} {:>8}".format('Region', 'Type', 'Size', 'Ready', 'Filling'))
+    for key, size in sorted(DB['pool'].items()):
+        region, boxtype = key.split('/', 1)
+        states = [y.get('pool_state') for y in DB['pool_instances'].values()
+                  if y['region'] == region and y['type'] == boxtype]
+        print ("{:<16} {:<16} {:>6} {:>6} {:>8}".format(
+            region, boxtype, size, states.count('ready'), states.count('filling')))
+
+
+if __name__ == "__main__":
+
+    from provisionpad.bin.propad import get_env_vars
+    fill_pool(get_env_vars())
@@ -0,0 +1,63 @@
+import os
+import sys
+from provisionpad.aws.aws_ec2 import AWSec2Funcs
+from provisionpad.db.database import save_database
+from provisionpad.runs.create_vpc import create_vpc
+from provisionpad.runs.initiate import setup_key_pair
+from provisionpad.helpers.regionhelpers import REGION_KEYS, home_region, \
+    all_regions, region_env, instance_region
+from provisionpad.helpers.trace import span
+
+# the image propad uses by default (Ubuntu 18.04), looked up per region
+UBUNTU_OWNER = '099720109477'
+UBUNTU_IMAGE = 'ubuntu/images/hvm-ssd/ubuntu-bionic-18.04-amd64-server-*'
+
+
+def add_region(region, env_vars, DB, ami=None):
+    """
+    sets propad up in one more region: its own VPC and key pair (the IAM
+    role is global) and the image new boxes start from
+    """
+    if region in all_regions(env_vars, DB):
+        print ('propad is already set up in {0}'.format(region))
+        return
+
+    region_vars = dict(env_vars)
+    region_vars['aws_region'] = region
+    region_vars['vpc_name'] = '{0}_VPC_{1}'.format(env_vars['your_name'], region)
+    region_vars['key_pair_name'] = 'ec2_keypair_{0}_{1}.pem'.format(env_vars['your_name'], region)
+    region_vars['key_pair_path'] = os.path.join(env_vars['env_dir'], region_vars['key_pair_name'])
+
+    awsec2f = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+    if not ami:
+        ami = awsec2f.latest_image(UBUNTU_OWNER, UBUNTU_IMAGE)
+        if not ami:
+            print ('could not find the default image in {0}; use --ami'.format(region))
+            sys.exit(1)
+    region_vars['aws_ami'] = ami
+
+    with span('vpc'):
+        create_vpc(region_vars, DB)
+    with span('key pair'):
+        setup_key_pair(region_vars, awsec2f)
+
+    DB['regions'][region] = dict((x, region_vars[x]) for x in REGION_KEYS)
+    save_database(DB, env_vars['db_path'])
+    print ('propad is set up in {0}; use propad create --region {0}'.format(region))
+
+
+def list_regions(env_vars, DB):
+    home = home_region(env_vars)
+    counts = {}
+    for key in ('running_instances', 'stopped_instances'):
+        for info in DB[key].values():
+            region = instance_region(info, env_vars)
+            counts.setdefault(region, {'running_instances': 0, 'stopped_instances': 0})
+            counts[region][key] += 1
+    print ("{:<16} {:<24} {:<24} {:>8} {:>8}".format('Region', 'VPC', 'Image', 'Running', 'Stopped'))
+    for region in all_regions(env_vars, DB):
+        region_vars = region_env(env_vars, DB, region)
+        count = counts.get(region, {'running_instances': 0, 'stopped_instances': 0})
+        print ("{:<16} {:<24} {:<24} {:>8} {:>8}".format(
+            region + (' *' if region == home else ''), DB.get(region_vars['vpc_name'], {}).get('vpc_id', '-'),
+            region_vars['aws_ami'], count['running_instances'], count['stopped_instances']))
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import threading
+
+# Pre-warms EBS volumes made from snapshots. Their blocks come from S3 on
+# the first touch, which makes the first read of every block slow, so this
+# reads every block of the volumes once, with many reads in flight per
+# volume, before the real work does. propad volume (runs/volume.py) copies
+# it to the box and starts it in the background as root:
+#   prewarm.py PROGRESS_FILE VOLUME_ID:DEVICE [VOLUME_ID:DEVICE ...]
+# It writes its progress as json to PROGRESS_FILE every few seconds:
+#   {'started', 'updated', 'done', 'error', 'volumes': {id: [read, size]}}
+# Only one runs per progress file and a finished one is not run again.
+
+CHUNK = 16 * 1024 * 1024  # what a worker takes at a time
+BLOCK = 1024 * 1024       # size of a read
+WORKERS = 32              # reads in flight per volume
+REPORT_INTERVAL = 2
+
+
+def find_device(volume_id, alt):
+    # nitro boxes show EBS volumes as nvme devices with the volume id as
+    # the serial; the others under the device name they were attached as
+    paths = ['/dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_' + volume_id.replace('-', ''), alt]
+    for i in range(60):
+        for x in paths:
+            if os.path.exists(x):
+                return os.path.realpath(x)
+        time.sleep(2)
+    raise Exception('{0} did not show up'.format(volume_id))
+
+
+class Volume(object):
+
+    def __init__(self, volume_id, path):
+        self.volume_id = volume_id
+        self.path = path
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.size = os.lseek(fd, 0, os.SEEK_END)
+        finally:
+            os.close(fd)
+        self.read = 0
+        self.next = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            start = self.next
+            self.next += CHUNK
+        return start
+
+    def worker(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            while self.error is None:
+                start = self.take()
+                if start >= self.size:
+                    return
+                end = min(start + CHUNK, self.size)
+                for offset in range(start, end, BLOCK):
+                    os.pread(fd, min(BLOCK, end - offset), offset)
+                # the point is to touch the blocks, not to fill the page cache
+                os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_DONTNEED)
+                with self.lock:
+                    self.read += end - start
+        except Exception as e:
+            self.error = '{0}: {1}'.format(self.volume_id, e)
+        finally:
+            os.close(fd)
+
+
+def write_progress(path, progress):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(progress, f)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def main(progress_path, pairs):
+    lock = open(progress_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        # already running
+        return
+    if os.path.isfile(progress_path):
+        with open(progress_path) as f:
+            if json.load(f).get('done'):
+                return
+
+    progress = {'started': time.time(), 'updated': time.time(), 'done': False,
+                'error': None, 'volumes': {}}
+    try:
+        volumes = []
+        for pair in pairs:
+            volume_id, alt = pair.split(':', 1)
+            volumes.append(Volume(volume_id, find_device(volume_id, alt)))
+    except Exception as e:
+        progress['error'] = str(e)
+        write_progress(progress_path, progress)
+        sys.exit(1)
+
+    threads = [threading.Thread(target=x.worker) for x in volumes for i in range(WORKERS)]
+    for x in threads:
+        x.daemon = True
+        x.start()
+    while True:
+        running = any(x.is_alive() for x in threads)
+        progress['updated'] = time.time()
+        progress['volumes'] = dict((x.volume_id, [x.read, x.size]) for x in volumes)
+        progress['error'] = next((x.error for x in volumes if x.error), None)
+        progress['done'] = not running and progress['error'] is None
+        write_progress(progress_path, progress)
+        if not running:
+            break
+        time.sleep(REPORT_INTERVAL)
+    if progress['error']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2:])
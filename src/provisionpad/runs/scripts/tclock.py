@@ -1,27 +1,322 @@
 import psutil
 import time
 import os
+import sys
+import json
+import mmap
+import fcntl
+import struct
+import resource
 from os.path import expanduser
 home = expanduser("~")
-total_idlef = os.path.join(home, '.provisionpad/data/total_idle.out')
-delta_idlef = os.path.join(home, '.provisionpad/data/delta_idle.out')
-idle_time = psutil.cpu_times().idle
-the_time  = time.time()
-with open(total_idlef, 'r') as f:
-    data = f.read().strip().split()
-str = '%f %f' % (idle_time, the_time)
-if len(data) != 2:
-    with open(total_idlef, 'w') as f:
-        f.write(str)
-    with open(delta_idlef, 'w') as f:
-        f.write('0\n')
-else:
-    idle_diff = (idle_time-float(data[0]))/(the_time-float(data[1]))
-    with open(total_idlef, 'w') as f:
-        f.write(str)
-    with open(delta_idlef, 'a+') as f:
-        f.write("%f\n" % idle_diff )  
-    with open(delta_idlef, 'r') as f:
-        data = f.read().splitlines()
-        if float(data[-1])>0.97 and abs(float(data[-1])-float(data[-2]))<0.002:
-            os.system('sudo poweroff')
+data_dir = os.path.join(home, '.provisionpad/data')
+ring_path = os.path.join(data_dir, 'idle.ring')
+history_path = os.path.join(data_dir, 'history.ring')
+lock_path = os.path.join(data_dir, 'agent.lock')
+policy_path = os.path.join(home, '.provisionpad/policy.json')
+
+# The idle agent. cron starts it every minute; it takes a sample every
+# sample_interval seconds for that minute and powers the box off (or
+# hibernates it, see power_off) once everything it looks at (cpu, disk and
+# network throughput, load average and optionally ssh sessions) has been
+# quiet for the whole window.
+#
+# The samples live in a fixed size binary ring buffer which is memory
+# mapped, so every tick costs the same no matter how long the box has
+# been up. Header: magic, version, capacity, next slot, number of samples
+# and the raw counters of the previous sample; every record is
+# (timestamp, cpu idle fraction, disk bytes/s, net bytes/s, ssh sessions,
+# load average per cpu, memory used fraction).
+#
+# Every history_interval seconds the samples are also summed up into a
+# second, much longer ring (about a month) which propad pulls down with
+#   tclock.py --history SINCE
+# to size the box (propad advise).
+
+DEFAULT_POLICY = {
+    'window': 1200,          # seconds the box has to be idle
+    'sample_interval': 15,   # seconds between two samples
+    'min_idle_fraction': 0.95,  # of the samples in the window
+    'cpu_idle': 0.97,        # idle fraction of all the cpus
+    'disk_bps': 1000000,     # read + write bytes per second
+    'net_bps': 100000,       # sent + received bytes per second (no loopback)
+    'load': 0.5,             # 1 minute load average per cpu
+    'ssh_sessions': None,    # most ssh sessions an idle box may have; None ignores them
+    'max_cpu': 0.01,         # cpu budget of the agent itself (fraction of a core)
+    'max_rss_mb': 64,        # memory budget of the agent itself
+    'hibernate': False,      # hibernate instead of powering off (create --hibernate)
+    'region': None,          # of the box; for the hibernate call
+}
+
+MAGIC = b'PPRB'
+VERSION = 3
+HEADER = struct.Struct('<4sIIII5d')
+RECORD = struct.Struct('<d6f')
+CAPACITY = 8192
+# (timestamp, mean and max cpu used, mean and max memory used, mean disk
+# bytes/s, mean net bytes/s) every history_interval seconds
+HISTORY_RECORD = struct.Struct('<d6f')
+HISTORY_CAPACITY = 8192
+HISTORY_INTERVAL = 300
+SSH_PORT = 22
+# samples further apart than this mean the box was not up in between (a
+# hibernated box resumes with its old boot time)
+RESUME_GAP = 180
+
+
+class RingBuffer(object):
+
+    def __init__(self, path, capacity=CAPACITY, record=RECORD):
+        self.record = record
+        size = HEADER.size + capacity * record.size
+        new = not os.path.isfile(path) or os.path.getsize(path) != size
+        self.f = open(path, 'w+b' if new else 'r+b')
+        if new:
+            self.f.truncate(size)
+        self.mm = mmap.mmap(self.f.fileno(), size)
+        header = HEADER.unpack_from(self.mm, 0)
+        if new or header[0] != MAGIC or header[1] != VERSION:
+            header = (MAGIC, VERSION, capacity, 0, 0, 0.0, 0.0, 0.0, 0.0, 0.0)
+            HEADER.pack_into(self.mm, 0, *header)
+        self.capacity, self.head, self.count = header[2:5]
+        self.last = list(header[5:])
+
+    def _write_header(self):
+        HEADER.pack_into(self.mm, 0, MAGIC, VERSION, self.capacity, self.head,
+                         self.count, *self.last)
+
+    def set_last(self, counters):
+        self.last = list(counters)
+        self._write_header()
+
+    def append(self, record):
+        self.record.pack_into(self.mm, HEADER.size + self.head * self.record.size, *record)
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._write_header()
+
+    def _get(self, i):
+        slot = (self.head - i) % self.capacity
+        return self.record.unpack_from(self.mm, HEADER.size + slot * self.record.size)
+
+    def latest(self, n):
+        """
+        the last n (at most) samples, oldest first
+        """
+        return [self._get(i) for i in range(min(n, self.count), 0, -1)]
+
+    def window(self, since):
+        """
+        the samples taken after since, oldest first
+        """
+        out = []
+        for i in range(1, self.count + 1):
+            sample = self._get(i)
+            if sample[0] < since:
+                break
+            out.append(sample)
+        return out[::-1]
+
+    def close(self):
+        self.mm.flush()
+        self.mm.close()
+        self.f.close()
+
+
+def load_policy():
+    policy = dict(DEFAULT_POLICY)
+    if os.path.isfile(policy_path):
+        with open(policy_path) as f:
+            policy.update(json.load(f))
+    return policy
+
+
+def counters():
+    """
+    (time, cpu idle seconds, cpu total seconds, disk bytes, net bytes)
+    """
+    cpu = psutil.cpu_times()
+    disk = psutil.disk_io_counters()
+    disk_bytes = disk.read_bytes + disk.write_bytes if disk else 0
+    net_bytes = 0
+    for nic, x in psutil.net_io_counters(pernic=True).items():
+        if nic != 'lo':
+            net_bytes += x.bytes_sent + x.bytes_recv
+    # guest time is already part of user time on linux
+    total = sum(cpu) - getattr(cpu, 'guest', 0) - getattr(cpu, 'guest_nice', 0)
+    return (time.time(), cpu.idle, total, float(disk_bytes), float(net_bytes))
+
+
+def ssh_sessions():
+    try:
+        return len([x for x in psutil.net_connections(kind='tcp')
+                    if x.status == psutil.CONN_ESTABLISHED and x.laddr and
+                    x.laddr[1] == SSH_PORT])
+    except psutil.AccessDenied:
+        return len(psutil.users())
+
+
+def sample(ring, boot_time):
+    now = counters()
+    last = ring.last
+    ring.set_last(now)
+    # after a reboot the counters start over
+    if last[0] < boot_time or now[0] <= last[0] or now[2] <= last[2] or \
+            now[3] < last[3] or now[4] < last[4]:
+        return None
+    dt = now[0] - last[0]
+    record = (now[0],
+              (now[1] - last[1]) / (now[2] - last[2]),
+              (now[3] - last[3]) / dt,
+              (now[4] - last[4]) / dt,
+              ssh_sessions(),
+              os.getloadavg()[0] / psutil.cpu_count(),
+              memory_used())
+    ring.append(record)
+    return record
+
+
+def memory_used():
+    mem = psutil.virtual_memory()
+    return float(mem.total - mem.available) / mem.total
+
+
+def summarize(ring, history):
+    """
+    adds a history record for every full history interval since the last one
+    """
+    # history.last[0] is the end of the last summed up interval
+    start = history.last[0]
+    samples = ring.window(start)
+    if not samples:
+        return
+    if start == 0:
+        start = samples[0][0]
+    # skip the intervals the box was down for
+    start += (samples[0][0] - start) // HISTORY_INTERVAL * HISTORY_INTERVAL
+    while samples and samples[-1][0] >= start + HISTORY_INTERVAL:
+        end = start + HISTORY_INTERVAL
+        chunk = [x for x in samples if start <= x[0] < end]
+        samples = [x for x in samples if x[0] >= end]
+        if chunk:
+            cpu = [1 - x[1] for x in chunk]
+            mem = [x[6] for x in chunk]
+            history.append((end, sum(cpu) / len(cpu), max(cpu),
+                            sum(mem) / len(mem), max(mem),
+                            sum(x[2] for x in chunk) / len(chunk),
+                            sum(x[3] for x in chunk) / len(chunk)))
+        start = end
+    history.set_last([start, 0, 0, 0, 0])
+
+
+def dump_history(since):
+    """
+    prints the history after since as json for propad
+    """
+    if not os.path.isfile(history_path):
+        print ('[]')
+        return
+    history = RingBuffer(history_path, HISTORY_CAPACITY, HISTORY_RECORD)
+    records = history.window(since)
+    history.close()
+    print (json.dumps([[round(y, 4) for y in x] for x in records if x[0] > since]))
+
+
+def is_idle(record, policy):
+    busy = record[1] < policy['cpu_idle'] or \
+           record[2] > policy['disk_bps'] or \
+           record[3] > policy['net_bps'] or \
+           record[5] > policy['load']
+    if policy['ssh_sessions'] is not None:
+        busy = busy or record[4] > policy['ssh_sessions']
+    return not busy
+
+
+def should_stop(ring, policy, boot_time):
+    now = time.time()
+    since = max(now - policy['window'], boot_time)
+    samples = ring.window(since)
+    # the window has to be covered, and only by samples of this boot
+    if now - policy['window'] < boot_time or not samples or \
+            samples[0][0] > now - policy['window'] + 2 * policy['sample_interval']:
+        return False
+    if any(b[0] - a[0] > RESUME_GAP for a, b in zip(samples, samples[1:])):
+        return False
+    # a short blip is fine but not when it is still going on
+    if not is_idle(samples[-1], policy):
+        return False
+    idle = len([x for x in samples if is_idle(x, policy)])
+    return idle >= policy['min_idle_fraction'] * len(samples)
+
+
+def power_off(policy):
+    """
+    hibernates the box through the EC2 API with its instance role if it was
+    created for it; powers it off otherwise or if that fails
+    """
+    if policy['hibernate']:
+        try:
+            import boto3
+            with open('/var/lib/cloud/data/instance-id') as f:
+                instance_id = f.read().strip()
+            ec2 = boto3.client('ec2', region_name=policy['region'])
+            ec2.stop_instances(InstanceIds=[instance_id], Hibernate=True)
+            return
+        except Exception as e:
+            sys.stderr.write('could not hibernate, powering off: {0}\n'.format(e))
+    os.system('sudo poweroff')
+
+
+def main():
+    lock = open(lock_path, 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        # the previous run is still going
+        return
+    os.nice(19)
+    policy = load_policy()
+    boot_time = psutil.boot_time()
+    start = time.time()
+    # (time, rusage) after the first pass, which carries the start up cost
+    # (importing psutil, mapping the rings) that the later ones do not
+    measured = None
+    interval = policy['sample_interval']
+    ring = RingBuffer(ring_path)
+    history = RingBuffer(history_path, HISTORY_CAPACITY, HISTORY_RECORD)
+    try:
+        while True:
+            sample(ring, boot_time)
+            summarize(ring, history)
+            if should_stop(ring, policy, boot_time):
+                ring.close()
+                history.close()
+                power_off(policy)
+                return
+            # stay within the overhead budget; sample less often if needed
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            if usage.ru_maxrss / 1024.0 > policy['max_rss_mb']:
+                sys.stderr.write('tclock is over its memory budget\n')
+                return
+            if measured is None:
+                measured = (time.time(), usage)
+            else:
+                elapsed = max(time.time() - measured[0], 1)
+                used = (usage.ru_utime - measured[1].ru_utime) + \
+                    (usage.ru_stime - measured[1].ru_stime)
+                if used / elapsed > policy['max_cpu']:
+                    interval *= 2
+            if time.time() + interval > start + 60:
+                return
+            time.sleep(interval)
+    finally:
+        for x in (ring, history):
+            if not x.mm.closed:
+                x.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == '--history':
+        dump_history(float(sys.argv[2]))
+    else:
+        main()
@@ -3,41 +3,50 @@ import sys
 from provisionpad.aws.aws_ec2 import AWSec2Funcs
 from provisionpad.db.database import load_database, save_database
 from provisionpad.helpers.namehelpers import vpc_name
-from provisionpad.helpers.texthelpers import write_into_text
+from provisionpad.helpers.texthelpers import render_ssh_config
+from provisionpad.helpers.update_status import mark_synced
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import group_by_region, for_each_region
 
 
 
 def start_instance(boxname, env_vars, DB):
+    start_instances([boxname], env_vars, DB)
 
-    if boxname not in DB['stopped_instances']:
-        print ('the box is not available check again:')
-        sys.exit()
+def start_instances(boxnames, env_vars, DB):
+
+    for boxname in boxnames:
+        if boxname not in DB['stopped_instances']:
+            print ('the box {0} is not available check again:'.format(boxname))
+            sys.exit()
 
 
     print ('Waiting for confirmation from AWS')
-    region = env_vars['aws_region']
-    home_folder = env_vars['HOME']
     access_key = env_vars['access_key']
     secret_key = env_vars['secret_key']
-    awsf = AWSec2Funcs(region, access_key, secret_key)
-
-    my_ssh_key_path = env_vars['key_pair_path']
-    ssh_key_name = env_vars['key_pair_name']
-
-    id = DB['stopped_instances'][boxname]['id']
-    DB['running_instances'][boxname] = awsf.start_ec2_instance(id)
-    del(DB['stopped_instances'][boxname])
+    groups = group_by_region(boxnames, 'stopped_instances', env_vars, DB)
+
+    names = {}
+    for boxname in boxnames:
+        names[DB['stopped_instances'][boxname]['id']] = boxname
+
+    def started(id, state):
+        print ('ec2 instance {0} started successfully'.format(names[id]))
+
+    def start(region):
+        awsf = AWSec2Funcs(region, access_key, secret_key)
+        ids = [DB['stopped_instances'][x]['id'] for x in groups[region]]
+        return awsf.start_ec2_instances(ids, callback=started)
+
+    with span('start instances', count=len(names)):
+        infos = {}
+        for region_infos in for_each_region(groups, start).values():
+            infos.update(region_infos)
+    for id, boxname in names.items():
+        DB['running_instances'][boxname] = DB['stopped_instances'][boxname]
+        DB['running_instances'][boxname].update(infos[id])
+        del(DB['stopped_instances'][boxname])
     # DB['available_names'].append(boxname)
+    mark_synced(DB)
     save_database(DB, env_vars['db_path'])
-    write_into_text(boxname,
-'''
-Host {0}
-    HostName {1}
-    User ubuntu
-    IdentityFile {2}
-    ForwardAgent yes
-    StrictHostKeyChecking no
-'''.format(boxname, DB['running_instances'][boxname]['public_ip'], my_ssh_key_path),
-os.path.join(home_folder,'.ssh/config'))
-
-    print ('ec2 instance {0} started successfully'.format(boxname))
+    render_ssh_config(DB, env_vars)
@@ -1,23 +1,25 @@
 from __future__ import print_function
 
-from colorclass import Color, Windows
-
-from terminaltables import SingleTable
-from provisionpad.helpers.update_status import update_status
 import sys
+from provisionpad.helpers.trace import span
 
 class StatTable:
 
-    def __init__(self, instance_status, color):
+    def __init__(self, instance_status, color, home_region=''):
         self.color = color
         self.instance_status = instance_status
+        # boxes from before propad knew about regions are in the home one
+        self.home_region = home_region
 
     def stat(self, DB):
         """Return table string to be printed."""
-        table_data = [[Color('{'+self.color+'}Name{/'+self.color+'}'), 'Type', 'SSH']]
+        from colorclass import Color
+        from terminaltables import SingleTable
+        table_data = [[Color('{'+self.color+'}Name{/'+self.color+'}'), 'Type', 'Region', 'SSH']]
         for ins, ins_val in DB[self.instance_status].items():
             table_data.append([Color('{'+self.color+'}'+ins+'{/'+self.color+'}'), 
-                                ins_val['type'], 'ssh {0}'.format(ins)])
+                                ins_val['type'], ins_val.get('region', self.home_region),
+                                'ssh {0}'.format(ins)])
         table_instance = SingleTable(table_data, self.instance_status)
         table_instance.inner_heading_row_border = True
         return table_instance.table
@@ -26,18 +28,23 @@ class StatTable:
         """Return table string to be printed."""
         str_to_return  = '\n'+self.instance_status+'\n'
         str_to_return += ' ' *len(self.instance_status) + \
-                   "{:<20} {:<20} {:<20}\n".format('Name', 'Type', 'SSH')
+                   "{:<20} {:<20} {:<16} {:<20}\n".format('Name', 'Type', 'Region', 'SSH')
         for ins, ins_val in DB[self.instance_status].items():
             str_to_return += ' ' *len(self.instance_status) + \
-                   "{:<20} {:<20} {:<20}\n".format(ins, ins_val['type'], 'ssh {0}\n'.format(ins)) 
+                   "{:<20} {:<20} {:<16} {:<20}\n".format(ins, ins_val['type'],
+                                                         ins_val.get('region', self.home_region),
+                                                         'ssh {0}\n'.format(ins)) 
         str_to_return += '\n'
         return str_to_return
 
-def show_status(env_vars, DB):
-    update_status(env_vars,DB)
+def show_status(env_vars, DB, cached=False, refresh=False):
+    if not cached:
+        from provisionpad.helpers.update_status import update_status
+        with span('sync state'):
+            update_status(env_vars, DB, force=refresh)
     # print (DB)
-    table_running = StatTable('running_instances', 'autogreen')
-    table_stopped = StatTable('stopped_instances', 'autoyellow')
+    table_running = StatTable('running_instances', 'autogreen', env_vars['aws_region'])
+    table_stopped = StatTable('stopped_instances', 'autoyellow', env_vars['aws_region'])
     if sys.platform == 'win32':
         print (table_running.sstat(DB))
         print (table_stopped.sstat(DB))  
@@ -3,23 +3,50 @@ import sys
 from provisionpad.aws.aws_ec2 import AWSec2Funcs
 from provisionpad.db.database import load_database, save_database
 from provisionpad.helpers.namehelpers import vpc_name
-from provisionpad.helpers.texthelpers import delete_text_from_file
+from provisionpad.helpers.texthelpers import render_ssh_config
+from provisionpad.helpers.update_status import mark_synced
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import group_by_region, for_each_region
 
      
 
 def stop_instance(boxname, env_vars, DB):
+    stop_instances([boxname], env_vars, DB)
+
+def stop_instances(boxnames, env_vars, DB):
+
+    for boxname in boxnames:
+        if boxname not in DB['running_instances']:
+            print ('the box {0} is not running check again:'.format(boxname))
+            sys.exit()
 
-    region = env_vars['aws_region']
-    home_folder = env_vars['HOME']
     access_key = env_vars['access_key']
     secret_key = env_vars['secret_key']
-    awsf = AWSec2Funcs(region, access_key, secret_key)
+    groups = group_by_region(boxnames, 'running_instances', env_vars, DB)
 
-    id = DB['running_instances'][boxname]['id']
-    awsf.stop_ec2_instance(id)
-    DB['stopped_instances'][boxname] = DB['running_instances'][boxname]
-    del(DB['running_instances'][boxname])
-    save_database(DB, env_vars['db_path'])
-    delete_text_from_file(boxname, os.path.join(home_folder,'.ssh/config'))
+    names = {}
+    for boxname in boxnames:
+        names[DB['running_instances'][boxname]['id']] = boxname
 
-    print ('ec2 instance {0} stopped successfully'.format(boxname))
+    def stopped(id, state):
+        print ('ec2 instance {0} stopped successfully'.format(names[id]))
+
+    def stop(region):
+        awsf = AWSec2Funcs(region, access_key, secret_key)
+        infos = [DB['running_instances'][x] for x in groups[region]]
+        # boxes created with --hibernate keep their memory
+        for hibernate in (True, False):
+            ids = [x['id'] for x in infos if bool(x.get('hibernate')) == hibernate]
+            if ids:
+                awsf.stop_ec2_instances(ids, hibernate=hibernate)
+        awsf.wait_instances([x['id'] for x in infos], 'stopped', callback=stopped)
+
+    print ('Waiting for the instances to stop')
+    with span('stop instances', count=len(names)):
+        for_each_region(groups, stop)
+    for boxname in boxnames:
+        DB['stopped_instances'][boxname] = DB['running_instances'][boxname]
+        del(DB['running_instances'][boxname])
+    mark_synced(DB)
+    save_database(DB, env_vars['db_path'])
+    render_ssh_config(DB, env_vars)
@@ -1,36 +1,53 @@
 import os
 import sys
 from provisionpad.aws.aws_ec2 import AWSec2Funcs
-from provisionpad.db.database import load_database, save_database
+from provisionpad.db.database import load_database, save_database, forget_utilization
 from provisionpad.helpers.namehelpers import vpc_name
-from provisionpad.helpers.texthelpers import delete_text_from_file
+from provisionpad.helpers.texthelpers import render_ssh_config
+from provisionpad.helpers.update_status import mark_synced
+from provisionpad.helpers.trace import span
+from provisionpad.helpers.regionhelpers import group_by_region, for_each_region
 import textwrap
 
 
 def terminate_instance(boxname, env_vars, DB):
+    terminate_instances([boxname], env_vars, DB)
 
-    if boxname in DB['stopped_instances']:
-        raise ValueError(textwrap.dedent('''\
-              Instance {name} is in stopped state and can not be terminated
-                          To terminate the instance you need to first start it:
-                          propad start {name}; then you can stop it
-        '''.format(name=boxname)))
+def terminate_instances(boxnames, env_vars, DB):
+
+    for boxname in boxnames:
+        if boxname in DB['stopped_instances']:
+            raise ValueError(textwrap.dedent('''\
+                  Instance {name} is in stopped state and can not be terminated
+                              To terminate the instance you need to first start it:
+                              propad start {name}; then you can stop it
+            '''.format(name=boxname)))
+        if boxname not in DB['running_instances']:
+            print ('the box {0} is not available check again:'.format(boxname))
+            sys.exit()
 
-    region = env_vars['aws_region']
-    home_folder = env_vars['HOME']
     access_key = env_vars['access_key']
     secret_key = env_vars['secret_key']
-    awsf = AWSec2Funcs(region, access_key, secret_key)
+    groups = group_by_region(boxnames, 'running_instances', env_vars, DB)
+
+    def terminate(region):
+        awsf = AWSec2Funcs(region, access_key, secret_key)
+        awsf.terminate_ec2_instances([DB['running_instances'][x]['id'] for x in groups[region]])
 
-    id = DB['running_instances'][boxname]['id']
-    awsf.terminate_ec2_instance(id)
-    del(DB['running_instances'][boxname])
-    if boxname[0:3] == 'box':
-        DB['available_names'].append(boxname)
+    ids = [DB['running_instances'][boxname]['id'] for boxname in boxnames]
+    with span('terminate instances', count=len(ids)):
+        for_each_region(groups, terminate)
+    for boxname in boxnames:
+        del(DB['running_instances'][boxname])
+        if boxname[0:3] == 'box':
+            DB['available_names'].append(boxname)
+    mark_synced(DB)
     save_database(DB, env_vars['db_path'])
-    delete_text_from_file(boxname, os.path.join(home_folder,'.ssh/config'))
+    forget_utilization(env_vars['db_path'], ids)
+    render_ssh_config(DB, env_vars)
 
-    print ('ec2 instance {0} terminated successfully'.format(boxname))
+    for boxname in boxnames:
+        print ('ec2 instance {0} terminated successfully'.format(boxname))
 
 # if __name__ == "__main__":
 
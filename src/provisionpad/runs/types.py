@@ -0,0 +1,24 @@
+import os
+import sys
+from provisionpad.helpers.typehelpers import cache_instance_types, find_instance_types
+
+
+def show_types(env_vars, region, pattern='*', min_vcpu=0, min_mem=0, arch=None, refresh=False):
+    """
+    prints the instance types of the region with at least min_vcpu vCPUs
+    and min_mem GiB of memory, smallest first
+    """
+    if refresh:
+        cache_instance_types(env_vars, region, refresh=True)
+    types = find_instance_types(env_vars, region, min_vcpu=min_vcpu,
+                                min_memory_mib=int(min_mem * 1024), arch=arch,
+                                pattern=pattern)
+    if not types:
+        print ('no instance type in {0} matches'.format(region))
+        return
+    print ("{:<18} {:>5} {:>9} {:<20} {:>9} {:<14} {:>5}".format(
+        'Type', 'vCPU', 'Mem GiB', 'Network', 'EBS Mbps', 'Arch', 'AZs'))
+    for x in types:
+        print ("{:<18} {:>5} {:>9.1f} {:<20} {:>9} {:<14} {:>5}".format(
+            x['type'], x['vcpu'], x['memory_mib'] / 1024.0, x['network'][:20],
+            x['ebs_mbps'] or '-', x['arch'], len(x['zones'])))
@@ -0,0 +1,531 @@
+import os
+import re
+import sys
+import json
+import time
+import fnmatch
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from provisionpad.aws.aws_ec2 import AWSec2Funcs
+from provisionpad.db.database import save_database
+from provisionpad.helpers.bootstrap import ssh_command, REMOTE_USER, REMOTE_DIR
+from provisionpad.helpers.regionhelpers import region_env, home_region, instance_region, \
+    all_regions, for_each_region
+from provisionpad.helpers.typehelpers import find_instance_types
+from provisionpad.helpers.trace import span
+
+# propad volume creates EBS volumes in groups: a group of one is a plain
+# volume, a bigger one is striped (RAID0) over ssh into a single file
+# system so the box gets the bandwidth of all of its volumes together (up
+# to the EBS bandwidth of the instance type). Groups are attached and
+# detached as a whole:
+#   DB['volumes'][name] = {'id', 'region', 'az', 'size', 'type', 'iops',
+#                          'throughput', 'group', 'box', 'device', 'mount'}
+# the members of a group of N are named group-1 .. group-N. mount is where
+# the group's file system goes; empty when propad did not make one.
+#
+# Groups can also be made from snapshots (--snapshot): a snapshot id, the
+# latest snapshot with that Name tag or, for a stripe, the latest of each
+# of name-1 .. name-N, which is what propad volume snapshot makes. Their
+# blocks are loaded from S3 on the first touch; propad volume prewarm (or
+# create --prewarm) reads them all once on the box in the background (see
+# scripts/prewarm.py) and shows how far it got.
+
+# device names EC2 suggests for EBS data volumes
+DEVICE_NAMES = ['/dev/sd' + x for x in 'fghijklmnopqrstuvwxyz']
+# stripe unit of the RAID0 in KiB
+CHUNK_KIB = 256
+DEFAULT_SIZE = 100
+# where the file system of the volumes was mounted, on their snapshots
+MOUNT_TAG = 'propad-mount'
+
+# finds the devices of the volumes (nitro boxes show them as nvme devices
+# with the volume id as the serial), stripes them if there are several,
+# makes the file system if fresh and mounts it
+MOUNT_SCRIPT = '''set -e
+DEVICES=""
+for pair in {devices}; do
+    vol=${{pair%%:*}}
+    alt=${{pair#*:}}
+    dev=""
+    for i in $(seq 60); do
+        for x in /dev/disk/by-id/nvme-Amazon_Elastic_Block_Store_${{vol/-/}} $alt; do
+            if [ -b $x ]; then dev=$(readlink -f $x); break 2; fi
+        done
+        sleep 2
+    done
+    if [ -z "$dev" ]; then echo "$vol did not show up" >&2; exit 1; fi
+    DEVICES="$DEVICES $dev"
+done
+set -- $DEVICES
+TARGET=$1
+if [ $# -gt 1 ]; then
+    command -v mdadm >/dev/null || (apt-get update && apt-get install -y mdadm)
+    TARGET=/dev/md/{group}
+    if [ {fresh} = 1 ]; then
+        mdadm --create $TARGET --run --level=0 --chunk={chunk} --raid-devices=$# "$@"
+    else
+        # udev may have put the stripe together already
+        held=$(ls /sys/block/$(basename $1)/holders 2>/dev/null | head -1)
+        if [ -n "$held" ]; then TARGET=/dev/$held; else mdadm --assemble $TARGET "$@"; fi
+    fi
+fi
+if [ {fresh} = 1 ]; then
+    mkfs.ext4 -q -F -m 0 -E stride={stride},stripe_width=$(({stride} * $#)) $TARGET
+fi
+mkdir -p {mount}
+grep -v " {mount} " /etc/fstab > /etc/fstab.propad || true
+echo "UUID=$(blkid -s UUID -o value $TARGET) {mount} ext4 defaults,noatime,nofail 0 2" >> /etc/fstab.propad
+mv /etc/fstab.propad /etc/fstab
+mount {mount}
+if [ {fresh} = 1 ]; then chown {user}: {mount}; fi
+'''
+
+UNMOUNT_SCRIPT = '''src=$(findmnt -n -o SOURCE {mount} || true)
+umount {mount} || true
+case "$src" in /dev/md*) mdadm --stop $src || true;; esac
+grep -v " {mount} " /etc/fstab > /etc/fstab.propad || true
+mv /etc/fstab.propad /etc/fstab
+'''
+
+PREWARM_START = '''mkdir -p {remote_dir}
+cat > {remote_dir}/prewarm.py <<'PROPAD_EOF'
+{script}
+PROPAD_EOF
+PY=$(command -v python3 || command -v python)
+nohup $PY {remote_dir}/prewarm.py {progress} {devices} > {progress}.log 2>&1 < /dev/null &
+'''
+
+
+def volume_mbps(vtype, iops, throughput):
+    """
+    rough MiB/s a volume moves at full speed
+    """
+    if vtype == 'gp3':
+        return throughput or 125
+    if vtype in ('io1', 'io2'):
+        return min(iops // 4, 1000)
+    return {'gp2': 250, 'st1': 500, 'sc1': 250, 'standard': 90}.get(vtype, 0)
+
+
+def group_members(DB, group):
+    return sorted(x for x, y in DB['volumes'].items() if y['group'] == group)
+
+
+def select_groups(DB, patterns):
+    """
+    the groups with a name or a member matching any of the names or glob
+    patterns; exits when one matches nothing
+    """
+    groups = []
+    for pattern in patterns:
+        found = sorted(set(y['group'] for x, y in DB['volumes'].items()
+                           if fnmatch.fnmatch(x, pattern) or fnmatch.fnmatch(y['group'], pattern)))
+        if not found:
+            print ('there is no volume named {0}; propad volume list shows them'.format(pattern))
+            sys.exit(1)
+        groups.extend(x for x in found if x not in groups)
+    return groups
+
+
+def find_box(boxname, DB):
+    for key in ('running_instances', 'stopped_instances'):
+        if boxname in DB[key]:
+            return DB[key][boxname], key == 'running_instances'
+    print ('the box {0} is not available check again:'.format(boxname))
+    sys.exit(1)
+
+
+def device_pairs(volumes):
+    """
+    volume id:device name as the box may see it, for the on box scripts
+    """
+    return ' '.join('{0}:{1}'.format(x['id'], x['device'].replace('/dev/sd', '/dev/xvd'))
+                    for x in volumes)
+
+
+def run_on_box(boxname, script):
+    proc = subprocess.Popen(ssh_command(boxname) + ['sudo', 'bash', '-s'],
+                            stdin=subprocess.PIPE)
+    proc.communicate(script.encode('UTF-8'))
+    return proc.returncode == 0
+
+
+def resolve_snapshots(awsf, name):
+    """
+    the snapshots to make the volumes of a group from, in order: the
+    snapshot with that id, the latest named name or the latest of each of
+    name-1 .. name-N
+    """
+    if name.startswith('snap-'):
+        return [awsf.snapshot_info(name)]
+    latest = {}
+    for x in sorted(awsf.named_snapshots([name, name + '-*'], state='completed'),
+                    key=lambda x: x['time']):
+        latest[x['name']] = x
+    if name in latest:
+        return [latest[name]]
+    parts = []
+    while '{0}-{1}'.format(name, len(parts) + 1) in latest:
+        parts.append(latest['{0}-{1}'.format(name, len(parts) + 1)])
+    if not parts:
+        print ('there is no completed snapshot named {0}'.format(name))
+        sys.exit(1)
+    return parts
+
+
+def create_volumes(group, size, vtype, iops, throughput, count, boxname, zone, region,
+                   mount, env_vars, DB, snapshot=None, prewarm=False):
+
+    if not re.match(r'^[A-Za-z0-9_-]+$', group):
+        print ('volume names can only have letters, digits, - and _')
+        sys.exit(1)
+    if vtype in ('io1', 'io2') and not iops:
+        print ('{0} volumes need --iops'.format(vtype))
+        sys.exit(1)
+
+    running = False
+    if boxname:
+        info, running = find_box(boxname, DB)
+        region = instance_region(info, env_vars)
+        zone = info['az']
+    elif not zone:
+        print ('enter the box to attach the volumes to or the availability zone to create them in')
+        sys.exit(1)
+    region = region or home_region(env_vars)
+    region_env(env_vars, DB, region)
+
+    awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+
+    snapshots = [None] * count
+    if snapshot:
+        with span('find snapshots'):
+            snapshots = resolve_snapshots(awsf, snapshot)
+        if count not in (1, len(snapshots)):
+            print ('{0} has {1} volume(s), not {2}'.format(snapshot, len(snapshots), count))
+            sys.exit(1)
+        count = len(snapshots)
+        mount = mount or snapshots[0]['tags'].get(MOUNT_TAG, '')
+    if (mount or prewarm) and not running:
+        print ('start {0} first; the volumes are set up on it over ssh'.format(boxname))
+        sys.exit(1)
+
+    names = [group] if count == 1 else ['{0}-{1}'.format(group, x + 1) for x in range(count)]
+    taken = set(DB['volumes']) | set(x['group'] for x in DB['volumes'].values())
+    if group in taken or any(x in taken for x in names):
+        print ('there is already a volume named {0}'.format(group))
+        sys.exit(1)
+    # a volume can be bigger than its snapshot but not smaller
+    sizes = [max(size or 0, x['size']) if x else size or DEFAULT_SIZE for x in snapshots]
+
+    def create(x):
+        name, vsize, snap = x
+        return awsf.create_volume({'az': zone, 'size': vsize, 'vtype': vtype, 'iops': iops,
+                                   'throughput': throughput,
+                                   'snapshot': snap['id'] if snap else None,
+                                   'name': env_vars['your_name'] + name})
+    if snapshot:
+        print ('creating {0} {1} volume(s) from {2}'.format(count, vtype, snapshot))
+    else:
+        print ('creating {0} {1} GiB {2} volume(s)'.format(count, sizes[0], vtype))
+    with span('create volumes', count=count):
+        with ThreadPoolExecutor(max_workers=min(count, 16)) as pool:
+            ids = list(pool.map(create, zip(names, sizes, snapshots)))
+    for name, id, vsize, snap in zip(names, ids, sizes, snapshots):
+        DB['volumes'][name] = {'id': id, 'region': region, 'az': zone, 'size': vsize,
+                               'type': vtype, 'iops': iops or 0,
+                               'throughput': throughput or 0, 'group': group,
+                               'box': '', 'device': '', 'mount': '',
+                               'snapshot': snap['id'] if snap else ''}
+    save_database(DB, env_vars['db_path'])
+    with span('wait for volumes'):
+        awsf.wait_volumes(ids, 'available')
+
+    if not boxname:
+        print ('volume(s) {0} ready to attach'.format(', '.join(names)))
+        return
+    attach_group(group, boxname, mount, env_vars, DB)
+    if prewarm:
+        start_prewarm(group, env_vars, DB)
+        print ('propad volume prewarm {0} shows how far it got'.format(group))
+
+
+def attach_group(group, boxname, mount, env_vars, DB):
+    """
+    attaches all the volumes of the group to free devices of the box and
+    mounts them if propad made a file system on them before or mount is
+    given (which makes one if there is none yet)
+    """
+    members = group_members(DB, group)
+    volumes = [DB['volumes'][x] for x in members]
+    info, running = find_box(boxname, DB)
+    if any(x['box'] for x in volumes):
+        print ('{0} is attached to {1}; detach it first'.format(group, volumes[0]['box']))
+        sys.exit(1)
+    if volumes[0]['az'] != info['az']:
+        print ('{0} is in {1} but {2} is in {3}'.format(group, volumes[0]['az'], boxname, info['az']))
+        sys.exit(1)
+    # a file system made before goes back where it was unless told otherwise;
+    # volumes made from a snapshot are never formatted
+    fresh = not volumes[0]['mount'] and not volumes[0].get('snapshot')
+    mount = mount or volumes[0]['mount']
+    if mount and not running:
+        print ('start {0} first; the volumes are mounted on it over ssh'.format(boxname))
+        sys.exit(1)
+
+    awsf = AWSec2Funcs(volumes[0]['region'], env_vars['access_key'], env_vars['secret_key'])
+    taken = set(x.replace('/dev/xvd', '/dev/sd') for x in awsf.instance_devices(info['id']))
+    devices = [x for x in DEVICE_NAMES if x not in taken][:len(volumes)]
+    if len(devices) < len(volumes):
+        print ('{0} does not have {1} free device names'.format(boxname, len(volumes)))
+        sys.exit(1)
+
+    with span('attach volumes', count=len(volumes)):
+        for volume, device in zip(volumes, devices):
+            awsf.attach_volume(volume['id'], info['id'], device)
+        awsf.wait_volumes([x['id'] for x in volumes], 'in-use')
+    for volume, device in zip(volumes, devices):
+        volume['box'] = boxname
+        volume['device'] = device
+    save_database(DB, env_vars['db_path'])
+    print ('{0} attached to {1} as {2}'.format(group, boxname, ' '.join(devices)))
+
+    found = find_instance_types(env_vars, volumes[0]['region'], name=info['type'])
+    box_mbps = found[0]['ebs_mbps'] / 8 if found else 0
+    volumes_mbps = sum(volume_mbps(x['type'], x['iops'], x['throughput']) for x in volumes)
+    if box_mbps and volumes_mbps > box_mbps:
+        print ('note: the volumes can move about {0} MB/s but a {1} only about {2:.0f} MB/s'.format(
+            volumes_mbps, info['type'], box_mbps))
+
+    if not mount:
+        return
+    script = MOUNT_SCRIPT.format(
+        devices=device_pairs(volumes), group=group, fresh=int(fresh), chunk=CHUNK_KIB, stride=CHUNK_KIB // 4,
+        mount=mount, user=REMOTE_USER)
+    with span('mount volumes'):
+        if not run_on_box(boxname, script):
+            print ('could not mount {0} on {1}; the volumes are attached'.format(group, boxname))
+            sys.exit(1)
+    for volume in volumes:
+        volume['mount'] = mount
+    save_database(DB, env_vars['db_path'])
+    print ('{0} mounted at {1} on {2}'.format(group, mount, boxname))
+
+
+def attach_volumes(patterns, boxname, mount, env_vars, DB):
+    for group in select_groups(DB, patterns):
+        attach_group(group, boxname, mount, env_vars, DB)
+
+
+def detach_volumes(patterns, env_vars, DB):
+    for group in select_groups(DB, patterns):
+        volumes = [DB['volumes'][x] for x in group_members(DB, group)]
+        boxname = volumes[0]['box']
+        if not boxname:
+            print ('{0} is not attached'.format(group))
+            continue
+        if volumes[0]['mount'] and boxname in DB['running_instances']:
+            with span('unmount volumes'):
+                run_on_box(boxname, UNMOUNT_SCRIPT.format(mount=volumes[0]['mount']))
+        awsf = AWSec2Funcs(volumes[0]['region'], env_vars['access_key'], env_vars['secret_key'])
+        with span('detach volumes', count=len(volumes)):
+            for volume in volumes:
+                awsf.detach_volume(volume['id'])
+            awsf.wait_volumes([x['id'] for x in volumes], 'available')
+        for volume in volumes:
+            volume['box'] = ''
+            volume['device'] = ''
+        save_database(DB, env_vars['db_path'])
+        print ('{0} detached from {1}'.format(group, boxname))
+
+
+def delete_volumes(patterns, env_vars, DB):
+    for group in select_groups(DB, patterns):
+        members = group_members(DB, group)
+        volumes = [DB['volumes'][x] for x in members]
+        if volumes[0]['box']:
+            print ('{0} is attached to {1}; detach it first'.format(group, volumes[0]['box']))
+            continue
+        awsf = AWSec2Funcs(volumes[0]['region'], env_vars['access_key'], env_vars['secret_key'])
+        for volume in volumes:
+            awsf.delete_volume(volume['id'])
+        for x in members:
+            del DB['volumes'][x]
+        save_database(DB, env_vars['db_path'])
+        print ('{0} deleted'.format(group))
+
+
+def sync_volumes(env_vars, DB):
+    """
+    drops the volumes deleted outside of propad and updates which box they
+    are attached to (a terminated box lets go of its volumes)
+    """
+    boxes = dict((y['id'], x) for key in ('running_instances', 'stopped_instances')
+                 for x, y in DB[key].items())
+
+    def describe(region):
+        ids = [x['id'] for x in DB['volumes'].values() if x['region'] == region]
+        if not ids:
+            return {}
+        awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+        return awsf.volumes_info(ids)
+
+    with span('describe volumes'):
+        aws_info = {}
+        for info in for_each_region(all_regions(env_vars, DB), describe).values():
+            aws_info.update(info)
+    for name, volume in list(DB['volumes'].items()):
+        if volume['id'] not in aws_info:
+            del DB['volumes'][name]
+            continue
+        volume['state'] = aws_info[volume['id']]['state']
+        attached = aws_info[volume['id']]['instance_id']
+        volume['box'] = boxes.get(attached, attached or '')
+        if not attached:
+            volume['device'] = ''
+    save_database(DB, env_vars['db_path'])
+
+
+def list_volumes(env_vars, DB):
+    sync_volumes(env_vars, DB)
+    print ("{:<20} {:<22} {:>6} {:<5} {:>6} {:>6} {:<10} {:<12} {:<8} {}".format(
+        'Name', 'Id', 'GiB', 'Type', 'IOPS', 'MiB/s', 'State', 'Box', 'Device', 'Mount'))
+    for name, x in sorted(DB['volumes'].items()):
+        print ("{:<20} {:<22} {:>6} {:<5} {:>6} {:>6} {:<10} {:<12} {:<8} {}".format(
+            name, x['id'], x['size'], x['type'], x['iops'] or '-',
+            volume_mbps(x['type'], x['iops'], x['throughput']), x.get('state', ''),
+            x['box'] or '-', x['device'].replace('/dev/', '') or '-', x['mount'] or '-'))
+
+
+def snapshot_volumes(pattern, snapname, env_vars, DB):
+    """
+    starts a snapshot of every volume of the group named snapname (or
+    snapname-1 .. snapname-N) which create --snapshot snapname takes
+    """
+    groups = select_groups(DB, [pattern])
+    if len(groups) != 1:
+        print ('{0} matches more than one volume'.format(pattern))
+        sys.exit(1)
+    members = group_members(DB, groups[0])
+    volumes = [DB['volumes'][x] for x in members]
+    if len(volumes) > 1 and volumes[0]['box']:
+        # the volumes would be snapshotted at slightly different times
+        print ('detach {0} first; a stripe is snapshotted while nothing writes to it'.format(groups[0]))
+        sys.exit(1)
+    names = [snapname] if len(volumes) == 1 else \
+        ['{0}-{1}'.format(snapname, x + 1) for x in range(len(volumes))]
+    tags = [{'Key': MOUNT_TAG, 'Value': volumes[0]['mount']}] if volumes[0]['mount'] else []
+    awsf = AWSec2Funcs(volumes[0]['region'], env_vars['access_key'], env_vars['secret_key'])
+    with span('create snapshots', count=len(volumes)):
+        ids = [awsf.create_snapshot(x['id'], y, tags) for x, y in zip(volumes, names)]
+    print ('snapshotting {0} as {1} ({2})'.format(groups[0], snapname, ' '.join(ids)))
+    print ('it can be used once complete; propad volume snapshots shows when')
+
+
+def list_snapshots(pattern, env_vars, DB):
+
+    def describe(region):
+        awsf = AWSec2Funcs(region, env_vars['access_key'], env_vars['secret_key'])
+        return awsf.named_snapshots([pattern])
+
+    with span('describe snapshots'):
+        found = for_each_region(all_regions(env_vars, DB), describe)
+    print ("{:<24} {:<24} {:>6} {:<16} {:<14} {}".format(
+        'Name', 'Id', 'GiB', 'State', 'Region', 'Mount'))
+    for region, snapshots in sorted(found.items()):
+        for x in sorted(snapshots, key=lambda x: (x['name'], x['time'])):
+            state = x['state'] if x['state'] != 'pending' else 'pending ' + x['progress']
+            print ("{:<24} {:<24} {:>6} {:<16} {:<14} {}".format(
+                x['name'], x['id'], x['size'], state, region, x['tags'].get(MOUNT_TAG, '-')))
+
+
+def prewarm_script():
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    with open(os.path.join(dir_path, 'scripts', 'prewarm.py')) as f:
+        return f.read().strip()
+
+
+def prewarm_path(volumes):
+    return '{0}/prewarm-{1}.json'.format(REMOTE_DIR, volumes[0]['id'])
+
+
+def start_prewarm(group, env_vars, DB):
+    """
+    starts reading all the blocks of the group on its box in the background;
+    nothing happens if that is running or done already
+    """
+    volumes = [DB['volumes'][x] for x in group_members(DB, group)]
+    if not volumes[0].get('snapshot'):
+        print ('{0} is not made from a snapshot; there is nothing to pre-warm'.format(group))
+        return False
+    boxname = volumes[0]['box']
+    if boxname not in DB['running_instances']:
+        print ('{0} has to be attached to a running box to be pre-warmed'.format(group))
+        sys.exit(1)
+    script = PREWARM_START.format(remote_dir=REMOTE_DIR, script=prewarm_script(),
+                                  progress=prewarm_path(volumes), devices=device_pairs(volumes))
+    with span('start prewarm'):
+        if not run_on_box(boxname, script):
+            print ('could not start pre-warming {0} on {1}'.format(group, boxname))
+            sys.exit(1)
+    print ('pre-warming {0} on {1}'.format(group, boxname))
+    return True
+
+
+def prewarm_progress(boxname, path):
+    proc = subprocess.Popen(ssh_command(boxname) + ['cat', path],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, _ = proc.communicate()
+    if proc.returncode != 0:
+        return None
+    try:
+        return json.loads(out.decode('UTF-8'))
+    except ValueError:
+        return None
+
+
+def follow_prewarm(group, DB, interval=5):
+    """
+    shows how far the pre-warm of the group got until it is done; ctrl-c
+    only stops watching it
+    """
+    volumes = [DB['volumes'][x] for x in group_members(DB, group)]
+    boxname = volumes[0]['box']
+    path = prewarm_path(volumes)
+    last = None
+    start = time.time()
+    try:
+        while True:
+            progress = prewarm_progress(boxname, path)
+            if progress is None and time.time() - start > 120:
+                print ('\n{0} did not start; see {1}.log on {2}'.format(group, path, boxname))
+                sys.exit(1)
+            if progress is None:
+                sys.stdout.write('\r{0}: starting'.format(group))
+            else:
+                done = sum(x[0] for x in progress['volumes'].values())
+                size = sum(x[1] for x in progress['volumes'].values()) or 1
+                line = '{0}: {1:.0%} of {2:.0f} GiB'.format(group, float(done) / size, size / 2.0**30)
+                if last is not None and progress['updated'] > last[1]:
+                    rate = (done - last[0]) / (progress['updated'] - last[1])
+                    if rate > 0:
+                        line += ', {0:.0f} MiB/s, about {1:.0f} min left'.format(
+                            rate / 2.0**20, (size - done) / rate / 60)
+                last = (done, progress['updated'])
+                sys.stdout.write('\r' + line.ljust(60))
+                if progress['error']:
+                    print ('\npre-warming failed: {0}'.format(progress['error']))
+                    sys.exit(1)
+                if progress['done']:
+                    print ('\n{0} is pre-warmed'.format(group))
+                    return
+            sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print ('\nit goes on on {0} in the background'.format(boxname))
+
+
+def prewarm_volumes(patterns, follow, env_vars, DB):
+    for group in select_groups(DB, patterns):
+        if start_prewarm(group, env_vars, DB) and follow:
+            follow_prewarm(group, DB)